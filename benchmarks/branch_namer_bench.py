@@ -0,0 +1,75 @@
+"""
+Compare regex based branch name conversions with a precompiled cached BranchNamer.
+
+    python benchmarks/branch_namer_bench.py [--branches 2000] [--repeat 5]
+"""
+import argparse
+import os
+import re
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fabric_utils.git import BranchNamer  # noqa: E402
+
+DOMAIN_PATTERN = (r'^.*myb-?(\d+)$', r'myb\1')
+BASE_DOMAIN = 'example.com'
+
+
+def uncompiled_branch_to_domain(branch_name, domain_pattern=None):
+    # the conversion as it was before BranchNamer
+    if domain_pattern:
+        pattern, replacer = domain_pattern
+        match_obj = re.search(pattern, branch_name, flags=re.I)
+        if match_obj:
+            return re.sub(pattern, replacer, branch_name, flags=re.I)
+    domain = re.sub(r'[^a-z0-9\-]', '-', branch_name.lower())
+    return re.sub(r'-{2,}', '-', domain)
+
+
+def uncompiled_names(branch_name):
+    domain = uncompiled_branch_to_domain(branch_name, DOMAIN_PATTERN)
+    slug = uncompiled_branch_to_domain(branch_name.split('/', 1)[-1], DOMAIN_PATTERN)
+    db = uncompiled_branch_to_domain(branch_name, DOMAIN_PATTERN).replace('-', '')
+    url_domain = uncompiled_branch_to_domain(branch_name, DOMAIN_PATTERN)
+    url = BASE_DOMAIN if url_domain == 'master' else f'{url_domain}.{BASE_DOMAIN}'
+    return domain, slug, db, url
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--branches', type=int, default=2000)
+    parser.add_argument('--labels', type=int, default=50000, help='container labels looked up')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    branches = [f'feature/some-stuff-{idx}' if idx % 2 else f'bugfix/MYB-{idx}' for idx in range(args.branches)]
+    labels = [branches[idx % len(branches)] for idx in range(args.labels)]
+
+    def uncompiled():
+        for label in labels:
+            uncompiled_names(label)
+
+    def namer():
+        branch_namer = BranchNamer(DOMAIN_PATTERN, BASE_DOMAIN)
+        for label in labels:
+            branch_namer.names(label)
+
+    def namer_uncached():
+        branch_namer = BranchNamer(DOMAIN_PATTERN, BASE_DOMAIN, cache_size=0)
+        for label in labels:
+            branch_namer.names(label)
+
+    results = {
+        'regex per call': min(timeit.repeat(uncompiled, number=1, repeat=args.repeat)),
+        'BranchNamer, no cache': min(timeit.repeat(namer_uncached, number=1, repeat=args.repeat)),
+        'BranchNamer': min(timeit.repeat(namer, number=1, repeat=args.repeat)),
+    }
+    print(f'{args.labels} labels of {args.branches} branches')
+    for name, seconds in results.items():
+        print(f'{name + ":":<24}{seconds * 1000:9.1f}ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""
+Compare the tar pipeline checksum (helpers.get_checksum) with the incremental manifest checksum.
+
+    python benchmarks/checksum_bench.py [--files 40000] [--size 2048]
+"""
+import argparse
+import contextlib
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fabric_utils.manifest import build_manifest, main as manifest_main, merkle_root  # noqa: E402
+
+# helpers.checksum and helpers.get_checksum pipelines
+TAR_PIPELINES = {
+    'checksum': 'find {paths} -type f -print0 | sort -z | xargs -0 tar cf - | shasum',
+    'get_checksum': 'find {paths} -type f -print0 | sort -z | xargs -0 tar cf - | tar xOf - | shasum',
+}
+
+
+def make_tree(root, files_count, file_size):
+    payload = os.urandom(file_size)
+    for idx in range(files_count):
+        directory = os.path.join(root, f'pkg{idx // 500}', f'mod{idx // 50}')
+        os.makedirs(directory, exist_ok=True)
+        with open(os.path.join(directory, f'file{idx}.js'), 'wb') as file:
+            file.write(payload + str(idx).encode())
+
+
+def timed(func):
+    started_at = time.perf_counter()
+    result = func()
+    return time.perf_counter() - started_at, result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--files', type=int, default=40000)
+    parser.add_argument('--size', type=int, default=2048)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        make_tree(root, args.files, args.size)
+        paths = [root]
+
+        tar_times = {
+            name: timed(lambda: subprocess.check_output(pipeline.format(paths='.'), shell=True, cwd=root,
+                                                        stderr=subprocess.DEVNULL))[0]
+            for name, pipeline in TAR_PIPELINES.items()
+        }
+        cold_time, (manifest, _) = timed(lambda: build_manifest(paths))
+        warm_time, (manifest, hashed_count) = timed(lambda: build_manifest(paths, manifest))
+        assert hashed_count == 0
+
+        # touch 1% of the files
+        changed_files = sorted(manifest)[::100]
+        for path in changed_files:
+            with open(path, 'ab') as file:
+                file.write(b'!')
+        changed_time, (manifest, hashed_count) = timed(lambda: build_manifest(paths, manifest))
+        assert hashed_count == len(changed_files)
+        root_time, _ = timed(lambda: merkle_root(manifest))
+
+        # the remote helper run: load the saved manifest, check the tree, save the pending manifest
+        manifest_filename = os.path.join(tempfile.gettempdir(), f'checksum-bench-{os.getpid()}.json')
+        with contextlib.redirect_stdout(io.StringIO()):
+            manifest_main(['update', manifest_filename] + paths)
+            cli_time, _ = timed(lambda: manifest_main(['check', manifest_filename] + paths))
+        for filename in (manifest_filename, f'{manifest_filename}.new'):
+            os.remove(filename)
+
+    print(f'{args.files} files of {args.size} bytes')
+    for name, tar_time in tar_times.items():
+        print(f'tar pipeline ({name + "):":<14}{tar_time:8.3f}s')
+    print(f'manifest, cold:            {cold_time:8.3f}s')
+    print(f'manifest, unchanged:       {warm_time:8.3f}s')
+    print(f'manifest, 1% changed:      {changed_time:8.3f}s')
+    print(f'merkle root:               {root_time:8.3f}s')
+    print(f'manifest check command:    {cli_time:8.3f}s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,33 @@
+"""
+In-process stand-ins for fabric run/sudo/local returning recorded outputs.
+"""
+import re
+from typing import Any, List, Optional, Pattern, Tuple
+
+from fabric_utils.batch import BatchedResult
+
+
+class FakeRunner:
+    """
+    Command function answering with the output of the first matching response,
+    a command with no matching response fails with exit code 127
+    """
+
+    def __init__(self, *responses: Tuple[str, str], default: Optional[str] = None) -> None:
+        self.responses = []  # type: List[Tuple[Pattern, str, int]]
+        self.default = default
+        self.commands = []  # type: List[str]
+        for pattern, output in responses:
+            self.respond(pattern, output)
+
+    def respond(self, pattern: str, output: str, return_code: int = 0) -> None:
+        self.responses.append((re.compile(pattern), output, return_code))
+
+    def __call__(self, command: str, *args: Any, **kwargs: Any) -> BatchedResult:
+        self.commands.append(command)
+        for pattern, output, return_code in self.responses:
+            if pattern.search(command):
+                return BatchedResult(command, output, '', return_code)
+        if self.default is not None:
+            return BatchedResult(command, self.default, '', 0)
+        return BatchedResult(command, '', 'command not found', 127)
@@ -0,0 +1,331 @@
+"""
+Simulated fleet for scaling runs of the parallel execute paths.
+
+Hosts are simulated in process: the library's remote command function is replaced with a fake transport
+answering for env.host_string after the host latency, failing at the host failure rate,
+and with the health of flapping hosts going up and down. No ssh connections are made,
+while fabric still forks a worker per host, so the wall time, the memory and the number of processes
+show where parallel execute stops scaling.
+Every run is measured in a fresh interpreter, so that its peak RSS is not the peak of the runs before it.
+
+    python benchmarks/fleet.py [--hosts 25 50 100 200 400] [--latency 0.05] [--jitter 0.02]
+                               [--failure-rate 0.01] [--flapping 0.05] [--flap-period 2]
+                               [--scenarios check_role_is_up ...] [--json results.json]
+"""
+import argparse
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from contextlib import contextmanager
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fabric.api import env, execute, hide, settings  # noqa: E402
+
+from fabric_utils import cleanup, healthcheck, swarm, waves  # noqa: E402
+from fabric_utils.batch import BatchedResult  # noqa: E402
+from fabric_utils.placement import get_ring  # noqa: E402
+
+# the modules whose remote command function is replaced with the fleet
+PATCHED_MODULES = [cleanup, healthcheck, swarm]
+
+
+class FakeFleet:
+    """
+    Fake hosts with a latency, a failure rate and (for a part of them) flapping health
+    """
+
+    def __init__(self, hosts, *, latency=0.05, jitter=0.02, failure_rate=0.0, flapping=0.0, flap_period=2.0,
+                 branches_per_host=5, seed=0):
+        self.hosts = list(hosts)
+        self.latency = latency
+        self.jitter = jitter
+        self.failure_rate = failure_rate
+        self.flap_period = flap_period
+        self.branches_per_host = branches_per_host
+        seeded = random.Random(seed)
+        self.flapping_hosts = {host for host in self.hosts if seeded.random() < flapping}
+        # phases of the flapping hosts, so that they don't go down all at once
+        self.phases = {host: seeded.uniform(0, 2 * flap_period) for host in self.hosts}
+        self.started_at = time.time()
+
+    def is_healthy(self, host):
+        if host not in self.flapping_hosts:
+            return True
+        elapsed = time.time() - self.started_at + self.phases[host]
+        return int(elapsed / self.flap_period) % 2 == 0
+
+    def run(self, command, *args, **kwargs):
+        host = env.host_string
+        # workers are forked, so every call draws from a generator of its own
+        chance = random.Random(zlib.crc32(f'{host}{command}{time.time()}{os.getpid()}'.encode()))
+        time.sleep(max(0, self.latency + chance.uniform(-self.jitter, self.jitter)))
+        if chance.random() < self.failure_rate:
+            return BatchedResult(command, '', 'connection reset', 255)
+
+        if 'curl' in command:
+            if self.is_healthy(host):
+                return BatchedResult(command, 'HTTP/1.1 200 OK', '', 0)
+            return BatchedResult(command, '', 'HTTP/1.1 502 Bad Gateway', 1)
+        if command.startswith('docker node ls'):
+            return BatchedResult(command, 'ID HOSTNAME STATUS AVAILABILITY MANAGER STATUS', '', 0)
+        if command.startswith('docker ps'):
+            lines = [f'{branch}:2000-01-01 00:00:00 +0000 UTC' for branch in self.get_branches(host)]
+            return BatchedResult(command, '\n'.join(lines), '', 0)
+        return BatchedResult(command, '', '', 0)
+
+    def get_branches(self, host):
+        return [f'{host.split(".")[0]}-branch-{idx}' for idx in range(self.branches_per_host)]
+
+    def get_branch_host(self, branch_slug):
+        return get_ring(self.hosts).get_node(branch_slug)
+
+    @contextmanager
+    def installed(self):
+        """
+        Replace the remote command function of the library with the fleet
+        """
+        originals = [module.run for module in PATCHED_MODULES]
+        for module in PATCHED_MODULES:
+            module.run = self.run
+        env.roledefs['fleet'] = self.hosts
+        try:
+            with settings(hide('everything'), abort_on_prompts=True):
+                yield self
+        finally:
+            for module, original in zip(PATCHED_MODULES, originals):
+                module.run = original
+            env.roledefs.pop('fleet', None)
+
+
+def check_health(url='http://localhost/health/'):
+    return healthcheck.run(f'curl -sSL -D - "{url}" -o /dev/null | head -n 1 | grep "200 OK"')
+
+
+def destroy_branch(branch_slug):
+    return healthcheck.run(f'docker stack rm {branch_slug}')
+
+
+def upload_release():
+    for command in ('mkdir -p /srv/app/releases/next', 'tar -xzf /tmp/release.tgz', 'pip install -r requirements.txt'):
+        healthcheck.run(command)
+
+
+def activate_release():
+    return healthcheck.run('ln -sfn /srv/app/releases/next /srv/app/current && systemctl restart app')
+
+
+def run_check_role_is_up(fleet):
+    up_hosts, _ = healthcheck.check_role_is_up(check_health, hosts=fleet.hosts)
+    return f'{sum(up_hosts.values())}/{len(up_hosts)} up'
+
+
+def run_wait_until_role_is_up(fleet):
+    try:
+        healthcheck.wait_until_role_is_up(check_health, poll_interval=1, max_wait=fleet.flap_period * 3,
+                                          check=healthcheck.quorum(0.95), task_kwargs={'hosts': fleet.hosts})
+    except SystemExit:
+        return 'timed out'
+    return 'quorum up'
+
+
+def run_select_manager(fleet):
+    # the cache would answer the following runs
+    swarm._managers_cache.clear()
+    try:
+        return swarm.docker_swarm_select_manager('fleet')
+    except SystemExit:
+        return 'no manager'
+
+
+def run_prune_stale_branches(fleet):
+    def get_stale_branches(days):
+        last_seen = cleanup.get_docker_branches_last_seen(project_label='project', project_name='app',
+                                                          branch_label='branch', hosts=fleet.hosts)
+        return cleanup.filter_stale_branches(last_seen, days)
+
+    def destroy_on_branch_host(branch_slug):
+        execute(destroy_branch, branch_slug, hosts=[fleet.get_branch_host(branch_slug)])
+
+    cleanup.prune_stale_branches(get_stale_branches, destroy_on_branch_host, protected_branches=[],
+                                 concurrency=min(32, len(fleet.hosts)), per_host_concurrency=2,
+                                 get_branch_host=fleet.get_branch_host)
+    return f'{len(fleet.hosts) * fleet.branches_per_host} branches'
+
+
+def run_parallel_deploy(fleet):
+    def deploy():
+        upload_release()
+        activate_release()
+
+    with settings(parallel=True):
+        execute(deploy, hosts=fleet.hosts)
+    return run_wait_until_role_is_up(fleet)
+
+
+def run_deploy_in_waves(fleet):
+    try:
+        results = waves.deploy_in_waves(upload_release, activate_release, check_health, hosts=fleet.hosts,
+                                        canary=1, growth=4, check=healthcheck.quorum(0.95),
+                                        max_wait=fleet.flap_period * 3, poll_interval=1)
+    except SystemExit:
+        return 'stopped'
+    return f'{sum(result.succeeded for result in results.values())}/{len(results)} up'
+
+
+SCENARIOS = OrderedDict([
+    ('check_role_is_up', run_check_role_is_up),
+    ('wait_until_role_is_up', run_wait_until_role_is_up),
+    ('docker_swarm_select_manager', run_select_manager),
+    ('prune_stale_branches', run_prune_stale_branches),
+    ('parallel_deploy', run_parallel_deploy),
+    ('deploy_in_waves', run_deploy_in_waves),
+])
+
+
+class ResourceSampler:
+    """
+    Sample the number of threads and child processes (and their total memory) of this process in background
+    """
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak_threads = 0
+        self.peak_children = 0
+        self.peak_children_memory = 0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._sample, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._stop.set()
+        self._thread.join()
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            # the sampler thread is not counted
+            self.peak_threads = max(self.peak_threads, threading.active_count() - 1)
+            children = list(iter_children(os.getpid()))
+            self.peak_children = max(self.peak_children, len(children))
+            children_memory = sum(get_memory(pid) for pid in children)
+            self.peak_children_memory = max(self.peak_children_memory, children_memory)
+
+
+def iter_children(parent_pid):
+    """
+    Yield pids of the child processes (linux /proc only)
+    """
+    try:
+        pids = [name for name in os.listdir('/proc') if name.isdigit()]
+    except OSError:
+        return
+    for pid in pids:
+        try:
+            with open(f'/proc/{pid}/stat') as stat_file:
+                # the process name may contain spaces, it's enclosed in parentheses
+                fields = stat_file.read().rsplit(')', 1)[1].split()
+        except (OSError, IndexError):
+            continue
+        if int(fields[1]) == parent_pid:
+            yield int(pid)
+
+
+def get_memory(pid):
+    """
+    Return proportional set size of the process (forked workers share most of their pages with the parent),
+    or its RSS if the kernel doesn't tell PSS
+    """
+    try:
+        with open(f'/proc/{pid}/smaps_rollup') as smaps_file:
+            for line in smaps_file:
+                if line.startswith('Pss:'):
+                    return int(line.split()[1]) * 1024
+    except (OSError, IndexError, ValueError):
+        pass
+    try:
+        with open(f'/proc/{pid}/statm') as statm_file:
+            return int(statm_file.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, IndexError, ValueError):
+        return 0
+
+
+def measure(scenario, fleet):
+    with fleet.installed(), ResourceSampler() as sampler:
+        started_at = time.perf_counter()
+        outcome = SCENARIOS[scenario](fleet)
+        wall_time = time.perf_counter() - started_at
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return OrderedDict([
+        ('scenario', scenario),
+        ('hosts', len(fleet.hosts)),
+        ('wall_time', wall_time),
+        # ru_maxrss is in kilobytes on linux
+        ('peak_rss_mb', usage.ru_maxrss / 1024),
+        ('peak_children_memory_mb', sampler.peak_children_memory / 1024 / 1024),
+        ('peak_children', sampler.peak_children),
+        ('peak_threads', sampler.peak_threads),
+        ('outcome', outcome),
+    ])
+
+
+def measure_in_subprocess(scenario, hosts_count, args):
+    command = [sys.executable, os.path.abspath(__file__), '--single', '--scenarios', scenario,
+               '--hosts', str(hosts_count), '--latency', str(args.latency), '--jitter', str(args.jitter),
+               '--failure-rate', str(args.failure_rate), '--flapping', str(args.flapping),
+               '--flap-period', str(args.flap_period)]
+    output = subprocess.run(command, stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+    # the result is the last line, anything the scenario prints goes before it
+    return json.loads(output.splitlines()[-1], object_pairs_hook=OrderedDict)
+
+
+def make_fleet(hosts_count, args):
+    return FakeFleet([f'host{idx:04d}.fleet' for idx in range(hosts_count)],
+                     latency=args.latency, jitter=args.jitter, failure_rate=args.failure_rate,
+                     flapping=args.flapping, flap_period=args.flap_period)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--hosts', type=int, nargs='+', default=[25, 50, 100, 200])
+    parser.add_argument('--latency', type=float, default=0.05)
+    parser.add_argument('--jitter', type=float, default=0.02)
+    parser.add_argument('--failure-rate', type=float, default=0.01)
+    parser.add_argument('--flapping', type=float, default=0.05, help='ratio of hosts with flapping health')
+    parser.add_argument('--flap-period', type=float, default=2)
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--json', metavar='FILE', help='save the results')
+    parser.add_argument('--single', action='store_true', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.single:
+        # a run of measure_in_subprocess
+        print(json.dumps(measure(args.scenarios[0], make_fleet(args.hosts[0], args))))
+        return
+
+    results = []
+    print(f'{"scenario":<28}{"hosts":>6}{"wall":>9}{"rss":>9}{"children pss":>14}{"procs":>7}{"threads":>9}  outcome')
+    for scenario in args.scenarios:
+        for hosts_count in args.hosts:
+            result = measure_in_subprocess(scenario, hosts_count, args)
+            results.append(result)
+            print(f'{scenario:<28}{hosts_count:>6}{result["wall_time"]:>8.2f}s{result["peak_rss_mb"]:>7.0f}MB'
+                  f'{result["peak_children_memory_mb"]:>12.0f}MB{result["peak_children"]:>7}{result["peak_threads"]:>9}'
+                  f'  {result["outcome"]}')
+
+    if args.json:
+        with open(args.json, 'w') as results_file:
+            json.dump(results, results_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Measure the import cost of the package modules (python -X importtime) and of the active branch lookup.
+
+    python benchmarks/import_bench.py [--repeat 5]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+MODULES = [
+    'fabric_utils',
+    'fabric_utils.git',
+    'fabric_utils.helpers',
+    'fabric_utils.healthcheck',
+    'fabric_utils.release',
+    'fabric_utils.cleanup',
+    'fabric_utils.swarm',
+    'fabric_utils.projects',
+]
+
+
+def get_import_time(module):
+    """
+    Return cumulative import time of the module (in seconds) as reported by -X importtime
+    """
+    output = subprocess.run([sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+                            cwd=ROOT, stderr=subprocess.PIPE, universal_newlines=True,
+                            env=dict(os.environ, PYTHONWARNINGS='ignore')).stderr
+    for line in output.splitlines():
+        # import time: self [us] | cumulative | imported package
+        fields = [field.strip() for field in line[len('import time:'):].split('|')]
+        if line.startswith('import time:') and len(fields) == 3 and fields[2] == module:
+            return int(fields[1]) / 1e6
+    raise RuntimeError(f'no import time reported for {module}')
+
+
+def timed(func, repeat):
+    timings = []
+    for _ in range(repeat):
+        started_at = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - started_at)
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    for module in MODULES:
+        import_time = statistics.median(get_import_time(module) for _ in range(args.repeat))
+        print(f'import {module:<28}{import_time * 1000:8.1f}ms')
+
+    # a fresh interpreter per run, as every fab invocation pays for the imports
+    resolvers = {
+        'branch from .git/HEAD': 'from fabric_utils.git import get_active_branch_name; get_active_branch_name()',
+        'branch with GitPython': 'from git import Repo; Repo(".").active_branch.name',
+    }
+    for name, code in resolvers.items():
+        def resolve_branch():
+            subprocess.run([sys.executable, '-c', code], cwd=ROOT, check=True)
+        try:
+            print(f'{name:<35}{timed(resolve_branch, args.repeat) * 1000:8.1f}ms')
+        except subprocess.CalledProcessError:
+            print(f'{name:<35}{"failed":>8}')
+
+
+if __name__ == '__main__':
+    main()
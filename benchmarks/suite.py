@@ -0,0 +1,201 @@
+"""
+Micro-benchmarks of the hot paths, run against fake command functions (no hosts are involved).
+
+    python benchmarks/suite.py [--repeat 5] [--only NAME ...]
+    python benchmarks/suite.py --save benchmarks/baseline.json
+    python benchmarks/suite.py --compare benchmarks/baseline.json [--threshold 1.25]
+
+Comparing exits with 1 if any benchmark is slower than the baseline by more than the threshold ratio.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from fabric.api import hide, settings  # noqa: E402
+from fabric.decorators import serial  # noqa: E402
+
+from fabric_utils import ci  # noqa: E402
+from fabric_utils.cleanup import get_stale_docker_branches  # noqa: E402
+from fabric_utils.git import branch_to_db, branch_to_domain, branch_to_slug, branch_to_url, get_branch_namer  # noqa
+from fabric_utils.healthcheck import check_role_is_up  # noqa: E402
+from fabric_utils.helpers import to_bool  # noqa: E402
+from fabric_utils.release import get_pending_release  # noqa: E402
+
+from fakes import FakeRunner  # noqa: E402
+
+DOMAIN_PATTERN = (r'^.*myb-?(\d+)$', r'myb\1')
+BENCHMARKS = OrderedDict()
+
+
+def benchmark(name, ops):
+    """
+    Register a benchmark setup returning the function to time (`ops` operations per call)
+    """
+    def decorator(setup):
+        BENCHMARKS[name] = (setup, ops)
+        return setup
+    return decorator
+
+
+@contextmanager
+def environ(**values):
+    saved = {name: os.environ.get(name) for name in values}
+    os.environ.update(values)
+    try:
+        yield
+    finally:
+        for name, value in saved.items():
+            if value is None:
+                os.environ.pop(name, None)
+            else:
+                os.environ[name] = value
+
+
+@benchmark('stale_docker_branches_10k', ops=10000)
+def stale_docker_branches():
+    now = datetime.now()
+    lines = [
+        f'branch-{idx % 2500}:{(now - timedelta(days=idx % 30)).strftime("%Y-%m-%d %H:%M:%S")} +0300 MSK'
+        for idx in range(10000)
+    ]
+    run = FakeRunner(('docker ps', '\n'.join(lines)))
+    return lambda: get_stale_docker_branches(run, days=7, project_label='project', project_name='app',
+                                             branch_label='branch')
+
+
+@benchmark('pending_release_5k_commits', ops=5000)
+def pending_release():
+    records = []
+    for idx in range(5000):
+        sha = f'{idx:040x}'
+        records.append(f'\x1e{sha}\x00Author {idx % 10}\x00author{idx % 10}@example.com\x00{1500000000 + idx}'
+                       f'\x00MYB-{idx} change something\n\n {idx % 7 + 1} files changed, {idx % 50} insertions(+), '
+                       f'{idx % 20} deletions(-)\n')
+    call = FakeRunner(('git', ''.join(records)))
+
+    def release():
+        # a TeamCity build of the last commit, the environment of the other benchmarks is left alone
+        with environ(BUILD_VCS_NUMBER=f'{4999:040x}'):
+            return get_pending_release(call, 'origin/master', 'origin/production')
+    return release
+
+
+@benchmark('branch_to_names_10k', ops=10000)
+def branch_to_names():
+    branches = [f'feature/some-stuff-{idx}' if idx % 2 else f'bugfix/MYB-{idx}' for idx in range(2000)]
+
+    def convert():
+        get_branch_namer.cache_clear()
+        for idx in range(10000):
+            branch = branches[idx % len(branches)]
+            branch_to_domain(branch, domain_pattern=DOMAIN_PATTERN)
+            branch_to_slug(branch, domain_pattern=DOMAIN_PATTERN)
+            branch_to_db(branch, domain_pattern=DOMAIN_PATTERN)
+            branch_to_url('example.com', branch, domain_pattern=DOMAIN_PATTERN)
+    return convert
+
+
+@benchmark('check_role_is_up_500_hosts', ops=500)
+def role_is_up():
+    hosts = [f'app{idx}.example.com' for idx in range(500)]
+    run = FakeRunner(('curl', 'HTTP/1.1 200 OK'))
+
+    # serial, so that no workers are forked and the fake results are aggregated in process
+    @serial
+    def check():
+        return run('curl -sSL -D - http://localhost/health/')
+
+    def aggregate():
+        with settings(hide('everything')):
+            return check_role_is_up(check, hosts=hosts)
+    return aggregate
+
+
+@benchmark('teamcity_emission_10k', ops=10000)
+def teamcity_emission():
+    def emit():
+        reporter = ci.TeamCityReporter(io.StringIO(), enabled=True)
+        for idx in range(2500):
+            reporter.emit('testStarted', f'Destroy branch-{idx}', flow_id=f'branch-{idx}')
+            reporter.emit('testFailed', f'Destroy branch-{idx}', "Exception: it's [broken]|", flow_id=f'branch-{idx}')
+            reporter.emit('testFinished', f'Destroy branch-{idx}', flow_id=f'branch-{idx}')
+            reporter.emit('buildStatisticValue', f'cleanup.branch-{idx}', idx)
+        reporter.flush()
+    return emit
+
+
+@benchmark('to_bool_100k', ops=100000)
+def to_bool_values():
+    values = ['yes', 'No', 'TRUE', '0', 1, False, 't', 'off'] * 12500
+    return lambda: [to_bool(value) for value in values]
+
+
+def run_benchmarks(names, repeat):
+    results = OrderedDict()
+    for name in names:
+        setup, ops = BENCHMARKS[name]
+        func = setup()
+        func()  # warm up
+        timings = []
+        for _ in range(repeat):
+            started_at = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - started_at)
+        seconds = statistics.median(timings)
+        results[name] = {'seconds': seconds, 'min_seconds': min(timings), 'ops': ops, 'ops_per_second': ops / seconds}
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--only', nargs='+', choices=list(BENCHMARKS), default=list(BENCHMARKS))
+    parser.add_argument('--save', metavar='FILE', help='save the results as a baseline')
+    parser.add_argument('--compare', metavar='FILE', help='compare the results with a baseline')
+    parser.add_argument('--threshold', type=float, default=1.25, help='slowdown ratio reported as a regression')
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.only, args.repeat)
+    baseline = {}
+    if args.compare:
+        with open(args.compare) as baseline_file:
+            baseline = json.load(baseline_file)['results']
+
+    regressions = []
+    for name, result in results.items():
+        line = f'{name:<30}{result["seconds"] * 1000:10.2f}ms {result["ops_per_second"]:14,.0f} ops/s'
+        if name in baseline:
+            # the fastest runs are compared, as they are the least affected by the machine noise
+            ratio = result['min_seconds'] / baseline[name]['min_seconds']
+            line += f' {ratio:6.2f}x baseline'
+            if ratio > args.threshold:
+                regressions.append(name)
+                line += ' REGRESSION'
+        print(line)
+
+    if args.save:
+        with open(args.save, 'w') as baseline_file:
+            json.dump({
+                'created_at': datetime.now().isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'repeat': args.repeat,
+                'results': results,
+            }, baseline_file, indent=2)
+            baseline_file.write('\n')
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,2 +1,39 @@
 # flake8: noqa
+import importlib
+
 __version__ = '0.1.0'
+
+# submodules are imported on first access (fabric_utils.release etc), so a fabfile pays only for what it uses
+_SUBMODULES = {
+    'batch',
+    'ci',
+    'cleanup',
+    'connections',
+    'git',
+    'healthcheck',
+    'helpers',
+    'history',
+    'lease',
+    'manifest',
+    'notifications',
+    'placement',
+    'probes',
+    'profiling',
+    'projects',
+    'release',
+    'sentry',
+    'steps',
+    'swarm',
+    'tasks',
+    'waves',
+}
+
+
+def __getattr__(name):
+    if name in _SUBMODULES:
+        return importlib.import_module(f'{__name__}.{name}')
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+def __dir__():
+    return sorted(set(globals()) | _SUBMODULES)
@@ -0,0 +1,154 @@
+"""
+Batched remote commands.
+
+Independent commands are queued and sent to the host as a single script,
+so that a dozen lookups (readlink, --version, checksums) cost one round-trip instead of a dozen:
+
+    with CommandBatch() as batch:
+        current = batch.add('readlink /srv/app/current')
+        version = batch.add('python3 --version')
+    current.result(), version.result()
+
+Every command runs in a subshell with its stdout and stderr captured separately,
+the output is framed with a random boundary, so that it is told apart from anything else printed on login.
+"""
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional, Tuple
+from uuid import uuid4
+
+from fabric.api import quiet
+
+from .profiling import sudo
+
+if TYPE_CHECKING:
+    from concurrent.futures import Future
+
+
+__all__ = [
+    'BatchedResult',
+    'CommandBatch',
+    'run_batch',
+]
+
+
+class BatchedResult(str):
+    """
+    Stdout of a batched command, quacks like a fabric command result
+    (`stdout`, `stderr`, `return_code`, `succeeded`, `failed`)
+    """
+
+    def __new__(cls, command: str, stdout: str, stderr: str, return_code: Optional[int]) -> 'BatchedResult':
+        result = super().__new__(cls, stdout)
+        result.command = command
+        result.stdout = stdout
+        result.stderr = stderr
+        result.return_code = return_code
+        return result
+
+    def __getnewargs__(self) -> Tuple[str, str, str, Optional[int]]:
+        # results are pickled on their way back from fabric parallel workers
+        return self.command, self.stdout, self.stderr, self.return_code
+
+    @property
+    def succeeded(self) -> bool:
+        return self.return_code == 0
+
+    @property
+    def failed(self) -> bool:
+        return not self.succeeded
+
+
+def _frame_command(boundary: str, idx: int, command: str) -> str:
+    # awk prints every line with a newline, even the last one that had none
+    return (f'( {command}\n) >"$__batch/out" 2>"$__batch/err" </dev/null; __status=$?; '
+            f'awk \'{{print "{boundary}:{idx}:o:" $0}}\' "$__batch/out"; '
+            f'awk \'{{print "{boundary}:{idx}:e:" $0}}\' "$__batch/err"; '
+            f'echo "{boundary}:{idx}:rc:$__status"')
+
+
+def build_batch_script(commands: List[str], boundary: str) -> str:
+    lines = ['__batch=$(mktemp -d)']
+    lines += [_frame_command(boundary, idx, command) for idx, command in enumerate(commands)]
+    lines.append('rm -rf "$__batch"')
+    return '\n'.join(lines)
+
+
+def parse_batch_output(output: str, commands: List[str], boundary: str) -> List[BatchedResult]:
+    """
+    Return results in order of the commands (a command that has not reported its exit code has None)
+    """
+    frames = {}  # type: Dict[int, Tuple[List[str], List[str], List[Optional[int]]]]
+    prefix = f'{boundary}:'
+    for line in output.splitlines():
+        # lines end with \r\n when a pty is used
+        line = line.rstrip('\r')
+        if not line.startswith(prefix):
+            continue
+        idx, kind, value = line[len(prefix):].split(':', 2)
+        out_lines, err_lines, return_code = frames.setdefault(int(idx), ([], [], [None]))
+        if kind == 'o':
+            out_lines.append(value)
+        elif kind == 'e':
+            err_lines.append(value)
+        elif kind == 'rc' and value.isdigit():
+            return_code[0] = int(value)
+
+    results = []
+    for idx, command in enumerate(commands):
+        out_lines, err_lines, return_code = frames.get(idx, ([], [], [None]))
+        results.append(BatchedResult(command, '\n'.join(out_lines), '\n'.join(err_lines), return_code[0]))
+    return results
+
+
+class CommandBatch:
+    """
+    Queue of independent commands run on the current host with a single call (sudo by default).
+    The batch is run when the block is done, or on run().
+    """
+
+    def __init__(self, call: Optional[Callable] = None) -> None:
+        self.call = call or sudo
+        self._queue = []  # type: List[Tuple[str, Future]]
+
+    def add(self, command: str) -> 'Future':
+        from concurrent.futures import Future
+        future = Future()  # type: Future
+        self._queue.append((command, future))
+        return future
+
+    def __len__(self) -> int:
+        return len(self._queue)
+
+    def run(self) -> List[BatchedResult]:
+        """
+        Run the queued commands and return their results in order they were queued
+        """
+        queue, self._queue = self._queue, []
+        if not queue:
+            return []
+        commands = [command for command, _ in queue]
+        boundary = uuid4().hex
+        try:
+            with quiet():
+                output = self.call(build_batch_script(commands, boundary))
+        except BaseException as exc:
+            for _, future in queue:
+                future.set_exception(exc)
+            raise
+        results = parse_batch_output(str(output), commands, boundary)
+        for (_, future), result in zip(queue, results):
+            future.set_result(result)
+        return results
+
+    def __enter__(self) -> 'CommandBatch':
+        return self
+
+    def __exit__(self, exc_type: Any, *exc_info: Any) -> None:
+        if exc_type is None:
+            self.run()
+
+
+def run_batch(*commands: str, call: Optional[Callable] = None) -> List[BatchedResult]:
+    batch = CommandBatch(call)
+    for command in commands:
+        batch.add(command)
+    return batch.run()
@@ -1,44 +1,187 @@
+import atexit
 import os
+import sys
+import threading
+import weakref
 from functools import wraps
+from typing import Any, IO, List, Optional
 
-from fabric.api import settings, warn
+from fabric.api import settings, warn, env
+
+
+__all__ = [
+    'TeamCityReporter',
+    'get_teamcity_reporter',
+    'teamcity',
+    'with_teamcity',
+]
+
+
+# message name -> names of its positional attributes (None for single value messages)
+TEAMCITY_MESSAGES = {
+    'testSuiteStarted': ('name',),
+    'testSuiteFinished': ('name',),
+    'testStarted': ('name',),
+    'testFailed': ('name', 'message'),
+    'testFinished': ('name',),
+    'testIgnored': ('name', 'message'),
+    'testStdOut': ('name', 'out'),
+    'testStdErr': ('name', 'out'),
+    'blockOpened': ('name',),
+    'blockClosed': ('name',),
+    'message': ('text', 'status'),
+    'buildStatus': ('text',),
+    'buildProblem': ('description',),
+    'buildStatisticValue': ('key', 'value'),
+    'setParameter': ('name', 'value'),
+    'progressMessage': None,
+    'progressStart': None,
+    'progressFinish': None,
+    'buildNumber': None,
+    'publishArtifacts': None,
+}
+
+# messages TeamCity times by their arrival
+UNBUFFERED_MESSAGES = {'testSuiteStarted', 'testStarted', 'blockOpened', 'progressStart'}
+
+TEAMCITY_ESCAPES = str.maketrans({
+    '|': '||',
+    "'": "|'",
+    '\n': '|n',
+    '\r': '|r',
+    '[': '|[',
+    ']': '|]',
+    '\u0085': '|x',
+    '\u2028': '|l',
+    '\u2029': '|p',
+})
+
+
+def escape_teamcity_value(value: Any) -> str:
+    return str(value).translate(TEAMCITY_ESCAPES)
+
+
+class TeamCityReporter:
+    """
+    TeamCity service messages writer.
+
+    Messages are buffered and written in batches with a single write under a lock,
+    so that messages of concurrent workers are never interleaved mid-line.
+    The buffer is flushed when it's full, on flush(), before a fork and at exit.
+    The start of a test, a block or a progress is written right away, as TeamCity times it by its arrival,
+    and forked processes (e.g. fabric parallel tasks, which exit without running atexit handlers) buffer nothing.
+    Messages sharing a `flow_id` are grouped by TeamCity into the same flow,
+    which keeps the test tree intact when tests run concurrently.
+    """
+
+    def __init__(self, stream: Optional[IO[str]] = None, enabled: Optional[bool] = None,
+                 batch_size: int = 50) -> None:
+        self.stream = stream
+        self.enabled = bool(os.environ.get('TEAMCITY_VERSION')) if enabled is None else enabled
+        self.batch_size = batch_size
+        self._buffer = []  # type: List[str]
+        self._lock = threading.Lock()
+        self._pid = self._owner_pid = os.getpid()
+        _reporters.add(self)
+
+    @staticmethod
+    def format(message_name: str, *params: Any, flow_id: Optional[str] = None, **attributes: Any) -> str:
+        attribute_names = TEAMCITY_MESSAGES[message_name]
+        if attribute_names is None:
+            value, = params
+            return f"##teamcity[{message_name} '{escape_teamcity_value(value)}']"
+        message_attributes = dict(zip(attribute_names, params))
+        message_attributes.update(attributes)
+        if flow_id is not None:
+            message_attributes['flowId'] = flow_id
+        formatted_attributes = ' '.join(f"{name}='{escape_teamcity_value(value)}'"
+                                        for name, value in message_attributes.items() if value is not None)
+        return f'##teamcity[{message_name} {formatted_attributes}]'
+
+    def emit(self, message_name: str, *params: Any, force: bool = False,
+             flow_id: Optional[str] = None, **attributes: Any) -> None:
+        if not (self.enabled or force):
+            return
+        if message_name not in TEAMCITY_MESSAGES:
+            warn(f'teamcity message {message_name} not supported')
+            return
+        line = self.format(message_name, *params, flow_id=flow_id, **attributes)
+        with self._lock:
+            if self._pid != os.getpid():
+                # the messages buffered by the parent process are written by the parent
+                self._buffer, self._pid = [], os.getpid()
+            self._buffer.append(line)
+            if (len(self._buffer) >= self.batch_size or message_name in UNBUFFERED_MESSAGES
+                    or self._pid != self._owner_pid):
+                self._write()
+
+    def flush(self) -> None:
+        with self._lock:
+            if self._pid != os.getpid():
+                self._buffer, self._pid = [], os.getpid()
+            self._write()
+
+    def _reset(self) -> None:
+        self._buffer, self._pid = [], os.getpid()
+        self._lock = threading.Lock()
+
+    def _write(self) -> None:
+        if not self._buffer:
+            return
+        lines, self._buffer = self._buffer, []
+        stream = self.stream or sys.stdout
+        stream.write('\n'.join(lines) + '\n')
+        stream.flush()
+
+
+# the hooks are registered once for all reporters, the reporters that are gone are skipped
+_reporters = weakref.WeakSet()  # type: weakref.WeakSet
+
+
+def _flush_reporters() -> None:
+    for reporter in list(_reporters):
+        reporter.flush()
+
+
+def _reset_reporters() -> None:
+    for reporter in list(_reporters):
+        reporter._reset()
+
+
+atexit.register(_flush_reporters)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(before=_flush_reporters, after_in_child=_reset_reporters)
+
+
+_reporter = None  # type: Optional[TeamCityReporter]
+
+
+def get_teamcity_reporter() -> TeamCityReporter:
+    global _reporter
+    if _reporter is None:
+        _reporter = TeamCityReporter()
+    return _reporter
 
 
 def teamcity(message_name, *params, **kwargs):
-    force = kwargs.get('force') or False
-    messages = {
-        'testSuiteStarted': "testSuiteStarted name='%s'",
-        'testSuiteFinished': "testSuiteFinished name='%s'",
-        'buildStatus': "buildStatus text='%s'",
-        'testStarted': "testStarted name='%s'",
-        'testFailed': "testFailed name='%s' message='%s'",
-        'testFinished': "testFinished name='%s'",
-        'setParameter': "setParameter name='%s' value='%s'",
-    }
-
-    is_teamcity_mode = os.environ.get('TEAMCITY_VERSION') or force
-    if not is_teamcity_mode:
-        return
-
-    message_tpl = messages.get(message_name)
-    if not message_tpl:
-        warn(f'teamcity message {message_name} not supported')
-        return
-
-    message = message_tpl % params
-    print(f"##teamcity[{message}]")  # noqa
+    get_teamcity_reporter().emit(message_name, *params, **kwargs)
 
 
 def with_teamcity(task):
     @wraps(task)
     def wrapper(*args, **kwargs):
-        teamcity('testStarted', task.__name__)
+        reporter = get_teamcity_reporter()
+        # tasks run on several hosts at once are reported in separate flows
+        flow_id = env.host_string or None
+        reporter.emit('testStarted', task.__name__, flow_id=flow_id)
+        reporter.flush()
         try:
             with settings(abort_exception=Exception):
                 return task(*args, **kwargs)
         except Exception as exc:
-            teamcity('testFailed', task.__name__, f'Exception: {type(exc).__name__}')
+            reporter.emit('testFailed', task.__name__, f'Exception: {type(exc).__name__}', flow_id=flow_id)
             raise
         finally:
-            teamcity('testFinished', task.__name__)
+            reporter.emit('testFinished', task.__name__, flow_id=flow_id)
+            reporter.flush()
     return wrapper
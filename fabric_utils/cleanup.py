@@ -1,42 +1,114 @@
-from datetime import datetime, timedelta
-from typing import Callable, Optional, Any, List, Set, Tuple, Dict
+import multiprocessing
+import queue
+from collections import Counter, deque
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache, partial
+from time import perf_counter
+from typing import Callable, Optional, Any, List, Set, Tuple, Dict, Iterator, Iterable
 
-from fabric.api import puts, task, settings, execute
+from fabric.api import puts, task, settings, execute, quiet
 from fabric.colors import green as g, yellow as y
+from fabric.state import connections
 
-from .ci import teamcity
-from .helpers import to_bool
+from .ci import get_teamcity_reporter
+from .helpers import to_bool, is_parallel_supported
+from .profiling import run, profiled, span, timed
+
+
+DOCKER_PS_BRANCHES_CMD = ("docker ps "
+                          "--format '{{ .Label \"%(branch_label)s\" }}:{{ .CreatedAt }}' "
+                          "--filter 'label=%(project_label)s=%(project_name)s'")
 
 
 @task
 def get_stale_docker_branches(run: Callable, *, days: int,
                               project_label: str, project_name: str, branch_label: str) -> Set[str]:
-    cmd = ("docker ps "
-           "--format '{{ .Label \"%(branch_label)s\" }}:{{ .CreatedAt }}' "
-           "--filter 'label=%(project_label)s=%(project_name)s'")
-    result = run(cmd % {'branch_label': branch_label,
-                        'project_label': project_label,
-                        'project_name': project_name})
-    stale_branches = set()
-    least_recent_date = (datetime.today() - timedelta(days=days)).date()
+    result = profiled(run)(DOCKER_PS_BRANCHES_CMD % {'branch_label': branch_label,
+                                                     'project_label': project_label,
+                                                     'project_name': project_name})
+    return filter_stale_branches(parse_docker_branches(result.splitlines()), days=days)
+
+
+def get_docker_branches_last_seen(*, project_label: str, project_name: str, branch_label: str,
+                                  **execute_kwargs: Any) -> Dict[str, datetime]:
+    """
+    Return the most recent container creation date of every branch across the hosts (given as hosts/roles).
+    The hosts are checked in parallel, each one reporting back its own compact branch -> date mapping.
+    """
+    command = DOCKER_PS_BRANCHES_CMD % {'branch_label': branch_label,
+                                        'project_label': project_label,
+                                        'project_name': project_name}
+    with settings(parallel=is_parallel_supported()):
+        results = execute(_get_host_docker_branches, command, **execute_kwargs)
 
-    for line in result.split('\n'):
+    last_seen = {}  # type: Dict[str, datetime]
+    for host_last_seen in results.values():
+        for branch_slug, created_at in (host_last_seen or {}).items():
+            if branch_slug not in last_seen or created_at > last_seen[branch_slug]:
+                last_seen[branch_slug] = created_at
+    return last_seen
+
+
+def _get_host_docker_branches(command: str) -> Dict[str, datetime]:
+    with quiet():
+        result = run(command)
+    if result.failed:
+        # a host that failed may be running any branch, so it's better not to guess
+        raise Exception(f'failed to list containers: {result}')
+    return parse_docker_branches(result.splitlines())
+
+
+def parse_docker_branches(lines: Iterable[str]) -> Dict[str, datetime]:
+    """
+    Parse "branch:created at" lines into the most recent creation date of every branch
+    """
+    last_seen = {}  # type: Dict[str, datetime]
+    for line in lines:
         line = line.strip()
         if not line:
             continue
 
-        branch_slug, timestamp = line.split(':', 1)
+        branch_slug, _, timestamp = line.partition(':')
         if not branch_slug:
             continue
 
-        branch_deploy_date = datetime.strptime(timestamp[:10], '%Y-%m-%d').date()
-        if branch_deploy_date <= least_recent_date:
-            stale_branches.add(branch_slug)
+        created_at = parse_docker_timestamp(timestamp)
+        if branch_slug not in last_seen or created_at > last_seen[branch_slug]:
+            last_seen[branch_slug] = created_at
+    return last_seen
 
-    return stale_branches
+
+def parse_docker_timestamp(timestamp: str) -> datetime:
+    """
+    Parse docker timestamps, e.g. 2019-05-10 12:34:56 +0300 MSK
+    """
+    return datetime(int(timestamp[0:4]), int(timestamp[5:7]), int(timestamp[8:10]),
+                    int(timestamp[11:13]), int(timestamp[14:16]), int(timestamp[17:19]),
+                    tzinfo=_get_timezone(timestamp[20:25]))
+
+
+@lru_cache(maxsize=None)
+def _get_timezone(offset: str) -> timezone:
+    if len(offset) != 5:
+        return timezone.utc
+    sign = -1 if offset[0] == '-' else 1
+    return timezone(sign * timedelta(hours=int(offset[1:3]), minutes=int(offset[3:5])))
+
+
+def filter_stale_branches(last_seen: Dict[str, datetime], days: int) -> Set[str]:
+    """
+    Return branches that were last deployed this or greater days ago
+    """
+    least_recent_date = (datetime.today() - timedelta(days=days)).date()
+    return {
+        branch_slug
+        for branch_slug, created_at in last_seen.items()
+        if created_at.date() <= least_recent_date
+    }
 
 
 @task
+@timed
 def prune_stale_branches(get_stale_branches: Callable,
                          destroy_branch: Callable,
                          protected_branches: List[str],
@@ -44,10 +116,17 @@ def prune_stale_branches(get_stale_branches: Callable,
                          dry_run: bool = False,
                          task_args: Optional[Tuple] = None,
                          task_kwargs: Optional[Dict] = None,
+                         concurrency: int = 1,
+                         per_host_concurrency: Optional[int] = None,
+                         get_branch_host: Optional[Callable] = None,
                          **kwargs: Any) -> None:
     """
     Destroy all branch instances that were last deployed this or greater days ago.
     Although demo and master should be kept protected from this deadly action.
+
+    :param concurrency: number of branches destroyed at once (1 destroys them one by one)
+    :param per_host_concurrency: limit of branches destroyed at once on the same host
+    :param get_branch_host: a callable returning the host the branch is destroyed on
     """
     task_args = task_args or ()
     task_kwargs = task_kwargs or {}
@@ -62,34 +141,143 @@ def prune_stale_branches(get_stale_branches: Callable,
     else:
         puts(y(f'WILL destroy {len(stale_branch_slugs)} instances'))
 
-    total_count = 0
-    failure_count = 0
-
-    teamcity('testSuiteStarted', 'cleanup', force=inside_teamcity)
-
+    branch_slugs = []
     for branch_slug in stale_branch_slugs:
         # protect essential branches
         if branch_slug in protected_branches:
             puts(f'wont remove protected branch {branch_slug}')
             continue
+        branch_slugs.append(branch_slug)
 
-        puts(f'removing branch {branch_slug}')
-        test_name = f'Destroy {branch_slug}'
-        total_count += 1
-        teamcity('testStarted', test_name, force=inside_teamcity)
-        try:
+    total_count = len(branch_slugs)
+    failure_count = 0
+
+    reporter = get_teamcity_reporter()
+    teamcity = partial(reporter.emit, force=inside_teamcity)
+    teamcity('testSuiteStarted', 'cleanup')
+
+    concurrency = int(concurrency)
+    if dry_run or concurrency <= 1 or not is_parallel_supported():
+        for branch_slug in branch_slugs:
+            test_name = f'Destroy {branch_slug}'
+            teamcity('testStarted', test_name)
+            reporter.flush()
+            started_at = perf_counter()
             with settings(abort_exception=Exception):
-                if not dry_run:
-                    execute(destroy_branch, branch_slug, *task_args, **task_kwargs)
-                    puts(y(f'destroyed branch {branch_slug}'))
-                else:
-                    puts(g(f'would destroy branch {branch_slug}'))
-        except Exception as exc:
-            puts(f'failed to remove branch {branch_slug} due to {exc}')
-            teamcity('testFailed', test_name, f'Exception: {type(exc).__name__}', force=inside_teamcity)
-            failure_count += 1
-        finally:
-            teamcity('testFinished', test_name, force=inside_teamcity)
-
-    teamcity('testSuiteFinished', 'cleanup', force=inside_teamcity)
-    teamcity('buildStatus', f'Branches destroyed: {total_count}, failures: {failure_count}', force=inside_teamcity)
+                error = _destroy_stale_branch(branch_slug, destroy_branch, dry_run, task_args, task_kwargs)
+            if error:
+                teamcity('testFailed', test_name, f'Exception: {error}')
+                failure_count += 1
+            teamcity('testFinished', test_name, duration=_to_milliseconds(perf_counter() - started_at))
+    else:
+        puts(f'destroying branches with {concurrency} workers')
+        per_host_concurrency = int(per_host_concurrency) if per_host_concurrency else None
+        # messages are reported once a branch is done, so that the tree stays intact
+        # even when the branches are destroyed out of order, along with the duration measured by the worker
+        for branch_slug, error, duration in _destroy_stale_branches_in_pool(branch_slugs, destroy_branch,
+                                                                   task_args, task_kwargs,
+                                                                   concurrency=concurrency,
+                                                                   per_host_concurrency=per_host_concurrency,
+                                                                   get_branch_host=get_branch_host):
+            test_name = f'Destroy {branch_slug}'
+            # a flow per branch keeps the tests apart should the messages of branches ever mix
+            teamcity('testStarted', test_name, flow_id=branch_slug)
+            if error:
+                teamcity('testFailed', test_name, f'Exception: {error}', flow_id=branch_slug)
+                failure_count += 1
+            teamcity('testFinished', test_name, flow_id=branch_slug, duration=_to_milliseconds(duration))
+
+    teamcity('testSuiteFinished', 'cleanup')
+    teamcity('buildStatisticValue', 'cleanup.branches.destroyed', total_count - failure_count)
+    teamcity('buildStatisticValue', 'cleanup.branches.failed', failure_count)
+    teamcity('buildStatus', f'Branches destroyed: {total_count}, failures: {failure_count}')
+    reporter.flush()
+
+
+def _to_milliseconds(seconds: float) -> int:
+    return int(seconds * 1000)
+
+
+def _destroy_stale_branch(branch_slug: str, destroy_branch: Callable, dry_run: bool,
+                          task_args: Tuple, task_kwargs: Dict) -> Optional[str]:
+    """
+    Destroy a single branch and return the failure exception name (if any)
+    """
+    puts(f'removing branch {branch_slug}')
+    try:
+        if not dry_run:
+            with span(f'destroy {branch_slug}'):
+                execute(destroy_branch, branch_slug, *task_args, **task_kwargs)
+            puts(y(f'destroyed branch {branch_slug}'))
+        else:
+            puts(g(f'would destroy branch {branch_slug}'))
+    except Exception as exc:
+        puts(f'failed to remove branch {branch_slug} due to {exc}')
+        return type(exc).__name__
+    return None
+
+
+def _destroy_stale_branches_in_pool(branch_slugs: List[str], destroy_branch: Callable,
+                                    task_args: Tuple, task_kwargs: Dict, *,
+                                    concurrency: int,
+                                    per_host_concurrency: Optional[int] = None,
+                                    get_branch_host: Optional[Callable] = None
+                                    ) -> Iterator[Tuple[str, Optional[str], float]]:
+    """
+    Destroy branches in forked workers (same as fabric does for parallel tasks)
+    yielding (branch slug, failure, seconds taken) in the order the branches are done.
+
+    No more than `concurrency` branches are destroyed at once,
+    and no more than `per_host_concurrency` for a host returned by `get_branch_host`.
+    """
+    mp = multiprocessing.get_context('fork')
+    results = mp.Queue()
+    pending = deque(branch_slugs)
+    running = {}  # type: Dict[str, Tuple[Any, Optional[str], float]]
+    host_load = Counter()  # type: Counter
+
+    def get_host(branch_slug: str) -> Optional[str]:
+        return get_branch_host(branch_slug) if get_branch_host else None
+
+    def has_capacity(host: Optional[str]) -> bool:
+        return not (host and per_host_concurrency and host_load[host] >= per_host_concurrency)
+
+    def worker(branch_slug: str) -> None:
+        # child processes must not share the parent's ssh connections
+        connections.clear()
+        started_at = perf_counter()
+        with settings(abort_exception=Exception, parallel=True, linewise=True):
+            error = _destroy_stale_branch(branch_slug, destroy_branch, False, task_args, task_kwargs)
+        results.put((branch_slug, error, perf_counter() - started_at))
+
+    while pending or running:
+        # spawn workers for as many branches as the limits allow
+        for branch_slug in list(pending):
+            if len(running) >= concurrency:
+                break
+            host = get_host(branch_slug)
+            if not has_capacity(host):
+                continue
+            pending.remove(branch_slug)
+            process = mp.Process(target=worker, args=(branch_slug,))
+            process.start()
+            running[branch_slug] = (process, host, perf_counter())
+            if host:
+                host_load[host] += 1
+
+        try:
+            done = [results.get(timeout=1)]
+        except queue.Empty:
+            # a worker may have died without reporting back
+            done = [(branch_slug, 'WorkerDied', perf_counter() - started_at)
+                    for branch_slug, (process, _, started_at) in running.items()
+                    if not process.is_alive() and process.exitcode != 0]
+
+        for branch_slug, error, duration in done:
+            if branch_slug not in running:
+                continue
+            process, host, _ = running.pop(branch_slug)
+            process.join()
+            if host:
+                host_load[host] -= 1
+            yield branch_slug, error, duration
@@ -0,0 +1,213 @@
+"""
+Pooled ssh connections for the whole run.
+
+The pool is installed explicitly in the fabfile, for the deploy tasks that should share the connections:
+
+    with connection_pool(max_connections_per_host=1):
+        execute(deploy, hosts=hosts)
+
+The connections are closed and their stats reported once the block is done.
+"""
+from collections import Counter
+from contextlib import contextmanager
+from time import monotonic
+from typing import Dict, Iterator, Optional
+
+from fabric import state
+from fabric.api import puts
+from fabric.network import HostConnectionCache, normalize, normalize_to_string
+
+
+__all__ = [
+    'ConnectionPool',
+    'connection_pool',
+    'get_connection_stats',
+    'install_connection_pool',
+    'report_connection_stats',
+]
+
+
+class ConnectionPool(HostConnectionCache):
+    """
+    Fabric connection cache keeping ssh connections open across tasks for the whole run.
+
+    On top of fabric's own cache the pool
+    * closes connections that have been idle for longer than `idle_timeout` seconds
+    * keeps no more than `max_connections_per_host` connections to a host
+      (fabric opens a connection per user@host:port)
+    * reconnects when a cached connection is no longer active
+    * counts connections opened, reused, reconnected and evicted
+
+    Connections are evicted when a new one is opened (or on evict()), never on lookup,
+    as fabric looks connections up by key to close them (see fabric.network.disconnect_all).
+    disconnect_all() closes the connections without looking them up.
+    """
+    idle_timeout = 300
+    max_connections_per_host = 2
+
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.reset()
+
+    def reset(self) -> None:
+        now = monotonic()
+        self.last_used = {key: now for key in dict.keys(self)}  # type: Dict[str, float]
+        self.stats = Counter()  # type: Counter
+
+    def setup(self, idle_timeout: Optional[float] = None, max_connections_per_host: Optional[int] = None) -> None:
+        if idle_timeout is not None:
+            self.idle_timeout = idle_timeout
+        if max_connections_per_host is not None:
+            self.max_connections_per_host = max_connections_per_host
+
+    def connect(self, key):
+        key = normalize_to_string(key)
+        if dict.__contains__(self, key):
+            self.close(key)
+        self.evict(keep=key)
+        self.stats['opened'] += 1
+        super().connect(key)
+        self.last_used[key] = monotonic()
+
+    def __getitem__(self, key):
+        key = normalize_to_string(key)
+        if dict.__contains__(self, key):
+            if _is_active(dict.__getitem__(self, key)):
+                self.stats['reused'] += 1
+            else:
+                self.stats['reconnected'] += 1
+                self.close(key)
+
+        client = super().__getitem__(key)
+        self.last_used[key] = monotonic()
+        return client
+
+    def keys(self):
+        """
+        Keys of the live connections, the dead ones are dropped,
+        so that fabric closing the listed connections never reconnects them
+        """
+        for key, client in list(dict.items(self)):
+            if not _is_active(client):
+                self.close(key)
+        return dict.keys(self)
+
+    def __delitem__(self, key):
+        key = normalize_to_string(key)
+        self.last_used.pop(key, None)
+        return super().__delitem__(key)
+
+    def clear(self):
+        self.last_used.clear()
+        return super().clear()
+
+    def disconnect_all(self) -> None:
+        """
+        Close all the connections
+        """
+        for key in list(dict.keys(self)):
+            self.close(key)
+
+    def close(self, key: str) -> None:
+        try:
+            dict.__getitem__(self, key).close()
+        finally:
+            del self[key]
+
+    def evict(self, keep: Optional[str] = None) -> None:
+        """
+        Close idle connections, and the least recently used connections to the host of `keep`
+        so that a new connection to it does not exceed the per host limit
+        """
+        self.evict_idle(keep)
+        if keep is not None:
+            self.evict_host_overflow(keep)
+
+    def evict_idle(self, keep: Optional[str] = None) -> None:
+        """
+        Close connections that have not been used for `idle_timeout` seconds
+        """
+        idle_since = monotonic() - self.idle_timeout
+        for key, used_at in list(self.last_used.items()):
+            if key != keep and used_at < idle_since and dict.__contains__(self, key):
+                self.stats['evicted'] += 1
+                self.close(key)
+
+    def evict_host_overflow(self, key: str) -> None:
+        """
+        Close the least recently used connections to the host of the key
+        so that a new connection does not exceed the per host limit
+        """
+        host = normalize(key)[1]
+        host_keys = sorted(
+            (used_at, other_key)
+            for other_key, used_at in self.last_used.items()
+            if other_key != key and normalize(other_key)[1] == host and dict.__contains__(self, other_key)
+        )
+        while host_keys and len(host_keys) >= self.max_connections_per_host:
+            _, other_key = host_keys.pop(0)
+            self.stats['evicted'] += 1
+            self.close(other_key)
+
+
+def _is_active(client) -> bool:
+    transport = client.get_transport()
+    return bool(transport and transport.is_active())
+
+
+def install_connection_pool(idle_timeout: Optional[float] = None,
+                            max_connections_per_host: Optional[int] = None) -> ConnectionPool:
+    """
+    Turn fabric's global connection cache into a pool.
+
+    Fabric modules hold a reference to the very same cache object,
+    so the object itself is upgraded rather than replaced.
+    Note that parallel tasks are run in forked processes, which start with an empty cache.
+    The pool stays installed until the end of the run, see connection_pool to limit it to a block.
+    """
+    connections = state.connections
+    if not isinstance(connections, ConnectionPool):
+        connections.__class__ = ConnectionPool
+        # connections opened before the pool was installed are tracked from now on
+        connections.reset()
+    connections.setup(idle_timeout, max_connections_per_host)
+    return connections
+
+
+@contextmanager
+def connection_pool(idle_timeout: Optional[float] = None,
+                    max_connections_per_host: Optional[int] = None) -> Iterator[ConnectionPool]:
+    """
+    Share the ssh connections of the block, then report their stats and close them.
+    A block nested in another one shares the pool of the outer block.
+    """
+    is_installed = isinstance(state.connections, ConnectionPool)
+    pool = install_connection_pool(idle_timeout, max_connections_per_host)
+    if is_installed:
+        yield pool
+        return
+    try:
+        yield pool
+    finally:
+        report_connection_stats()
+        pool.disconnect_all()
+        pool.__class__ = HostConnectionCache
+
+
+def get_connection_stats() -> Dict[str, int]:
+    connections = state.connections
+    if not isinstance(connections, ConnectionPool):
+        return {}
+    return {
+        'opened': connections.stats['opened'],
+        'reused': connections.stats['reused'],
+        'reconnected': connections.stats['reconnected'],
+        'evicted': connections.stats['evicted'],
+        'open': len(connections),
+    }
+
+
+def report_connection_stats() -> None:
+    stats = get_connection_stats()
+    if stats:
+        puts('connections ' + ', '.join(f'{name}: {value}' for name, value in stats.items()))
@@ -1,60 +1,193 @@
 import os
 import re
+from collections import namedtuple
+from functools import lru_cache
 
 
 __all__ = [
+    'BranchNamer',
+    'BranchNames',
+    'GitHead',
     'branch_to_db',
     'branch_to_domain',
     'branch_to_slug',
     'branch_to_url',
     'get_active_branch_name',
+    'get_branch_namer',
+    'read_git_head',
 ]
 
 
+GitHead = namedtuple('GitHead', ['branch', 'sha'])
+
+
 def get_active_branch_name(path=None):
-    from git import Repo
-    return Repo(path or os.getcwd()).active_branch.name
+    """
+    Return the branch checked out in the git repository the path belongs to
+    (None if HEAD is detached or the path is not in a git repository)
+    """
+    return read_git_head(os.path.abspath(path or os.getcwd())).branch
+
+
+@lru_cache(maxsize=None)
+def read_git_head(path):
+    """
+    Read HEAD of the repository (or the worktree) the path belongs to right off the .git directory
+    """
+    git_dir = _find_git_dir(path)
+    if not git_dir:
+        return GitHead(branch=None, sha=None)
+    head = _read_file(os.path.join(git_dir, 'HEAD'))
+    if not head:
+        return GitHead(branch=None, sha=None)
+    if not head.startswith('ref:'):
+        # detached HEAD
+        return GitHead(branch=None, sha=head)
+    ref = head[len('ref:'):].strip()
+    branch = ref[len('refs/heads/'):] if ref.startswith('refs/heads/') else None
+    return GitHead(branch=branch, sha=_resolve_ref(git_dir, ref))
+
+
+def _read_file(filename):
+    try:
+        with open(filename) as file:
+            return file.read().strip()
+    except OSError:
+        return None
+
+
+def _find_git_dir(path):
+    while True:
+        dot_git = os.path.join(path, '.git')
+        if os.path.isdir(dot_git):
+            return dot_git
+        if os.path.isfile(dot_git):
+            # worktrees and submodules have a .git file pointing to the actual git directory
+            content = _read_file(dot_git) or ''
+            if content.startswith('gitdir:'):
+                return os.path.normpath(os.path.join(path, content[len('gitdir:'):].strip()))
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+def _resolve_ref(git_dir, ref):
+    # refs of worktrees are kept in the common git directory
+    common_dir = _read_file(os.path.join(git_dir, 'commondir'))
+    ref_dirs = [git_dir]
+    if common_dir:
+        ref_dirs.append(os.path.normpath(os.path.join(git_dir, common_dir)))
+    for ref_dir in ref_dirs:
+        sha = _read_file(os.path.join(ref_dir, ref))
+        if sha:
+            return sha
+    for ref_dir in ref_dirs:
+        packed_refs = _read_file(os.path.join(ref_dir, 'packed-refs')) or ''
+        for line in packed_refs.splitlines():
+            if line.startswith(('#', '^')):
+                continue
+            sha, _, packed_ref = line.partition(' ')
+            if packed_ref == ref:
+                return sha
+    # a branch without commits yet
+    return None
+
+
+BranchNames = namedtuple('BranchNames', ['domain', 'slug', 'db', 'url'])
+
+NON_DOMAIN_CHARS_RE = re.compile(r'[^a-z0-9\-]')
+MULTIPLE_HYPHENS_RE = re.compile(r'-{2,}')
+
+
+class BranchNamer:
+    """
+    Convert git branch names into domain, slug, database name and url.
+
+    The domain pattern is compiled once and the results are kept in a bounded LRU cache.
+    """
+
+    def __init__(self, domain_pattern=None, base_domain=None, cache_size=4096):
+        self.base_domain = base_domain
+        self.pattern, self.replacer = None, None
+        if domain_pattern:
+            if isinstance(domain_pattern, (tuple, list)):
+                pattern, self.replacer = domain_pattern
+            else:
+                pattern = domain_pattern
+            self.pattern = re.compile(pattern, flags=re.I)
+        self.domain = lru_cache(maxsize=cache_size)(self._get_domain)
+        self.names = lru_cache(maxsize=cache_size)(self._get_names)
+
+    def _get_domain(self, branch_name):
+        # obtain domain name using regex
+        if self.pattern:
+            match_obj = self.pattern.search(branch_name)
+            if match_obj:
+                if self.replacer:
+                    return self.pattern.sub(self.replacer, branch_name)
+                else:
+                    return match_obj.group(1)
+        # replace all non-alphanumeric characters with a hyphen
+        domain = NON_DOMAIN_CHARS_RE.sub('-', branch_name.lower())
+        # replace double hyphens with a single character
+        return MULTIPLE_HYPHENS_RE.sub('-', domain)
+
+    def _get_names(self, branch_name):
+        domain = self.domain(branch_name)
+        slug_name = branch_name.split('/', 1)[-1]
+        slug = domain if slug_name == branch_name else self.domain(slug_name)
+        url = None
+        if self.base_domain:
+            url = self.base_domain if domain == 'master' else f'{domain}.{self.base_domain}'
+        return BranchNames(domain=domain, slug=slug, db=domain.replace('-', ''), url=url)
+
+    def slug(self, branch_name):
+        return self.names(branch_name).slug
+
+    def db(self, branch_name):
+        return self.names(branch_name).db
+
+    def url(self, branch_name):
+        if not self.base_domain:
+            raise ValueError('base domain is required to build branch url')
+        return self.names(branch_name).url
+
+
+@lru_cache(maxsize=64)
+def get_branch_namer(domain_pattern=None, base_domain=None):
+    """
+    Return a shared namer for the pattern (a pattern or a (pattern, replacer) tuple)
+    """
+    return BranchNamer(domain_pattern, base_domain)
+
+
+def _get_branch_namer(domain_pattern=None, base_domain=None):
+    if isinstance(domain_pattern, list):
+        domain_pattern = tuple(domain_pattern)
+    return get_branch_namer(domain_pattern, base_domain)
 
 
 def branch_to_domain(branch_name, domain_pattern=None):
     """
     Convert a git branch name into a valid domain string.
     """
-    # obtain domain name using regex
-    if domain_pattern:
-        if isinstance(domain_pattern, (tuple, list)):
-            pattern, replacer = domain_pattern
-        else:
-            pattern, replacer = domain_pattern, None
-
-        match_obj = re.search(pattern, branch_name, flags=re.I)
-        if match_obj:
-            if replacer:
-                return re.sub(pattern, replacer, branch_name, flags=re.I)
-            else:
-                return match_obj.group(1)
-    # replace all non-alphanumeric characters with a hyphen
-    domain = re.sub(r'[^a-z0-9\-]', '-', branch_name.lower())
-    # replace double hyphens with a single character
-    return re.sub(r'-{2,}', '-', domain)
+    return _get_branch_namer(domain_pattern).domain(branch_name)
 
 
 def branch_to_url(base_domain, branch_name, domain_pattern=None):
-    domain = branch_to_domain(branch_name, domain_pattern)
-    if domain == 'master':
-        return base_domain
-    return f'{domain}.{base_domain}'
+    return _get_branch_namer(domain_pattern, base_domain).url(branch_name)
 
 
-def branch_to_slug(branch_name, **kwargs):
+def branch_to_slug(branch_name, domain_pattern=None):
     """
     Convert branch name to valid slug
     """
-    return branch_to_domain(branch_name.split('/', 1)[-1], **kwargs)
+    return _get_branch_namer(domain_pattern).slug(branch_name)
 
 
-def branch_to_db(branch_name, **kwargs):
+def branch_to_db(branch_name, domain_pattern=None):
     """
     Convert branch name to valid database name
     """
-    return branch_to_domain(branch_name, **kwargs).replace('-', '')
+    return _get_branch_namer(domain_pattern).db(branch_name)
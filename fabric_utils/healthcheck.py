@@ -1,15 +1,32 @@
-from time import sleep
-from typing import Tuple, Callable, Any, Dict, Optional
+from random import uniform
+from time import sleep, monotonic
+from typing import Tuple, Callable, Any, Dict, Optional, Iterable, Iterator, List
 
-from fabric.api import puts, settings, hide
-from fabric.operations import run
+from fabric.api import puts, settings, hide, env
 from fabric.tasks import execute
 from fabric.utils import error
 
 from .helpers import is_parallel_supported
+from .probes import Probe, http_probe, uwsgi_probe, run_probes
+from .profiling import run, timed
 
 
-def check_uwsgi_is_200_ok(url, uwsgi_port=None, uwsgi_sock=None, status='200 OK'):
+def check_uwsgi_is_200_ok(url, uwsgi_port=None, uwsgi_sock=None, status='200 OK', direct=False, timeout=5,
+                          uwsgi_host=None):
+    """
+    Check a uwsgi app responds with the status.
+
+    Direct mode probes the app port from this process instead of running uwsgi_curl on the host.
+    As uwsgi usually listens on 127.0.0.1 of the host, the address it's reachable at from here
+    is given explicitly as `uwsgi_host` (e.g. env.host when it listens on all interfaces).
+    """
+    if direct:
+        if uwsgi_sock:
+            raise ValueError('a unix socket of the host can not be probed directly')
+        if not uwsgi_host:
+            raise ValueError('uwsgi_host reachable from this machine is required to probe directly')
+        probe = uwsgi_probe(url, host=uwsgi_host, port=uwsgi_port, status=status, timeout=timeout)
+        return run_probes([probe])[0]
     with settings(hide('stdout')):
         addr = f'127.0.0.1:{uwsgi_port}' if uwsgi_port else uwsgi_sock
         command = f'uwsgi_curl {addr} {url} | head -n 1 | grep "{status}"'
@@ -17,7 +34,18 @@ def check_uwsgi_is_200_ok(url, uwsgi_port=None, uwsgi_sock=None, status='200 OK'
         return result
 
 
-def check_http_is_200_ok(healthcheck_url, http_host=None, unix_sock=None, status='200 OK'):
+def check_http_is_200_ok(healthcheck_url, http_host=None, unix_sock=None, status='200 OK', direct=False, timeout=5):
+    """
+    Check a url responds with the status.
+
+    Direct mode probes the url port of the host from this process instead of running curl on the host,
+    so the port has to be reachable from this machine.
+    """
+    if direct:
+        if unix_sock:
+            raise ValueError('a unix socket of the host can not be probed directly')
+        probe = http_probe(healthcheck_url, host=env.host, http_host=http_host, status=status, timeout=timeout)
+        return run_probes([probe])[0]
     with settings(hide('stdout')):
         command = 'curl'
         if unix_sock:
@@ -29,39 +57,129 @@ def check_http_is_200_ok(healthcheck_url, http_host=None, unix_sock=None, status
         return result
 
 
+@timed
 def check_role_is_up(task: Callable, *task_args: Any, **task_kwargs: Any) -> Tuple[dict, str]:
     with settings(parallel=is_parallel_supported()):
         is_role_up_results = execute(task, *task_args, **task_kwargs)
+    # a host that returned nothing (e.g. a failed ping) is still a failed host
     per_hosts_success = {
-        host: res.succeeded
-        for host, res in is_role_up_results.items() if res
+        host: bool(getattr(res, 'succeeded', False))
+        for host, res in is_role_up_results.items()
     }
     joint_stderr = '\n'.join(r.stdout for r in is_role_up_results.values() if r)
     return per_hosts_success, joint_stderr
 
 
-def wait_until_role_is_up(task: Callable, poll_interval: int = 3, max_wait: int = 20, check=all,
-                          task_args: Optional[Tuple[Any]] = None, task_kwargs: Optional[Dict[str, Any]] = None) -> bool:
-    waiting_seconds = 0
+def check_hosts_are_up(probes: Dict[str, Probe]) -> Tuple[dict, str]:
+    """
+    Same as check_role_is_up but probe the hosts concurrently from this process.
+
+    :param probes: host to probe mapping (see fabric_utils.probes.http_probe, uwsgi_probe)
+    """
+    results = run_probes(list(probes.values()))
+    per_hosts_success = {
+        host: result.succeeded
+        for host, result in zip(probes, results)
+    }
+    joint_stderr = '\n'.join(f'{host}: {result.stdout}' for host, result in zip(probes, results))
+    return per_hosts_success, joint_stderr
+
+
+def quorum(ratio: float) -> Callable:
+    """
+    Build a check passing when at least the given ratio of hosts is up, e.g. quorum(0.5)
+    """
+    def check(statuses: Iterable[bool]) -> bool:
+        statuses = list(statuses)
+        return bool(statuses) and sum(statuses) >= ratio * len(statuses)
+    return check
+
+
+@timed
+def wait_until_role_is_up(task: Callable, poll_interval: float = 3, max_wait: float = 20, check=all,
+                          task_args: Optional[Tuple[Any]] = None, task_kwargs: Optional[Dict[str, Any]] = None,
+                          initial_interval: float = 0.5, backoff: float = 2, jitter: float = 0.2) -> bool:
+    """
+    Wait for the hosts to pass the check task as long as `max_wait` seconds (by the wall clock).
+
+    The hosts that are up are not checked again.
+    The interval between checks starts with `initial_interval`
+    and grows `backoff` times up to `poll_interval` (with a random `jitter` ratio applied).
+    """
     stderr = '-'
     task_args = task_args or ()
     task_kwargs = task_kwargs or {}
+    hosts_status = {}  # type: Dict[str, bool]
+    intervals = _iter_intervals(poll_interval, initial_interval, backoff, jitter)
+    started_at = monotonic()
+    deadline = started_at + max_wait
 
     puts(f'waiting for role/host to be up for as long as {max_wait} seconds')
-    while waiting_seconds < max_wait:
+    while True:
         # skip waiting on the first iteration, app may already be up
-        up_hosts, stderr = check_role_is_up(task, *task_args, **task_kwargs)
-        if check(up_hosts.values()):
-            puts(f'role/host is up after {waiting_seconds} seconds')
+        pending_hosts = [host for host, status in hosts_status.items() if not status]
+        if not hosts_status:
+            up_hosts, stderr = check_role_is_up(task, *task_args, **task_kwargs)
+        else:
+            up_hosts, stderr = check_role_is_up(task, *task_args, **_with_hosts(task_kwargs, pending_hosts))
+        hosts_status.update(up_hosts)
+
+        waiting_seconds = monotonic() - started_at
+        if check(hosts_status.values()):
+            puts(f'role/host is up after {waiting_seconds:.1f} seconds')
             return True
         else:
-            failed_hosts = ', '.join([host for host, status in up_hosts.items() if not status])
-            puts(f'role/host is not up after {waiting_seconds} seconds: failed hosts: {failed_hosts}')
+            failed_hosts = ', '.join([host for host, status in hosts_status.items() if not status])
+            puts(f'role/host is not up after {waiting_seconds:.1f} seconds: failed hosts: {failed_hosts}')
 
-        sleep(poll_interval)
-        waiting_seconds += poll_interval
+        remaining_seconds = deadline - monotonic()
+        if remaining_seconds <= 0:
+            break
+        sleep(min(next(intervals), remaining_seconds))
 
     with settings(warn_only=False):
-        error(f'waited for {waiting_seconds} seconds, role/host is not up. Aborting \n {stderr}')
+        error(f'waited for {waiting_seconds:.1f} seconds, role/host is not up. Aborting \n {stderr}')
 
     return False
+
+
+def wait_until_host_is_up(task: Callable, *task_args: Any, poll_interval: float = 3, max_wait: float = 20,
+                          initial_interval: float = 0.5, backoff: float = 2, jitter: float = 0.2,
+                          **task_kwargs: Any) -> bool:
+    """
+    Same as wait_until_role_is_up but poll the current host from this process (e.g. within a parallel task)
+    and return whether it passed the check task, instead of aborting.
+    """
+    intervals = _iter_intervals(poll_interval, initial_interval, backoff, jitter)
+    deadline = monotonic() + max_wait
+    while True:
+        result = task(*task_args, **task_kwargs)
+        if getattr(result, 'succeeded', False):
+            return True
+        remaining_seconds = deadline - monotonic()
+        if remaining_seconds <= 0:
+            return False
+        sleep(min(next(intervals), remaining_seconds))
+
+
+def _iter_intervals(poll_interval: float, initial_interval: float, backoff: float, jitter: float) -> Iterator[float]:
+    """
+    Yield intervals growing `backoff` times from `initial_interval` up to `poll_interval` (with the jitter applied)
+    """
+    interval = min(initial_interval, poll_interval)
+    while True:
+        yield interval * uniform(1 - jitter, 1 + jitter)
+        interval = min(interval * backoff, poll_interval)
+
+
+def _with_hosts(task_kwargs: Dict[str, Any], hosts: List[str]) -> Dict[str, Any]:
+    """
+    Replace execute() host and role arguments with the given host list
+    """
+    task_kwargs = {
+        key: value
+        for key, value in task_kwargs.items()
+        if key not in ('host', 'hosts', 'role', 'roles', 'exclude_hosts')
+    }
+    task_kwargs['hosts'] = hosts
+    return task_kwargs
@@ -1,15 +1,20 @@
+import hashlib
 import os
 import platform
 import re
+import shlex
 import sys
-from typing import Any, List, Callable
+from typing import Any, Callable, Dict, List, Optional
 from functools import partial, wraps
 from contextlib import contextmanager
 
-from fabric.api import sudo, run, path, puts, quiet
+from fabric.api import path, puts, quiet, put, env
 from fabric.contrib.files import upload_template
 
+from . import manifest
 from .git import get_active_branch_name
+from .placement import get_ring
+from .profiling import run, sudo
 
 
 def su(user):
@@ -83,8 +88,22 @@ def virtualenv(virtualenv_path):
 
 
 @contextmanager
-def checksum(filename, *files_or_dirs):
+def checksum(filename, *files_or_dirs, incremental=False):
+    """
+    Tell whether the files have changed since the last time the checksum was saved to the file.
+    The checksum is saved after the block is done.
+
+    Incremental mode keeps a manifest of file digests in the file so that only changed files are read.
+    """
     paths = ' '.join(files_or_dirs)
+    if incremental:
+        with quiet():
+            modified = sudo(manifest_command('check', filename, paths)).failed
+        yield modified
+        if modified:
+            sudo(manifest_command('update', filename, paths))
+        return
+
     # check whether the files have changed (or the checksum file does not exist at all)
     with quiet():
         if not sudo(f'find {paths} -type f -print0 | sort -z | xargs -0 tar cf - | shasum -c {filename}').failed:
@@ -97,13 +116,19 @@ def checksum(filename, *files_or_dirs):
         sudo(f'find {paths} -type f -print0 | sort -z | xargs -0 tar cf - | shasum > {filename}')
 
 
-def get_checksum(*files_or_dirs):
+def get_checksum(*files_or_dirs, incremental=False, cache=None):
     """
     Calculate sha checksum for list of given files or directories.
+
+    Incremental mode may be given a manifest cache file, so that only the files changed since are read.
     """
     paths = ' '.join(files_or_dirs)
-    # what this command does is:
-    shasum = sudo(f'find {paths} -type f -print0 | sort -z | xargs -0 tar cf - | tar xOf - | shasum')
+    if incremental:
+        cache_option = f'--cache {cache} ' if cache else ''
+        shasum = sudo(manifest_command('root', f'{cache_option}{paths}'))
+    else:
+        # what this command does is:
+        shasum = sudo(f'find {paths} -type f -print0 | sort -z | xargs -0 tar cf - | tar xOf - | shasum')
 
     if shasum.failed:
         raise Exception('failed to get shasum for specified files')
@@ -111,6 +136,36 @@ def get_checksum(*files_or_dirs):
     return str(shasum).split(' ', 1)[0]
 
 
+# host -> path of the manifest script uploaded to the host
+_manifest_script_paths = {}  # type: Dict[str, str]
+
+
+def manifest_command(*args):
+    """
+    Return the command running the manifest script (fabric_utils.manifest) on the current host.
+
+    The script is uploaded once per host to ~/.fabric-utils of the connecting user (writable by nobody else),
+    and the command runs it only if its digest matches.
+    """
+    with open(manifest.__file__, 'rb') as script:
+        script_digest = hashlib.sha1(script.read()).hexdigest()
+
+    remote_path = _manifest_script_paths.get(env.host_string)
+    if remote_path is None:
+        with quiet():
+            remote_dir = run('mkdir -p ~/.fabric-utils && chmod 755 ~/.fabric-utils && cd ~/.fabric-utils && pwd')
+            remote_path = f'{remote_dir.strip()}/manifest-{script_digest[:12]}.py'
+            is_uploaded = run(f'sha1sum {shlex.quote(remote_path)}').startswith(script_digest)
+        if not is_uploaded:
+            put(manifest.__file__, remote_path, mode=0o644)
+        _manifest_script_paths[env.host_string] = remote_path
+
+    python = env.get('manifest_python', 'python3')
+    quoted_path = shlex.quote(remote_path)
+    digest_check = f"printf '%s  %s\\n' {script_digest} {quoted_path} | sha1sum -c --status"
+    return f'{digest_check} && {python} {quoted_path} {" ".join(args)}'
+
+
 def readlink(path):
     with quiet():
         result = sudo(f'readlink {path}')
@@ -159,5 +214,33 @@ def with_random_node(nodes: List[str], randomizer: Callable) -> Callable:
     return decorator
 
 
-with_branch_node = partial(with_random_node,
-                           randomizer=lambda b, *args, **kws: sum(map(ord, b.name)) % len(b.hosts))
+def with_branch_node(nodes: List[str], randomizer: Optional[Callable] = None, *, ring: bool = False,
+                     weights: Optional[Dict[str, float]] = None, get_loads: Optional[Callable] = None,
+                     get_branch_node: Optional[Callable] = None, load_factor: float = 1.25) -> Callable:
+    """
+    Pass the node of the branch (the first task argument).
+
+    The branch is placed by the sum of its name characters modulo the number of its hosts,
+    or on a consistent-hash ring of the nodes if `ring` is set (see fabric_utils.placement),
+    so that a change of the nodes moves only a few branches.
+    Switching to the ring moves most of the existing branches once,
+    list them with placement.report_moved_keys(branches, ModuloPlacement(nodes), get_ring(nodes)) before switching.
+
+    The ring gives the nodes their `weights`, and if `get_loads` is given (a callable returning stacks per node),
+    a new branch skips the nodes holding more than `load_factor` times their share of the stacks.
+    The loads require `get_branch_node` (a callable returning the node the branch is deployed on, or None),
+    as a deployed branch is kept on its node.
+    """
+    if get_loads is not None and get_branch_node is None:
+        raise ValueError('get_loads requires get_branch_node')
+    if randomizer is None and ring:
+        def randomizer(branch: Any, *args: Any, **kwargs: Any) -> int:
+            loads = get_loads() if get_loads is not None else None
+            current_node = get_branch_node(branch) if get_branch_node is not None else None
+            node = get_ring(nodes, weights).get_node(branch.name, loads, load_factor=load_factor,
+                                                     current_node=current_node)
+            return nodes.index(node)
+    elif randomizer is None:
+        def randomizer(branch: Any, *args: Any, **kwargs: Any) -> int:
+            return sum(map(ord, branch.name)) % len(branch.hosts)
+    return with_random_node(nodes, randomizer)
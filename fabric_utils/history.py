@@ -0,0 +1,136 @@
+"""
+Release history kept in a local SQLite database.
+
+The history records the release deployed to every node and environment,
+so that the next deploy knows its base revision, and caches changelogs by (base sha, target sha),
+so that nodes deployed with the same release reuse the changelog instead of running git log again.
+"""
+import json
+import os
+import threading
+from collections import namedtuple
+from datetime import datetime
+from time import time
+from typing import TYPE_CHECKING, Any, Dict, List, Optional
+
+if TYPE_CHECKING:
+    import sqlite3
+
+
+__all__ = [
+    'ReleaseHistory',
+    'ReleaseRecord',
+    'get_release_history',
+]
+
+DEFAULT_HISTORY_PATH = os.path.join('~', '.fabric-utils', 'history.sqlite3')
+
+ReleaseRecord = namedtuple('ReleaseRecord', ['node', 'environment', 'sha', 'deployed_at', 'project'])
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS releases (
+    id INTEGER PRIMARY KEY,
+    node TEXT NOT NULL,
+    environment TEXT NOT NULL,
+    sha TEXT NOT NULL,
+    deployed_at REAL NOT NULL,
+    project TEXT NOT NULL DEFAULT ''
+);
+CREATE TABLE IF NOT EXISTS changelogs (
+    base TEXT NOT NULL,
+    target TEXT NOT NULL,
+    commits TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (base, target)
+);
+"""
+
+INDEXES = """
+DROP INDEX IF EXISTS releases_node;
+CREATE INDEX IF NOT EXISTS releases_target ON releases (project, node, environment, deployed_at);
+"""
+
+
+class ReleaseHistory:
+    """
+    Release history database, safe to use from threads and forked processes (parallel deploys).
+
+    Releases are kept per project, node and environment. The node is any deploy target,
+    e.g. the swarm role rather than the manager that happened to be picked for the deploy.
+    """
+
+    def __init__(self, path: Optional[str] = None, timeout: float = 30) -> None:
+        self.path = os.path.expanduser(path or os.environ.get('FABRIC_UTILS_HISTORY') or DEFAULT_HISTORY_PATH)
+        self.timeout = timeout
+        self._local = threading.local()
+
+    @property
+    def connection(self) -> 'sqlite3.Connection':
+        # connections are neither shared between threads nor inherited by forked processes
+        if getattr(self._local, 'pid', None) != os.getpid():
+            import sqlite3
+            if os.path.dirname(self.path):
+                os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.executescript(SCHEMA)
+            columns = {row[1] for row in connection.execute('PRAGMA table_info(releases)')}
+            if 'project' not in columns:
+                # a history written before the releases were kept per project
+                try:
+                    connection.execute("ALTER TABLE releases ADD COLUMN project TEXT NOT NULL DEFAULT ''")
+                except sqlite3.OperationalError:
+                    # added by another process in the meantime
+                    pass
+            connection.executescript(INDEXES)
+            self._local.connection, self._local.pid = connection, os.getpid()
+        return self._local.connection
+
+    def record_release(self, node: str, environment: str, sha: str,
+                       deployed_at: Optional[datetime] = None, project: str = '') -> None:
+        deployed_at_ts = deployed_at.timestamp() if deployed_at else time()
+        self.connection.execute('INSERT INTO releases (project, node, environment, sha, deployed_at) '
+                                'VALUES (?, ?, ?, ?, ?)', (project, node, environment, sha, deployed_at_ts))
+
+    def get_releases(self, node: str, environment: str, limit: int = 10, project: str = '') -> List[ReleaseRecord]:
+        """
+        Return the releases of the project on the node, the latest first
+        """
+        rows = self.connection.execute(
+            'SELECT sha, deployed_at FROM releases WHERE project = ? AND node = ? AND environment = ? '
+            'ORDER BY deployed_at DESC, id DESC LIMIT ?',
+            (project, node, environment, limit),
+        )
+        return [ReleaseRecord(node, environment, sha, datetime.fromtimestamp(deployed_at_ts), project)
+                for sha, deployed_at_ts in rows]
+
+    def get_last_release(self, node: str, environment: str, project: str = '') -> Optional[ReleaseRecord]:
+        releases = self.get_releases(node, environment, limit=1, project=project)
+        return releases[0] if releases else None
+
+    def get_changelog(self, base: str, target: str) -> Optional[List[Dict[str, Any]]]:
+        """
+        Return the cached commits (as dicts) of the revision range
+        """
+        row = self.connection.execute('SELECT commits FROM changelogs WHERE base = ? AND target = ?',
+                                      (base, target)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def save_changelog(self, base: str, target: str, commits: List[Dict[str, Any]]) -> None:
+        self.connection.execute('INSERT OR REPLACE INTO changelogs (base, target, commits, created_at) '
+                                'VALUES (?, ?, ?, ?)', (base, target, json.dumps(commits), time()))
+
+    def close(self) -> None:
+        connection = getattr(self._local, 'connection', None)
+        if connection is not None and self._local.pid == os.getpid():
+            connection.close()
+        self._local.__dict__.clear()
+
+
+_histories = {}  # type: Dict[Optional[str], ReleaseHistory]
+
+
+def get_release_history(path: Optional[str] = None) -> ReleaseHistory:
+    if path not in _histories:
+        _histories[path] = ReleaseHistory(path)
+    return _histories[path]
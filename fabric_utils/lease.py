@@ -0,0 +1,316 @@
+"""
+Lease based locks.
+
+A lease is a lock that expires after `ttl` seconds unless it's renewed.
+The holder renews the lease with a background heartbeat, so a crashed deploy frees the lock within `ttl` seconds.
+Every acquired lease gets a fencing token (an ever increasing number) and is released with compare-and-delete,
+so that a holder whose lease has expired can never release somebody else's lease.
+
+Leases are kept in redis (talked to directly through a connection pool) or in memory (a local stand-in).
+"""
+import os
+import select
+import socket
+import threading
+from time import monotonic
+from typing import Any, Dict, List, Optional, Tuple, Union
+
+
+__all__ = [
+    'Lease',
+    'LeaseError',
+    'MemoryLeaseBackend',
+    'RedisConnectionPool',
+    'RedisError',
+    'RedisLeaseBackend',
+    'get_redis_pool',
+]
+
+
+class LeaseError(Exception):
+    pass
+
+
+class RedisError(Exception):
+    pass
+
+
+class RedisConnection:
+    """
+    Minimal redis protocol (RESP) connection
+    """
+
+    def __init__(self, host: str, port: int, timeout: float = 5) -> None:
+        self.sock = socket.create_connection((host, port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = self.sock.makefile('rb')
+
+    def execute(self, *args: Union[str, int, bytes]) -> Any:
+        self.send(*args)
+        return self.read_reply()
+
+    def send(self, *args: Union[str, int, bytes]) -> None:
+        self.sock.sendall(self.encode(args))
+
+    def is_closed(self) -> bool:
+        """
+        Tell whether the server has closed the idle connection (it has nothing to read otherwise)
+        """
+        try:
+            readable, _, _ = select.select([self.sock], [], [], 0)
+            return bool(readable) and not self.sock.recv(1, socket.MSG_PEEK)
+        except OSError:
+            return True
+
+    @staticmethod
+    def encode(args: Tuple) -> bytes:
+        parts = [b'*%d\r\n' % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode()
+            parts.append(b'$%d\r\n%s\r\n' % (len(arg), arg))
+        return b''.join(parts)
+
+    def read_reply(self) -> Any:
+        line = self.reader.readline()
+        if not line.endswith(b'\r\n'):
+            raise ConnectionError('redis connection closed')
+        prefix, payload = line[:1], line[1:-2]
+        if prefix == b'+':
+            return payload.decode()
+        if prefix == b'-':
+            raise RedisError(payload.decode())
+        if prefix == b':':
+            return int(payload)
+        if prefix == b'$':
+            size = int(payload)
+            if size < 0:
+                return None
+            data = self.reader.read(size + 2)
+            return data[:-2].decode()
+        if prefix == b'*':
+            size = int(payload)
+            if size < 0:
+                return None
+            return [self.read_reply() for _ in range(size)]
+        raise RedisError(f'unexpected reply {line!r}')
+
+    def close(self) -> None:
+        self.reader.close()
+        self.sock.close()
+
+
+class RedisConnectionPool:
+    """
+    Keep redis connections open for reuse (connections are not shared with forked processes).
+
+    A command is sent again over a new connection only if it could not be sent,
+    as a command that has reached the server (e.g. INCR or SET NX) must not be run twice.
+    """
+
+    def __init__(self, host: str, port: int, max_idle: int = 4, timeout: float = 5) -> None:
+        self.host = host
+        self.port = port
+        self.max_idle = max_idle
+        self.timeout = timeout
+        self._idle = []  # type: List[RedisConnection]
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def execute(self, *args: Union[str, int, bytes]) -> Any:
+        connection, is_reused = self._get()
+        try:
+            connection.send(*args)
+        except OSError:
+            connection.close()
+            if not is_reused:
+                raise
+            connection = RedisConnection(self.host, self.port, self.timeout)
+            connection.send(*args)
+        try:
+            result = connection.read_reply()
+        except RedisError:
+            self._put(connection)
+            raise
+        except (OSError, ConnectionError):
+            connection.close()
+            raise
+        self._put(connection)
+        return result
+
+    def _get(self) -> Tuple[RedisConnection, bool]:
+        while True:
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._idle, self._pid = [], os.getpid()
+                if not self._idle:
+                    break
+                connection = self._idle.pop()
+            # an idle connection may have been closed by the server
+            if not connection.is_closed():
+                return connection, True
+            connection.close()
+        return RedisConnection(self.host, self.port, self.timeout), False
+
+    def _put(self, connection: RedisConnection) -> None:
+        with self._lock:
+            if len(self._idle) < self.max_idle:
+                self._idle.append(connection)
+                return
+        connection.close()
+
+
+_redis_pools = {}  # type: Dict[Tuple[str, int], RedisConnectionPool]
+
+
+def get_redis_pool(host: str, port: int) -> RedisConnectionPool:
+    key = (host, int(port))
+    if key not in _redis_pools:
+        _redis_pools[key] = RedisConnectionPool(host, int(port))
+    return _redis_pools[key]
+
+
+RENEW_SCRIPT = ("if redis.call('get', KEYS[1]) == ARGV[1] "
+                "then return redis.call('pexpire', KEYS[1], ARGV[2]) else return 0 end")
+RELEASE_SCRIPT = ("if redis.call('get', KEYS[1]) == ARGV[1] "
+                  "then return redis.call('del', KEYS[1]) else return 0 end")
+
+
+class RedisLeaseBackend:
+
+    def __init__(self, pool: RedisConnectionPool) -> None:
+        self.pool = pool
+
+    def next_fence(self, key: str) -> int:
+        return self.pool.execute('INCR', f'{key}:fence')
+
+    def acquire(self, key: str, token: str, ttl_ms: int) -> bool:
+        return self.pool.execute('SET', key, token, 'NX', 'PX', ttl_ms) == 'OK'
+
+    def renew(self, key: str, token: str, ttl_ms: int) -> bool:
+        return self.pool.execute('EVAL', RENEW_SCRIPT, 1, key, token, ttl_ms) == 1
+
+    def release(self, key: str, token: str) -> bool:
+        return self.pool.execute('EVAL', RELEASE_SCRIPT, 1, key, token) == 1
+
+    def holder(self, key: str) -> Optional[str]:
+        return self.pool.execute('GET', key)
+
+
+class MemoryLeaseBackend:
+    """
+    In-process stand-in for redis (e.g. for a single deploy agent or tests)
+    """
+
+    def __init__(self) -> None:
+        self._values = {}  # type: Dict[str, Tuple[str, Optional[float]]]
+        self._fences = {}  # type: Dict[str, int]
+        self._lock = threading.Lock()
+
+    def _get(self, key: str) -> Optional[str]:
+        value, expires_at = self._values.get(key, (None, None))
+        if expires_at is not None and expires_at <= monotonic():
+            self._values.pop(key, None)
+            return None
+        return value
+
+    def next_fence(self, key: str) -> int:
+        with self._lock:
+            self._fences[key] = self._fences.get(key, 0) + 1
+            return self._fences[key]
+
+    def acquire(self, key: str, token: str, ttl_ms: int) -> bool:
+        with self._lock:
+            if self._get(key) is not None:
+                return False
+            self._values[key] = (token, monotonic() + ttl_ms / 1000)
+            return True
+
+    def renew(self, key: str, token: str, ttl_ms: int) -> bool:
+        with self._lock:
+            if self._get(key) != token:
+                return False
+            self._values[key] = (token, monotonic() + ttl_ms / 1000)
+            return True
+
+    def release(self, key: str, token: str) -> bool:
+        with self._lock:
+            if self._get(key) != token:
+                return False
+            del self._values[key]
+            return True
+
+    def holder(self, key: str) -> Optional[str]:
+        with self._lock:
+            return self._get(key)
+
+
+class Lease:
+    """
+    A lease of the key held by the owner, renewed every `ttl / 3` seconds once acquired
+    """
+
+    def __init__(self, backend: Union[RedisLeaseBackend, MemoryLeaseBackend], key: str, owner: str,
+                 ttl: float = 10, heartbeat_interval: Optional[float] = None) -> None:
+        self.backend = backend
+        self.key = key
+        self.owner = owner
+        self.ttl = ttl
+        self.heartbeat_interval = heartbeat_interval or ttl / 3
+        self.fence = None  # type: Optional[int]
+        self.token = None  # type: Optional[str]
+        self.lost = False
+        self._stop = threading.Event()
+        self._heartbeat = None  # type: Optional[threading.Thread]
+
+    @property
+    def ttl_ms(self) -> int:
+        return int(self.ttl * 1000)
+
+    def acquire(self) -> bool:
+        fence = self.backend.next_fence(self.key)
+        token = f'{fence}:{self.owner}'
+        if not self.backend.acquire(self.key, token, self.ttl_ms):
+            return False
+        self.fence, self.token, self.lost = fence, token, False
+        self._stop.clear()
+        self._heartbeat = threading.Thread(target=self._renew, name=f'lease-{self.key}', daemon=True)
+        self._heartbeat.start()
+        return True
+
+    def release(self) -> bool:
+        if self.token is None:
+            return False
+        self._stop.set()
+        if self._heartbeat:
+            self._heartbeat.join()
+        try:
+            return self.backend.release(self.key, self.token)
+        finally:
+            self.token = None
+
+    def holder(self) -> Optional[str]:
+        return self.backend.holder(self.key)
+
+    def _renew(self) -> None:
+        expires_at = monotonic() + self.ttl
+        while not self._stop.wait(self.heartbeat_interval):
+            try:
+                renewed_at = monotonic()
+                if not self.backend.renew(self.key, self.token, self.ttl_ms):
+                    self.lost = True
+                    return
+                expires_at = renewed_at + self.ttl
+            except (OSError, ConnectionError, RedisError):
+                # keep trying until the lease would expire
+                if monotonic() >= expires_at:
+                    self.lost = True
+                    return
+
+    def __enter__(self) -> 'Lease':
+        if not self.acquire():
+            raise LeaseError(f'{self.key} is held by {self.holder()}')
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.release()
@@ -0,0 +1,274 @@
+"""
+Incremental checksum of file trees.
+
+A manifest maps every file path to its stat data (size, mtime, inode) and content digest,
+so that only the files whose stat data changed are read again.
+The per-file digests are combined into a Merkle root identifying the whole tree.
+
+The module has no dependencies besides the standard library
+so that it could be uploaded to a host and run as a script:
+
+    python3 manifest.py root PATH [PATH ...] [--cache FILE]
+    python3 manifest.py check FILE PATH [PATH ...]
+    python3 manifest.py update FILE PATH [PATH ...]
+    python3 manifest.py steps STATE_DIR --step NAME=PATTERN[,PATTERN ...] [--step ...]
+    python3 manifest.py commit STATE_DIR NAME [NAME ...]
+"""
+import argparse
+import fnmatch
+import hashlib
+import json
+import os
+import sys
+from typing import Dict, Iterator, List, Optional, Tuple
+
+
+__all__ = [
+    'build_manifest',
+    'diff_manifests',
+    'iter_files',
+    'load_manifest',
+    'merkle_root',
+    'save_manifest',
+    'select_paths',
+]
+
+MANIFEST_VERSION = 1
+READ_CHUNK_SIZE = 1024 * 1024
+
+# path -> (size, mtime_ns, inode, digest)
+Manifest = Dict[str, Tuple[int, int, int, str]]
+
+
+def iter_files(paths: List[str]) -> Iterator[Tuple[str, os.stat_result]]:
+    """
+    Yield regular files (symlinks are not followed, same as `find -type f` does)
+    """
+    for path in paths:
+        try:
+            path_stat = os.lstat(path)
+        except FileNotFoundError:
+            continue
+        if os.path.isdir(path) and not os.path.islink(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames.sort()
+                for filename in sorted(filenames):
+                    file_path = os.path.join(dirpath, filename)
+                    file_stat = os.lstat(file_path)
+                    if _is_regular(file_stat):
+                        yield file_path, file_stat
+        elif _is_regular(path_stat):
+            yield path, path_stat
+
+
+def _is_regular(file_stat: os.stat_result) -> bool:
+    return (file_stat.st_mode & 0o170000) == 0o100000
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha1()
+    with open(path, 'rb') as file:
+        for chunk in iter(lambda: file.read(READ_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def build_manifest(paths: List[str], previous: Optional[Manifest] = None,
+                   patterns: Optional[List[str]] = None) -> Tuple[Manifest, int]:
+    """
+    Build a manifest of the files under the paths (matching any of the glob patterns, if given)
+    reusing digests of the previous manifest files whose stat data is the same.
+
+    Return the manifest and the number of files hashed.
+    """
+    previous = previous or {}
+    manifest = {}
+    hashed_count = 0
+    for path, file_stat in iter_files(paths):
+        if patterns is not None and not _matches(path, patterns):
+            continue
+        stat_key = (file_stat.st_size, file_stat.st_mtime_ns, file_stat.st_ino)
+        known = previous.get(path)
+        if known and tuple(known[:3]) == stat_key:
+            digest = known[3]
+        else:
+            digest = file_digest(path)
+            hashed_count += 1
+        manifest[path] = stat_key + (digest,)
+    return manifest, hashed_count
+
+
+def merkle_root(manifest: Manifest) -> str:
+    """
+    Combine file digests into a single digest.
+
+    Leaves are (path, digest) pairs in path order, every upper level hashes a pair of the lower level nodes.
+    """
+    level = [
+        hashlib.sha1(f'{path}\0{manifest[path][3]}'.encode('utf-8', 'surrogateescape')).digest()
+        for path in sorted(manifest)
+    ]
+    if not level:
+        return hashlib.sha1(b'').hexdigest()
+    while len(level) > 1:
+        level = [
+            hashlib.sha1(b''.join(level[idx:idx + 2])).digest()
+            for idx in range(0, len(level), 2)
+        ]
+    return level[0].hex()
+
+
+def diff_manifests(old: Manifest, new: Manifest) -> List[str]:
+    """
+    Return sorted paths added, removed or whose content changed
+    """
+    changed = set(old.keys() - new.keys())
+    changed.update(path for path, entry in new.items() if path not in old or old[path][3] != entry[3])
+    return sorted(changed)
+
+
+def select_paths(manifest: Manifest, patterns: List[str]) -> Manifest:
+    """
+    Return the part of the manifest matching any of the glob patterns.
+
+    Patterns are matched against paths relative to the tree root (`*` matches `/` as well,
+    so `static/*` matches everything under static).
+    """
+    return {path: entry for path, entry in manifest.items() if _matches(path, patterns)}
+
+
+def _matches(path: str, patterns: List[str]) -> bool:
+    relative_path = _relative_path(path)
+    return any(fnmatch.fnmatchcase(relative_path, pattern) for pattern in patterns)
+
+
+def _relative_path(path: str) -> str:
+    return path[2:] if path.startswith('./') else path
+
+
+def load_manifest(filename: str) -> Tuple[Manifest, Optional[str]]:
+    """
+    Return a saved manifest along with its root (empty manifest if the file is missing or not a manifest)
+    """
+    try:
+        with open(filename) as file:
+            data = json.load(file)
+    except (OSError, ValueError):
+        return {}, None
+    if not isinstance(data, dict) or data.get('version') != MANIFEST_VERSION:
+        return {}, None
+    return {path: tuple(entry) for path, entry in data['files'].items()}, data['root']
+
+
+def save_manifest(filename: str, manifest: Manifest, root: Optional[str] = None) -> str:
+    root = root or merkle_root(manifest)
+    data = {
+        'version': MANIFEST_VERSION,
+        'root': root,
+        'files': manifest,
+    }
+    tmp_filename = f'{filename}.{os.getpid()}.tmp'
+    with open(tmp_filename, 'w') as file:
+        json.dump(data, file, separators=(',', ':'))
+    os.replace(tmp_filename, filename)
+    return root
+
+
+def _pending_filename(filename: str) -> str:
+    return f'{filename}.new'
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description='Incremental checksum of file trees')
+    commands = parser.add_subparsers(dest='command')
+
+    root_parser = commands.add_parser('root', help='print the tree checksum')
+    root_parser.add_argument('--cache', help='manifest file to reuse and update')
+    root_parser.add_argument('paths', nargs='+')
+
+    check_parser = commands.add_parser('check', help='exit with 1 if the tree does not match the manifest')
+    check_parser.add_argument('filename')
+    check_parser.add_argument('paths', nargs='+')
+
+    update_parser = commands.add_parser('update', help='save the tree manifest')
+    update_parser.add_argument('filename')
+    update_parser.add_argument('paths', nargs='+')
+
+    steps_parser = commands.add_parser('steps', help='print paths changed per step of the current directory tree '
+                                                     '(null for steps that have never been committed)')
+    steps_parser.add_argument('state_dir')
+    steps_parser.add_argument('--step', action='append', default=[], metavar='NAME=PATTERN[,PATTERN ...]')
+
+    commit_parser = commands.add_parser('commit', help='save manifests of the steps checked last')
+    commit_parser.add_argument('state_dir')
+    commit_parser.add_argument('names', nargs='+')
+
+    args = parser.parse_args(argv)
+
+    if args.command == 'root':
+        previous = load_manifest(args.cache)[0] if args.cache else {}
+        manifest, _ = build_manifest(args.paths, previous)
+        root = merkle_root(manifest)
+        if args.cache:
+            save_manifest(args.cache, manifest, root)
+        print(root)
+        return 0
+
+    if args.command == 'check':
+        saved, saved_root = load_manifest(args.filename)
+        # the pending manifest is kept for the update that follows the check
+        pending, _ = load_manifest(_pending_filename(args.filename))
+        manifest, _ = build_manifest(args.paths, {**saved, **pending})
+        root = save_manifest(_pending_filename(args.filename), manifest)
+        print(root)
+        return 0 if root == saved_root else 1
+
+    if args.command == 'update':
+        saved, _ = load_manifest(args.filename)
+        pending, _ = load_manifest(_pending_filename(args.filename))
+        manifest, _ = build_manifest(args.paths, {**saved, **pending})
+        print(save_manifest(args.filename, manifest))
+        try:
+            os.remove(_pending_filename(args.filename))
+        except FileNotFoundError:
+            pass
+        return 0
+
+    if args.command == 'steps':
+        os.makedirs(args.state_dir, exist_ok=True)
+        tree_filename = os.path.join(args.state_dir, 'tree.json')
+        steps = [(name, patterns.split(',')) for name, _, patterns in (step.partition('=') for step in args.step)]
+        # the tree is walked once for all the steps, only the files that are inputs of any step are hashed
+        tree, _ = build_manifest(['.'], load_manifest(tree_filename)[0],
+                                 patterns=[pattern for _, patterns in steps for pattern in patterns])
+        save_manifest(tree_filename, tree)
+        changes = {}
+        for name, patterns in steps:
+            step_filename = os.path.join(args.state_dir, f'{name}.json')
+            saved, saved_root = load_manifest(step_filename)
+            manifest = select_paths(tree, patterns)
+            changed = diff_manifests(saved, manifest)
+            changes[name] = [_relative_path(path) for path in changed] if saved_root else None
+            if changed or not saved_root:
+                save_manifest(_pending_filename(step_filename), manifest)
+            elif os.path.exists(_pending_filename(step_filename)):
+                # left by a step that failed, its inputs are back to the saved ones
+                os.remove(_pending_filename(step_filename))
+        print(json.dumps(changes))
+        return 0
+
+    if args.command == 'commit':
+        for name in args.names:
+            step_filename = os.path.join(args.state_dir, f'{name}.json')
+            try:
+                os.replace(_pending_filename(step_filename), step_filename)
+            except FileNotFoundError:
+                pass
+        return 0
+
+    parser.print_help()
+    return 2
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,194 @@
+"""
+Background dispatcher of release notifications.
+
+Notifiers are called by a pool of worker threads fed from a bounded queue,
+so that slow chat and sentry webhooks don't add their latency to the deploy.
+
+Forked processes (e.g. fabric parallel tasks) exit without running atexit handlers,
+so their notifications are sent back to the dispatcher of the parent process through a pipe.
+"""
+import atexit
+import multiprocessing
+import os
+import pickle
+import queue
+import sys
+import threading
+import traceback
+import weakref
+from collections import defaultdict
+from time import monotonic, sleep
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+
+__all__ = [
+    'NotificationDispatcher',
+]
+
+
+class NotificationDispatcher:
+    """
+    Call notifiers in background threads.
+
+    Notifications with the same notifier and merge key that are queued within `merge_window` seconds
+    are merged: the notifier is called once, with the `nodes` of all the notifications
+    (e.g. a single "release started" message for nodes deployed at once, in parallel too).
+
+    A forked process relays its notifications to the process the dispatcher was created in,
+    or calls the notifier inline if the notification can not be pickled.
+    """
+
+    def __init__(self, workers: int = 2, max_queue: int = 100, merge_window: float = 0,
+                 flush_timeout: Optional[float] = 30) -> None:
+        self.workers = workers
+        self.merge_window = merge_window
+        self.flush_timeout = flush_timeout
+        # notifier name -> call durations
+        self.timings = defaultdict(list)  # type: Dict[str, List[float]]
+        self.errors = []  # type: List[Tuple[str, BaseException]]
+        self._queue = queue.Queue(maxsize=max_queue)  # type: queue.Queue
+        self._pending = {}  # type: Dict[Tuple[Callable, Hashable], Dict[str, Any]]
+        self._unfinished = 0
+        self._lock = threading.Lock()
+        self._all_done = threading.Condition(self._lock)
+        self._threads = []  # type: List[threading.Thread]
+        self._pid = os.getpid()
+        mp = multiprocessing.get_context('fork')
+        self._relay_reader, self._relay_writer = mp.Pipe(duplex=False)
+        self._relay_write_lock = mp.Lock()
+        self._relay_lock = threading.Lock()
+        self._relay_thread = None  # type: Optional[threading.Thread]
+        _dispatchers.add(self)
+
+    def notify(self, notifier: Callable, merge_key: Optional[Hashable] = None, **kwargs: Any) -> None:
+        """
+        Queue a notifier call (blocks while the queue is full)
+        """
+        if os.getpid() != self._pid:
+            if not self._relay(notifier, merge_key, kwargs):
+                self._call(notifier, kwargs)
+            return
+        self._start()
+        self._enqueue(notifier, merge_key, kwargs)
+
+    def _enqueue(self, notifier: Callable, merge_key: Optional[Hashable], kwargs: Dict[str, Any]) -> None:
+        with self._lock:
+            self._unfinished += 1
+            if merge_key is not None and self.merge_window:
+                key = (notifier, merge_key)
+                pending = self._pending.get(key)
+                if pending:
+                    pending['nodes'].append(kwargs.get('node'))
+                    self._unfinished -= 1
+                    return
+                self._pending[key] = {
+                    'kwargs': kwargs,
+                    'nodes': [kwargs.get('node')],
+                    'ready_at': monotonic() + self.merge_window,
+                }
+                item = (notifier, key)
+            else:
+                item = (notifier, kwargs)
+        self._queue.put(item)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """
+        Wait for the queued notifications, return False if they are not done in time
+        """
+        if os.getpid() != self._pid:
+            return True
+        self._receive_relayed()
+        deadline = None if timeout is None else monotonic() + timeout
+        with self._all_done:
+            while self._unfinished:
+                remaining = None if deadline is None else deadline - monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._all_done.wait(remaining)
+        return True
+
+    def _start(self) -> None:
+        if self._threads:
+            return
+        for idx in range(self.workers):
+            thread = threading.Thread(target=self._work, name=f'notifications-{idx}', daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        atexit.register(self.flush, self.flush_timeout)
+
+    def _relay(self, notifier: Callable, merge_key: Optional[Hashable], kwargs: Dict[str, Any]) -> bool:
+        try:
+            data = pickle.dumps((notifier, merge_key, kwargs))
+        except (pickle.PicklingError, AttributeError, TypeError):
+            return False
+        with self._relay_write_lock:
+            self._relay_writer.send_bytes(data)
+        return True
+
+    def _start_relay(self) -> None:
+        """
+        Receive the notifications relayed by forked processes (started before a fork)
+        """
+        if os.getpid() != self._pid or self._relay_thread:
+            return
+        self._relay_thread = threading.Thread(target=self._receive_relayed_forever, name='notifications-relay',
+                                              daemon=True)
+        self._relay_thread.start()
+
+    def _receive_relayed_forever(self) -> None:
+        while True:
+            self._relay_reader.poll(None)
+            self._receive_relayed()
+
+    def _receive_relayed(self) -> None:
+        # a relayed notification is queued under the lock, so that flush() never misses it in between
+        with self._relay_lock:
+            while self._relay_reader.poll():
+                notifier, merge_key, kwargs = pickle.loads(self._relay_reader.recv_bytes())
+                self._start()
+                self._enqueue(notifier, merge_key, kwargs)
+
+    def _call(self, notifier: Callable, kwargs: Dict[str, Any]) -> None:
+        name = getattr(notifier, '__name__', repr(notifier))
+        started_at = monotonic()
+        try:
+            notifier(**kwargs)
+        except Exception as exc:
+            self.errors.append((name, exc))
+            sys.stderr.write(f'notifier {name} failed:\n{traceback.format_exc()}')
+        finally:
+            self.timings[name].append(monotonic() - started_at)
+
+    def _work(self) -> None:
+        while True:
+            notifier, payload = self._queue.get()
+            if isinstance(payload, tuple):
+                # wait for the notifications to merge with
+                with self._lock:
+                    ready_at = self._pending[payload]['ready_at']
+                sleep(max(0, ready_at - monotonic()))
+                with self._lock:
+                    pending = self._pending.pop(payload)
+                kwargs = dict(pending['kwargs'], nodes=pending['nodes'])
+            else:
+                kwargs = payload
+
+            try:
+                self._call(notifier, kwargs)
+            finally:
+                with self._lock:
+                    self._unfinished -= 1
+                    self._all_done.notify_all()
+                self._queue.task_done()
+
+
+_dispatchers = weakref.WeakSet()  # type: weakref.WeakSet
+
+
+def _start_relays() -> None:
+    for dispatcher in list(_dispatchers):
+        dispatcher._start_relay()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(before=_start_relays)
@@ -0,0 +1,139 @@
+"""
+Placement of branch stacks on nodes.
+
+Branches are placed with a consistent-hash ring: every node gets a number of virtual nodes (points) on the ring
+proportional to its weight, and a branch is placed on the node owning the first point after the branch hash.
+Adding or removing a node moves only the branches of the ring arcs that change hands
+(about 1/N of them) instead of almost every branch.
+
+Placement may be bounded by the current number of stacks on the nodes,
+so that a branch skips the nodes that already have more than their share of stacks.
+
+ModuloPlacement is the former placement by the sum of the name characters,
+compare it with the ring (get_moved_keys) to tell the branches that move when switching to the ring.
+"""
+import bisect
+import hashlib
+import math
+from functools import lru_cache
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from fabric.api import puts
+
+
+__all__ = [
+    'HashRing',
+    'ModuloPlacement',
+    'get_moved_keys',
+    'get_ring',
+    'report_moved_keys',
+]
+
+DEFAULT_VNODES = 160
+
+
+def _hash(value: str) -> int:
+    return int.from_bytes(hashlib.md5(value.encode()).digest()[:8], 'big')
+
+
+class HashRing:
+
+    def __init__(self, nodes: Iterable[str], weights: Optional[Dict[str, float]] = None,
+                 vnodes: int = DEFAULT_VNODES) -> None:
+        self.nodes = list(dict.fromkeys(nodes))
+        if not self.nodes:
+            raise ValueError('no nodes to place on')
+        self.weights = {node: (weights or {}).get(node, 1) for node in self.nodes}
+        points = []
+        for node in self.nodes:
+            for idx in range(max(1, round(vnodes * self.weights[node]))):
+                points.append((_hash(f'{node}#{idx}'), node))
+        points.sort()
+        self._hashes = [point_hash for point_hash, _ in points]
+        self._owners = [node for _, node in points]
+
+    def iter_nodes(self, key: str) -> Iterator[str]:
+        """
+        Yield distinct nodes in order of preference for the key
+        """
+        start = bisect.bisect(self._hashes, _hash(key))
+        seen = set()
+        for idx in range(len(self._owners)):
+            node = self._owners[(start + idx) % len(self._owners)]
+            if node not in seen:
+                seen.add(node)
+                yield node
+                if len(seen) == len(self.nodes):
+                    return
+
+    def get_node(self, key: str, loads: Optional[Dict[str, int]] = None, load_factor: float = 1.25,
+                 current_node: Optional[str] = None) -> str:
+        """
+        Return the node of the key.
+
+        If the current loads (e.g. stacks per node) are given, the key goes to the first node in order of preference
+        that holds no more than `load_factor` times its weighted share of the stacks (the new one included).
+        A key already placed on a node of the ring (`current_node`) stays there whatever the loads,
+        so that a redeploy never leaves its old stack behind.
+        """
+        if current_node in self.weights:
+            return current_node
+        if loads is None:
+            return next(self.iter_nodes(key))
+        total_load = sum(loads.get(node, 0) for node in self.nodes) + 1
+        total_weight = sum(self.weights.values())
+        for node in self.iter_nodes(key):
+            capacity = math.ceil(load_factor * total_load * self.weights[node] / total_weight)
+            if loads.get(node, 0) < capacity:
+                return node
+        return next(self.iter_nodes(key))
+
+    def place(self, keys: Iterable[str]) -> Dict[str, str]:
+        return {key: self.get_node(key) for key in keys}
+
+
+class ModuloPlacement:
+    """
+    Placement of a key by the sum of its characters modulo the number of nodes
+    """
+
+    def __init__(self, nodes: Iterable[str]) -> None:
+        self.nodes = list(nodes)
+
+    def get_node(self, key: str) -> str:
+        return self.nodes[sum(map(ord, key)) % len(self.nodes)]
+
+
+@lru_cache(maxsize=32)
+def _get_ring(nodes: Tuple[str, ...], weights: Tuple[Tuple[str, float], ...], vnodes: int) -> HashRing:
+    return HashRing(nodes, dict(weights), vnodes)
+
+
+def get_ring(nodes: Iterable[str], weights: Optional[Dict[str, float]] = None,
+             vnodes: int = DEFAULT_VNODES) -> HashRing:
+    """
+    Return a ring of the nodes, rings are cached
+    """
+    return _get_ring(tuple(nodes), tuple(sorted((weights or {}).items())), vnodes)
+
+
+def get_moved_keys(keys: Iterable[str], old_ring: Union[HashRing, ModuloPlacement],
+                   new_ring: Union[HashRing, ModuloPlacement]) -> Dict[str, Tuple[str, str]]:
+    """
+    Return keys that would move to another node along with their (old node, new node)
+    """
+    moved = {}
+    for key in keys:
+        old_node, new_node = old_ring.get_node(key), new_ring.get_node(key)
+        if old_node != new_node:
+            moved[key] = (old_node, new_node)
+    return moved
+
+
+def report_moved_keys(keys: List[str], old_ring: Union[HashRing, ModuloPlacement],
+                      new_ring: Union[HashRing, ModuloPlacement]) -> Dict[str, Tuple[str, str]]:
+    moved = get_moved_keys(keys, old_ring, new_ring)
+    puts(f'{len(moved)} of {len(keys)} branches would move')
+    for key, (old_node, new_node) in sorted(moved.items()):
+        puts(f'{key}: {old_node} -> {new_node}')
+    return moved
@@ -0,0 +1,308 @@
+"""
+In-process HTTP and uwsgi health probes.
+
+Probes are run concurrently in a single asyncio event loop,
+probes sharing an address reuse the same keep-alive connection.
+HTTP redirects to the same address are followed (as curl -L does).
+"""
+import struct
+from collections import namedtuple, OrderedDict
+from time import monotonic
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
+from urllib.parse import quote, urljoin, urlsplit
+
+# asyncio (and ssl) are imported once probes are run, not along with the fabfile
+if TYPE_CHECKING:
+    import asyncio
+
+
+__all__ = [
+    'Probe',
+    'ProbeResult',
+    'http_probe',
+    'uwsgi_probe',
+    'run_probes',
+]
+
+MAX_REDIRECTS = 5
+REDIRECT_STATUS_CODES = (301, 302, 303, 307, 308)
+
+Probe = namedtuple('Probe', ['protocol', 'host', 'port', 'unix_sock', 'ssl', 'path',
+                             'http_host', 'status', 'timeout'])
+
+
+class ProbeResult(namedtuple('ProbeResult', ['probe', 'status_code', 'reason', 'headers', 'latency', 'error'])):
+    """
+    Result of a probe.
+
+    Quacks like a fabric command result (`succeeded`, `failed`, `stdout`)
+    so that it can be used with check_role_is_up and wait_until_role_is_up.
+    """
+
+    @property
+    def status_line(self) -> str:
+        return f'{self.status_code} {self.reason}' if self.status_code else ''
+
+    @property
+    def succeeded(self) -> bool:
+        return self.error is None and self.probe.status in self.status_line
+
+    @property
+    def failed(self) -> bool:
+        return not self.succeeded
+
+    @property
+    def stdout(self) -> str:
+        return self.error or self.status_line
+
+    def __bool__(self) -> bool:
+        return True
+
+
+def http_probe(url: str, host: Optional[str] = None, port: Optional[int] = None, unix_sock: Optional[str] = None,
+               http_host: Optional[str] = None, status: str = '200 OK', timeout: float = 5) -> Probe:
+    """
+    Probe an HTTP url.
+
+    The url host and port are connected unless an explicit host/port or a unix socket is given.
+    Redirects to the same host and scheme are followed (e.g. /health to /health/),
+    a redirect elsewhere is not and the probe fails unless the redirect status is expected.
+    """
+    parts = urlsplit(url if '//' in url else f'http://localhost{url}')
+    is_ssl = parts.scheme == 'https'
+    # curl sends non ascii paths as is, a request line has to be latin-1 though
+    path = quote(parts.path, safe="/%:@!$&'()*+,;=~") or '/'
+    if parts.query:
+        path = f'{path}?{parts.query}'
+    return Probe(protocol='http',
+                 host=host or parts.hostname,
+                 port=port or parts.port or (443 if is_ssl else 80),
+                 unix_sock=unix_sock,
+                 ssl=is_ssl,
+                 path=path,
+                 http_host=http_host or parts.netloc,
+                 status=status,
+                 timeout=timeout)
+
+
+def uwsgi_probe(url: str, host: Optional[str] = None, port: Optional[int] = None, unix_sock: Optional[str] = None,
+                http_host: Optional[str] = None, status: str = '200 OK', timeout: float = 5) -> Probe:
+    """
+    Probe a uwsgi application by its uwsgi protocol socket (same as uwsgi_curl does)
+    """
+    if not (port or unix_sock):
+        raise ValueError('either uwsgi port or socket is required')
+    parts = urlsplit(url if '//' in url else f'http://localhost{url}')
+    path = parts.path or '/'
+    if parts.query:
+        path = f'{path}?{parts.query}'
+    return Probe(protocol='uwsgi',
+                 host=host or '127.0.0.1',
+                 port=port,
+                 unix_sock=unix_sock,
+                 ssl=False,
+                 path=path,
+                 http_host=http_host or parts.netloc,
+                 status=status,
+                 timeout=timeout)
+
+
+def run_probes(probes: List[Probe]) -> List[ProbeResult]:
+    """
+    Run the probes concurrently and return their results in the same order
+    """
+    import asyncio
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(_run_probes(probes))
+    finally:
+        loop.close()
+
+
+async def _run_probes(probes: List[Probe]) -> List[ProbeResult]:
+    import asyncio
+    # http probes to the same address share a keep-alive connection
+    groups = OrderedDict()  # type: Dict[Tuple, List[int]]
+    for idx, probe in enumerate(probes):
+        if probe.protocol == 'http':
+            key = (probe.host, probe.port, probe.unix_sock, probe.ssl)
+        else:
+            key = ('uwsgi', idx)
+        groups.setdefault(key, []).append(idx)
+
+    results = [None] * len(probes)  # type: List[Optional[ProbeResult]]
+
+    async def run_group(indices: List[int]) -> None:
+        connection = None
+        try:
+            for idx in indices:
+                results[idx], connection = await _run_probe(probes[idx], connection)
+        finally:
+            if connection:
+                connection[1].close()
+
+    await asyncio.gather(*[run_group(indices) for indices in groups.values()])
+    return results
+
+
+async def _run_probe(probe: Probe, connection: Optional[Tuple]) -> Tuple[ProbeResult, Optional[Tuple]]:
+    import asyncio
+    started_at = monotonic()
+    # a failed request closes its connection (see _request)
+    try:
+        response, connection = await asyncio.wait_for(_follow_redirects(probe, connection), probe.timeout)
+    except asyncio.TimeoutError:
+        error = f'timed out after {probe.timeout} seconds'
+        return ProbeResult(probe, None, '', {}, monotonic() - started_at, error), None
+    # LimitOverrunError: a response head over the stream limit (64 KiB) or one that never ends,
+    # ValueError: a malformed response or a request that can not be encoded (UnicodeEncodeError)
+    except (OSError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError) as exc:
+        error = f'{type(exc).__name__}: {exc}'
+        return ProbeResult(probe, None, '', {}, monotonic() - started_at, error), None
+
+    status_code, reason, headers = response
+    return ProbeResult(probe, status_code, reason, headers, monotonic() - started_at, None), connection
+
+
+async def _follow_redirects(probe: Probe,
+                            connection: Optional[Tuple]) -> Tuple[Tuple[int, str, Dict[str, str]], Optional[Tuple]]:
+    request_probe = probe
+    for _ in range(MAX_REDIRECTS + 1):
+        response, connection = await _request(request_probe, connection)
+        status_code, _, headers = response
+        path = _get_redirect_path(request_probe, status_code, headers)
+        if path is None:
+            break
+        request_probe = request_probe._replace(path=path)
+    return response, connection
+
+
+def _get_redirect_path(probe: Probe, status_code: int, headers: Dict[str, str]) -> Optional[str]:
+    """
+    Path to follow a redirect to, None unless it's an unexpected redirect to the same host and scheme
+    """
+    if probe.protocol != 'http' or status_code not in REDIRECT_STATUS_CODES or 'location' not in headers:
+        return None
+    if probe.status.startswith(str(status_code)):
+        return None
+    scheme = 'https' if probe.ssl else 'http'
+    parts = urlsplit(urljoin(f'{scheme}://{probe.http_host}{probe.path}', headers['location']))
+    if parts.scheme != scheme or parts.netloc != probe.http_host:
+        return None
+    path = parts.path or '/'
+    if parts.query:
+        path = f'{path}?{parts.query}'
+    return path
+
+
+async def _open_connection(probe: Probe) -> Tuple['asyncio.StreamReader', 'asyncio.StreamWriter']:
+    import asyncio
+    if probe.unix_sock:
+        return await asyncio.open_unix_connection(probe.unix_sock)
+    return await asyncio.open_connection(probe.host, probe.port, ssl=probe.ssl or None)
+
+
+async def _request(probe: Probe,
+                   connection: Optional[Tuple]) -> Tuple[Tuple[int, str, Dict[str, str]], Optional[Tuple]]:
+    """
+    Send the request and read the response, the connection is closed unless the response is read
+    (including when the request is cancelled on timeout)
+    """
+    import asyncio
+    if probe.protocol == 'uwsgi':
+        request = _build_uwsgi_request(probe)
+    else:
+        request = _build_http_request(probe)
+
+    is_done = False
+    try:
+        if probe.protocol == 'uwsgi':
+            connection = await _open_connection(probe)
+        # an idle keep-alive connection may have been closed by the server in the meantime
+        for attempt in (1, 2):
+            if not connection:
+                connection = await _open_connection(probe)
+            reader, writer = connection
+            writer.write(request)
+            try:
+                await writer.drain()
+                response = await _read_response(reader)
+                break
+            except (ConnectionError, asyncio.IncompleteReadError):
+                writer.close()
+                connection = None
+                if attempt == 2 or probe.protocol == 'uwsgi':
+                    raise
+        is_done = True
+    finally:
+        if not is_done and connection:
+            connection[1].close()
+
+    status_code, reason, headers, keep_alive = response
+    if not keep_alive:
+        connection[1].close()
+        connection = None
+    return (status_code, reason, headers), connection
+
+
+def _build_http_request(probe: Probe) -> bytes:
+    return (f'GET {probe.path} HTTP/1.1\r\n'
+            f'Host: {probe.http_host}\r\n'
+            f'Connection: keep-alive\r\n'
+            f'User-Agent: fabric-utils\r\n'
+            f'\r\n').encode('latin-1')
+
+
+def _build_uwsgi_request(probe: Probe) -> bytes:
+    path, _, query = probe.path.partition('?')
+    variables = OrderedDict([
+        ('REQUEST_METHOD', 'GET'),
+        ('REQUEST_URI', probe.path),
+        ('PATH_INFO', path),
+        ('QUERY_STRING', query),
+        ('SERVER_PROTOCOL', 'HTTP/1.1'),
+        ('SERVER_NAME', probe.http_host.split(':')[0]),
+        ('SERVER_PORT', str(probe.port or 80)),
+        ('HTTP_HOST', probe.http_host),
+    ])
+    body = b''
+    for key, value in variables.items():
+        key, value = key.encode('latin-1'), value.encode('latin-1')
+        body += struct.pack('<H', len(key)) + key + struct.pack('<H', len(value)) + value
+    # modifier1=0 (WSGI), datasize (little endian), modifier2=0
+    return struct.pack('<BHB', 0, len(body), 0) + body
+
+
+async def _read_response(reader: 'asyncio.StreamReader') -> Tuple[int, str, Dict[str, str], bool]:
+    head = await reader.readuntil(b'\r\n\r\n')
+    status_line, *header_lines = head.decode('latin-1').rstrip('\r\n').split('\r\n')
+    version, status_code, reason = _parse_status_line(status_line)
+
+    headers = {}
+    for header_line in header_lines:
+        name, _, value = header_line.partition(':')
+        headers[name.strip().lower()] = value.strip()
+
+    keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+    # the body is drained so that the connection could be reused
+    if headers.get('transfer-encoding', '').lower() == 'chunked':
+        while True:
+            chunk_size = int((await reader.readuntil(b'\r\n')).split(b';', 1)[0], 16)
+            await reader.readexactly(chunk_size + 2)
+            if not chunk_size:
+                break
+    elif 'content-length' in headers:
+        await reader.readexactly(int(headers['content-length']))
+    elif status_code not in (204, 304):
+        await reader.read()
+        keep_alive = False
+
+    return status_code, reason, headers, keep_alive
+
+
+def _parse_status_line(status_line: str) -> Tuple[str, int, str]:
+    # HTTP/1.1 200 OK or a CGI style "Status: 200 OK" line
+    version, status_code, reason = (status_line.split(None, 2) + [''])[:3]
+    if not status_code.isdigit():
+        raise ValueError(f'malformed status line {status_line!r}')
+    return version, int(status_code), reason
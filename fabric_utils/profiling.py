@@ -0,0 +1,224 @@
+"""
+Deploy timeline profiler.
+
+Remote and local commands (and whole functions) are recorded with their host, task, wall time,
+output size and exit code, then exported as a chrome trace (chrome://tracing, ui.perfetto.dev)
+or as TeamCity build statistics.
+
+Profiling is disabled unless enable_profiling() is called
+or FABRIC_UTILS_PROFILE environment variable is set to a spans file path,
+a disabled profiler costs a single global lookup per call.
+The spans file is truncated when the run starts, subprocesses of the run append to it.
+"""
+import atexit
+import json
+import os
+import threading
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
+from functools import wraps
+from time import time, perf_counter
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+from fabric import operations
+from fabric.api import env
+
+from .ci import teamcity
+
+
+__all__ = [
+    'Profiler',
+    'Span',
+    'disable_profiling',
+    'enable_profiling',
+    'get_profiler',
+    'local',
+    'profiled',
+    'run',
+    'span',
+    'sudo',
+    'timed',
+]
+
+
+Span = namedtuple('Span', ['name', 'command', 'host', 'task', 'started_at', 'duration',
+                           'output_bytes', 'exit_code', 'pid', 'tid'])
+
+
+class Profiler:
+    """
+    Span recorder.
+
+    Spans are kept in memory, or appended to a JSON lines file if a path is given,
+    so that spans of forked workers (fabric parallel mode) end up in the same timeline.
+    """
+
+    def __init__(self, path: Optional[str] = None) -> None:
+        self.path = path
+        self._spans = []  # type: List[Span]
+        self._lock = threading.Lock()
+
+    def record(self, name: str, started_at: float, duration: float, command: Optional[str] = None,
+               output_bytes: Optional[int] = None, exit_code: Optional[int] = None) -> Span:
+        recorded_span = Span(name=name, command=command,
+                             host=env.get('host_string'), task=env.get('command'),
+                             started_at=started_at, duration=duration,
+                             output_bytes=output_bytes, exit_code=exit_code,
+                             pid=os.getpid(), tid=threading.get_ident())
+        with self._lock:
+            if self.path:
+                # a single append write, so that lines of concurrent workers don't mix
+                spans_fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+                try:
+                    os.write(spans_fd, (json.dumps(recorded_span) + '\n').encode())
+                finally:
+                    os.close(spans_fd)
+            else:
+                self._spans.append(recorded_span)
+        return recorded_span
+
+    def clear(self) -> None:
+        with self._lock:
+            self._spans = []
+            if self.path:
+                open(self.path, 'w').close()
+
+    @property
+    def spans(self) -> List[Span]:
+        if not self.path:
+            return list(self._spans)
+        if not os.path.exists(self.path):
+            return []
+        with open(self.path) as spans_file:
+            return [Span(*json.loads(line)) for line in spans_file if line.strip()]
+
+    def to_chrome_trace(self) -> Dict[str, Any]:
+        events = []
+        for recorded_span in self.spans:
+            args = OrderedDict([
+                ('host', recorded_span.host),
+                ('task', recorded_span.task),
+                ('command', recorded_span.command),
+                ('output_bytes', recorded_span.output_bytes),
+                ('exit_code', recorded_span.exit_code),
+            ])
+            events.append({
+                'name': recorded_span.name,
+                'cat': recorded_span.task or 'fabric',
+                'ph': 'X',
+                'ts': int(recorded_span.started_at * 1e6),
+                'dur': int(recorded_span.duration * 1e6),
+                'pid': recorded_span.pid,
+                'tid': recorded_span.tid,
+                'args': {key: value for key, value in args.items() if value is not None},
+            })
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def save_chrome_trace(self, filename: str) -> None:
+        with open(filename, 'w') as trace_file:
+            json.dump(self.to_chrome_trace(), trace_file)
+
+    def get_statistics(self) -> Dict[str, float]:
+        """
+        Return total seconds spent and number of calls per span name
+        """
+        statistics = OrderedDict()  # type: Dict[str, float]
+        for recorded_span in self.spans:
+            key = f'fabric.{recorded_span.name}'
+            statistics[f'{key}.seconds'] = statistics.get(f'{key}.seconds', 0) + recorded_span.duration
+            statistics[f'{key}.calls'] = statistics.get(f'{key}.calls', 0) + 1
+        return statistics
+
+    def report_teamcity(self, force: bool = False) -> None:
+        for key, value in self.get_statistics().items():
+            teamcity('buildStatisticValue', key, round(value, 3), force=force)
+
+
+_profiler = None  # type: Optional[Profiler]
+
+
+def enable_profiling(path: Optional[str] = None) -> Profiler:
+    global _profiler
+    _profiler = Profiler(path)
+    return _profiler
+
+
+def disable_profiling() -> None:
+    global _profiler
+    _profiler = None
+
+
+def get_profiler() -> Optional[Profiler]:
+    return _profiler
+
+
+def profiled(call: Callable, name: Optional[str] = None) -> Callable:
+    """
+    Instrument a command function (e.g. run, sudo, local or an injected call)
+    """
+    span_name = name or getattr(call, '__name__', 'call')
+
+    @wraps(call)
+    def wrapper(command: str, *args: Any, **kwargs: Any) -> Any:
+        profiler = _profiler
+        if profiler is None:
+            return call(command, *args, **kwargs)
+        started_at, started_counter = time(), perf_counter()
+        result = None
+        try:
+            result = call(command, *args, **kwargs)
+            return result
+        finally:
+            profiler.record(span_name, started_at, perf_counter() - started_counter, command=command,
+                            output_bytes=len(result) if isinstance(result, str) else None,
+                            exit_code=getattr(result, 'return_code', None))
+    return wrapper
+
+
+@contextmanager
+def span(name: str) -> Iterator[None]:
+    """
+    Record the block as a span
+    """
+    profiler = _profiler
+    if profiler is None:
+        yield
+        return
+    started_at, started_counter = time(), perf_counter()
+    try:
+        yield
+    finally:
+        profiler.record(name, started_at, perf_counter() - started_counter)
+
+
+def timed(func: Callable) -> Callable:
+    """
+    Record every call of the function as a span
+    """
+    @wraps(func)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        if _profiler is None:
+            return func(*args, **kwargs)
+        with span(func.__name__):
+            return func(*args, **kwargs)
+    return wrapper
+
+
+run = profiled(operations.run)
+sudo = profiled(operations.sudo)
+local = profiled(operations.local)
+
+
+def _enable_profiling_from_environment() -> None:
+    spans_path = os.environ['FABRIC_UTILS_PROFILE']
+    profiler = enable_profiling(spans_path)
+    if os.environ.get('FABRIC_UTILS_PROFILE_RUN_PID'):
+        # a subprocess of a profiled run, e.g. a nested fab command
+        return
+    os.environ['FABRIC_UTILS_PROFILE_RUN_PID'] = str(os.getpid())
+    profiler.clear()
+    atexit.register(lambda: _profiler and _profiler.save_chrome_trace(f'{spans_path}.trace.json'))
+
+
+if os.environ.get('FABRIC_UTILS_PROFILE'):
+    _enable_profiling_from_environment()
@@ -1,9 +1,35 @@
 import os
+from collections import namedtuple, OrderedDict
 from contextlib import contextmanager
+from time import time, perf_counter
+from typing import Dict, List, Optional
 
-from fabric.api import cd, sudo, settings
+from fabric.api import cd, settings, env, execute, quiet
+from fabric.task_utils import merge
 
-from .helpers import virtualenv
+from .batch import CommandBatch
+from .helpers import virtualenv, is_parallel_supported, readlink, slugify_version
+from .profiling import run, sudo
+
+
+ProjectState = namedtuple('ProjectState', ['python_version', 'env_exists', 'requirements_hash', 'links'])
+
+CommandResult = namedtuple('CommandResult', ['host', 'command', 'succeeded', 'return_code', 'stdout',
+                                             'started_at', 'duration', 'error'])
+
+
+def elect_leader(hosts: List[str]) -> Optional[str]:
+    """
+    Return the first reachable host of the list, so the same host is elected as long as it's up
+    """
+    for host in hosts:
+        with settings(quiet(), host_string=host, abort_exception=Exception):
+            try:
+                if run('true').succeeded:
+                    return host
+            except Exception:
+                continue
+    return None
 
 
 class PythonProject:
@@ -11,6 +37,8 @@ class PythonProject:
     src = None
     env = None
     user = None
+    # symlinks resolved by the state probe (e.g. the current release link)
+    state_links = ()
 
     def __init__(self, *args, **kwargs):
         pass
@@ -47,9 +75,112 @@ class PythonProject:
         with settings(sudo_user=self.user):
             yield
 
+    @property
+    def _states(self) -> Dict[str, ProjectState]:
+        # host -> state
+        return self.__dict__.setdefault('_host_states', {})
+
+    def get_state(self, refresh: bool = False) -> ProjectState:
+        """
+        Return the python version, env, installed requirements hash and state links of the current host.
+        The state is probed with a single batch of commands and kept until it's invalidated.
+        """
+        host = env.host_string
+        if refresh or host not in self._states:
+            with self.su():
+                self._states[host] = self._probe_state(CommandBatch())
+        return self._states[host]
+
+    def invalidate_state(self, all_hosts: bool = False) -> None:
+        if all_hosts:
+            self._states.clear()
+        else:
+            self._states.pop(env.host_string, None)
+
+    @contextmanager
+    def changing_state(self):
+        """Invalidate the state of the current host once the block (e.g. pip install) is done"""
+        try:
+            yield
+        finally:
+            self.invalidate_state()
+
+    def readlink(self, path: str) -> Optional[str]:
+        if path in self.state_links:
+            return self.get_state().links[path]
+        return readlink(path)
+
+    @property
+    def python_version(self) -> str:
+        """Slugified interpreter version, e.g. python_3_6_5"""
+        return slugify_version(self.get_state().python_version)
+
+    def _probe_state(self, batch: CommandBatch) -> ProjectState:
+        python = self.python if self.env else self.python_bin
+        python_version = batch.add(f'{python} --version 2>&1')
+        if self.env:
+            env_exists = batch.add(f'test -x {python}')
+            requirements_hash = batch.add(f'{python} -m pip freeze 2>/dev/null | shasum | cut -c 1-40')
+        links = OrderedDict((path, batch.add(f'readlink {path}')) for path in self.state_links)
+        batch.run()
+        return ProjectState(python_version=python_version.result().strip() or None,
+                            env_exists=env_exists.result().succeeded if self.env else None,
+                            requirements_hash=(requirements_hash.result().strip() or None) if self.env else None,
+                            links={path: link.result().strip() or None for path, link in links.items()})
+
+    def python_on_hosts(self, command: str, *, hosts: Optional[List[str]] = None, roles: Optional[List[str]] = None,
+                        concurrency: Optional[int] = None, once: bool = False) -> Dict[str, CommandResult]:
+        """
+        Run `python <command>` in the project env on the hosts and roles (the current host by default)
+        at most `concurrency` hosts at once, and return a result per host.
+
+        The `once` mode runs the command on a single elected host (e.g. for migrations).
+        Output lines are prefixed with the host they come from.
+        """
+        if hosts is None and roles is None:
+            target_hosts = [env.host_string]
+        else:
+            target_hosts = merge(hosts or [], roles or [], env.exclude_hosts, env.roledefs)
+        if once:
+            leader = elect_leader(target_hosts)
+            if leader is None:
+                return {
+                    host: CommandResult(host=host, command=command, succeeded=False, return_code=None, stdout='',
+                                        started_at=time(), duration=0, error='no host is reachable')
+                    for host in target_hosts
+                }
+            target_hosts = [leader]
+
+        parallel = concurrency != 1 and len(target_hosts) > 1 and is_parallel_supported()
+        with settings(parallel=parallel, pool_size=concurrency or 0, output_prefix=True):
+            return execute(self._run_python, command, hosts=target_hosts)
+
+    def _run_python(self, command: str) -> CommandResult:
+        started_at, started_counter = time(), perf_counter()
+        try:
+            # the env, the directory and the user are set up once for the host
+            with self.activate(), settings(warn_only=True, abort_exception=Exception):
+                result = sudo(f'python {command}')
+        except Exception as exc:
+            return CommandResult(host=env.host_string, command=command, succeeded=False, return_code=None,
+                                 stdout='', started_at=started_at, duration=perf_counter() - started_counter,
+                                 error=f'{type(exc).__name__}: {exc}')
+        return CommandResult(host=env.host_string, command=command, succeeded=result.succeeded,
+                             return_code=result.return_code, stdout=str(result), started_at=started_at,
+                             duration=perf_counter() - started_counter, error=None)
+
 
 class DjangoProject(PythonProject):
 
     def managepy(self, command):
         with self.activate(), self.su():
             return sudo(f'python manage.py {command}')
+
+    def managepy_on_hosts(self, command: str, **kwargs) -> Dict[str, CommandResult]:
+        """
+        Run a management command across hosts, e.g.
+
+            project.managepy_on_hosts('migrate --noinput', roles=['app'], once=True)
+            project.managepy_on_hosts('check --deploy', roles=['app'], concurrency=5)
+        """
+        return self.python_on_hosts(f'manage.py {command}', **kwargs)
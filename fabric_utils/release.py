@@ -1,51 +1,62 @@
 import os
 import re
-import json
 from datetime import datetime
-from functools import wraps
-from typing import List, Optional, Callable, Any
+from functools import wraps, partial
+from typing import List, Optional, Callable, Any, Iterator, Union, Dict, Tuple
 
-from fabric.api import quiet, fastprint, warn, prompt, execute, abort, settings, local
+from fabric.api import quiet, fastprint, warn, prompt, execute, abort, settings
 from collections import namedtuple, OrderedDict
 
+from .history import ReleaseHistory
+from .notifications import NotificationDispatcher
+from .profiling import profiled
+from .sentry import SentryClient, SentryError
 
-Commit = namedtuple('Commit', ['sha', 'sha_short', 'msg'])
+
+Commit = namedtuple('Commit', ['sha', 'sha_short', 'msg',
+                               'author', 'author_email', 'committed_at', 'files_changed', 'insertions', 'deletions'])
+Commit.__new__.__defaults__ = (None, None, None, 0, 0, 0)
 Release = namedtuple('Release', ['base', 'release', 'changelog'])
 
 
-def get_pending_release(call: Callable, target_rev: str, base_rev: Optional['str'] = None) -> Release:
+def get_pending_release(call: Callable, target_rev: str, base_rev: Optional['str'] = None, *,
+                        history: Optional[ReleaseHistory] = None, node: Optional[str] = None,
+                        environment: str = '', project: str = '') -> Release:
     """
     Return an ordered list of (sha,msg,diff stat) commit tuples for diff between given git revisions
     The first commit is the last commit in the local branch
-    """
-    commits = []
 
+    The commits are obtained with a single git call along with their author, date and diff stat.
+    Given a release history, the base revision defaults to the release of the project last deployed to the node
+    (or any deploy target, see with_release) if it's an ancestor of the target revision,
+    and the commits of a range of two shas are cached for the other nodes.
+    """
     teamcity_release_sha = os.environ.get('BUILD_VCS_NUMBER')
     to_revision = teamcity_release_sha or target_rev
+    last_release = None
+    if base_rev is None and history is not None and node:
+        last_release = history.get_last_release(node, environment, project=project)
+        # the range starts before the deployed commit, so that it's the base commit and the changelog is complete
+        base_rev = f'{last_release.sha}~1' if last_release else None
     from_revision = base_rev or 'HEAD~1'
 
-    with quiet():
-        git_log = _get_revision_diff(call, from_revision, to_revision)
-        if not git_log:
-            git_log = _get_revision_diff(call, f'{to_revision}~1', to_revision)
-
-        # remove empty lines and non git-log lines (such as freebsd login tips)
-        lines = []
-        accept_line = False
-        for raw_line in git_log.strip().split('\n'):
-            gitlog_line = raw_line.strip()
-            if not gitlog_line:
-                continue
-            if re.match(r'^[a-f0-9]{7,}\s', gitlog_line):
-                accept_line = True
-            if accept_line:
-                lines.append(gitlog_line)
-
-        # gather changelog
-        for commit in lines:
-            sha, msg = commit.split(None, 1)
-            sha_short = sha[:6]
-            commits.append(Commit(sha=sha, sha_short=sha_short, msg=msg))
+    # a range of symbolic revisions (e.g. origin/master) may change, so it's never cached
+    is_cacheable = history is not None and all(SHA_RE.match(rev) for rev in (from_revision, to_revision))
+    cached_commits = history.get_changelog(from_revision, to_revision) if is_cacheable else None
+    if cached_commits is not None:
+        commits = [_commit_from_dict(commit) for commit in cached_commits]
+    else:
+        with quiet():
+            if last_release and not _is_ancestor(profiled(call, 'git merge-base'), last_release.sha, to_revision):
+                # e.g. a rollback or a force push
+                warn(f'{last_release.sha} deployed to {node} is not an ancestor of {to_revision}, '
+                     f'the changelog starts from HEAD~1')
+                from_revision, is_cacheable = 'HEAD~1', False
+            git_log = _get_revision_diff(profiled(call, 'git log'), from_revision, to_revision)
+            # gather changelog
+            commits = list(_parse_git_log(git_log))
+        if is_cacheable:
+            history.save_changelog(from_revision, to_revision, [_commit_to_dict(commit) for commit in commits])
 
     base_commit = commits[-1] if commits else None
     release_commit = commits[0] if commits else None
@@ -54,8 +65,60 @@ def get_pending_release(call: Callable, target_rev: str, base_rev: Optional['str
     return Release(base=base_commit, release=release_commit, changelog=changelog_commits)
 
 
+SHA_RE = re.compile(r'^[a-f0-9]{40}(~1)?$')
+
+
+def _commit_to_dict(commit: Commit) -> Dict[str, Any]:
+    commit_dict = commit._asdict()
+    if commit.committed_at:
+        commit_dict['committed_at'] = commit.committed_at.timestamp()
+    return commit_dict
+
+
+def _commit_from_dict(commit_dict: Dict[str, Any]) -> Commit:
+    committed_at = commit_dict.get('committed_at')
+    return Commit(**dict(commit_dict, committed_at=datetime.fromtimestamp(committed_at) if committed_at else None))
+
+
+# a record separator starts every commit, its fields are separated with NUL
+GIT_LOG_FORMAT = '%x1e%H%x00%an%x00%ae%x00%ct%x00%s'
+GIT_SHORTSTAT_RE = re.compile(r'(\d+) files? changed(?:, (\d+) insertions?\(\+\))?(?:, (\d+) deletions?\(-\))?')
+
+
+def _is_ancestor(call: Callable, revision: str, to_revision: str) -> bool:
+    # an unknown revision (e.g. of another repository) is not an ancestor either
+    result = call(f'git merge-base --is-ancestor {revision} {to_revision} && echo ancestor || true')
+    return str(result).strip().endswith('ancestor')
+
+
 def _get_revision_diff(call: Callable, from_revision: str, to_revision: str) -> str:
-    return call(f'git --no-pager log --pretty=oneline --no-color --no-decorate {from_revision}..{to_revision}')
+    """
+    Return git log of the revision range (or the target revision alone if the range is empty) in one call
+    """
+    git_log = f'git --no-pager log --no-color --no-decorate --shortstat --format={GIT_LOG_FORMAT}'
+    return call(f'if [ -n "$(git rev-list -n 1 {from_revision}..{to_revision})" ]; '
+                f'then {git_log} {from_revision}..{to_revision}; '
+                f'else {git_log} {to_revision}~1..{to_revision}; fi')
+
+
+def _parse_git_log(git_log: str) -> Iterator[Commit]:
+    # anything before the first record (such as freebsd login tips) is skipped
+    records = iter(git_log.split('\x1e'))
+    next(records, None)
+    for record in records:
+        header, _, stat = record.partition('\n')
+        fields = header.strip('\r').split('\x00')
+        if len(fields) != 5 or not re.match(r'^[a-f0-9]{7,}$', fields[0]):
+            continue
+        sha, author, author_email, timestamp, msg = fields
+        files_changed, insertions, deletions = 0, 0, 0
+        stat_match = GIT_SHORTSTAT_RE.search(stat)
+        if stat_match:
+            files_changed, insertions, deletions = (int(value or 0) for value in stat_match.groups())
+        yield Commit(sha=sha, sha_short=sha[:6], msg=msg,
+                     author=author, author_email=author_email,
+                     committed_at=datetime.fromtimestamp(int(timestamp)) if timestamp.isdigit() else None,
+                     files_changed=files_changed, insertions=insertions, deletions=deletions)
 
 
 def _get_commits_for_release(commits: List[Commit], auto: bool = False) -> List[Commit]:
@@ -116,62 +179,132 @@ def with_deploy_lock(set_lock_task, delete_lock_task):
     return decorator
 
 
+def with_deploy_lease(get_lease: Callable, fence_kwarg: Optional[str] = None) -> Callable:
+    """
+    Hold a deploy lease (see fabric_utils.lease) for the node while the decorated task runs.
+    The lease is renewed in background and released with compare-and-delete.
+
+    The lease is kept in env.deploy_lease, so that the task checks it between its steps
+    (see fabric_utils.tasks.check_deploy_lease, DeploySteps check it before every step).
+    The fencing token of the lease is passed to the task as `fence_kwarg` if given,
+    e.g. to be stored along with the release and refused when it's older than the stored one.
+    """
+    def decorator(deploy_task: Callable) -> Callable:
+        @wraps(deploy_task)
+        def inner(*task_args: Any, **task_kwargs: Any) -> Any:
+            node = task_kwargs['node']
+            lease = get_lease(node=node)
+            if not lease.acquire():
+                abort(f'deploy lock is set for {lease.holder()}')
+            if fence_kwarg:
+                task_kwargs[fence_kwarg] = lease.fence
+            with settings(abort_exception=FabricException, deploy_lease=lease):
+                try:
+                    result = deploy_task(*task_args, **task_kwargs)
+                finally:
+                    if not lease.release():
+                        warn(f'deploy lock {lease.key} expired before the deploy was finished')
+            return result
+        return inner
+    return decorator
+
+
 def with_release(template: str,
                  get_release: Callable,
                  notify_release_started: Callable,
-                 notify_release_finished: Callable) -> Callable:
+                 notify_release_finished: Callable,
+                 dispatcher: Optional[NotificationDispatcher] = None,
+                 history: Optional[ReleaseHistory] = None,
+                 environment: str = '',
+                 project: str = '',
+                 target: Optional[str] = None) -> Callable:
+    """
+    Pass the release to the decorated deploy task and notify of the release start and finish.
+
+    Notifiers are called inline unless a dispatcher is given to call them in background
+    (a dispatcher with a merge window calls them once for the nodes of the same release with `nodes`).
+    The release of a successful deploy is recorded in the history (see get_pending_release)
+    for the project and the deploy target, the node by default.
+    A target that is deployed through any of its nodes (e.g. with_swarm_node) should be given,
+    e.g. the swarm role, and passed to get_pending_release as the node as well.
+    """
+    def notify(notifier: Callable, release: Release, **kwargs: Any) -> None:
+        if dispatcher:
+            release_commit = getattr(release, 'release', None)
+            merge_key = getattr(release_commit, 'sha', None)
+            dispatcher.notify(notifier, merge_key=merge_key, release=release, **kwargs)
+        else:
+            notifier(release=release, **kwargs)
+
     def decorator(func: Callable) -> Callable:
         @wraps(func)
         def wrapper(*task_args: Any, **task_kwargs: Any) -> Any:
             node = task_kwargs['node']
             release_started_at = datetime.now()
             release = get_release(node=node)
-            notify_release_started(release=release, node=node, template=template)
+            notify(notify_release_started, release=release, node=node, template=template)
             task_kwargs['release'] = release
             result = func(*task_args, **task_kwargs)
-            notify_release_finished(release=release, node=node, release_started_at=release_started_at)
+            if history is not None and getattr(release, 'release', None):
+                history.record_release(target or node, environment, release.release.sha, project=project)
+            notify(notify_release_finished, release=release, node=node, release_started_at=release_started_at)
             return result
         return wrapper
     return decorator
 
 
+_sentry_clients = {}  # type: Dict[Tuple[str, str, str], SentryClient]
+
+
+def get_sentry_client(sentry_url: str, org_id: str, api_token: str) -> SentryClient:
+    """
+    Return a client (sharing a keep-alive session) for the sentry organization
+    """
+    key = (sentry_url, org_id, api_token)
+    if key not in _sentry_clients:
+        _sentry_clients[key] = SentryClient(sentry_url, org_id, api_token)
+    return _sentry_clients[key]
+
+
 def register_sentry_release(release: Release, *, sentry_url: str, org_id: str, projects: List[str],
-                            api_token: str, environment: str, github_repo: str,
+                            api_token: str, environment: Union[str, List[str]], github_repo: str,
                             release_started_at: Optional[datetime] = None,
-                            release_finished_at: Optional[datetime] = None) -> None:
+                            release_finished_at: Optional[datetime] = None,
+                            background: bool = False) -> None:
+    """
+    Create a sentry release and register its deploy to the environment (or a list of environments).
+
+    In background mode the registration does not block the deploy,
+    it's flushed at exit or with flush_sentry_releases().
+    """
     # https://docs.sentry.io/api/releases/post-organization-releases/
-    release_id = release.release.sha_short
-    sentry_url = sentry_url.rstrip('/')
-    releases_api_url = f'{sentry_url}/api/0/organizations/{org_id}/releases/'
-
-    # create a release
-    release_data = {
-        'version': release_id,
-        'refs': [{
-            'repository': github_repo,
-            'commit': release.release.sha,
-            'previousCommit': release.base.sha,
-        }],
-        'projects': projects
-    }
-    local(f'curl {releases_api_url}'
-          f' -X POST'
-          f' -H "Authorization: Bearer {api_token}"'
-          f' -H "Content-Type: application/json"'
-          f' -d \'{json.dumps(release_data)}\'')
-
-    release_url = f'{releases_api_url}{release_id}/'
-    # register a deployment
-    deployment_data = {
-        'environment': environment,
-    }
-    if release_started_at and release_finished_at:
-        deployment_data.update({
-            'dateStarted': release_started_at.isoformat(),
-            'dateFinished': release_finished_at.isoformat(),
-        })
-    local(f'curl {release_url}deploys/'
-          f' -X POST'
-          f' -H "Authorization: Bearer {api_token}"'
-          f' -H "Content-Type: application/json"'
-          f' -d \'{json.dumps(deployment_data)}\'')
+    client = get_sentry_client(sentry_url, org_id, api_token)
+    environments = [environment] if isinstance(environment, str) else list(environment)
+    refs = [{
+        'repository': github_repo,
+        'commit': release.release.sha,
+        'previousCommit': release.base.sha,
+    }]
+    register = partial(_register_sentry_release, client, release.release.sha_short,
+                       projects=projects, environments=environments, refs=refs,
+                       started_at=release_started_at, finished_at=release_finished_at)
+    if background:
+        client.submit(register)
+    else:
+        register()
+
+
+def _register_sentry_release(client: SentryClient, version: str, **kwargs: Any) -> None:
+    try:
+        client.register_release(version, **kwargs)
+    except SentryError as exc:
+        warn(f'failed to register sentry release {version}: {exc}')
+
+
+def flush_sentry_releases(timeout: Optional[float] = None) -> None:
+    """
+    Wait for the sentry releases registered in background
+    """
+    for client in _sentry_clients.values():
+        for exc in client.flush(timeout):
+            warn(f'failed to register sentry release: {exc}')
@@ -0,0 +1,125 @@
+"""
+Sentry releases API client.
+
+Requests share a keep-alive session, failed requests are retried with an exponential backoff,
+and registrations may be run in background threads to be flushed at exit.
+"""
+import atexit
+from datetime import datetime
+from time import sleep
+from typing import TYPE_CHECKING, Any, Callable, Dict, List, Optional
+
+if TYPE_CHECKING:
+    from concurrent.futures import Future, ThreadPoolExecutor
+
+
+__all__ = [
+    'SentryClient',
+    'SentryError',
+]
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+
+class SentryError(Exception):
+    pass
+
+
+class SentryClient:
+
+    def __init__(self, sentry_url: str, org_id: str, api_token: str, *,
+                 retries: int = 3, backoff: float = 0.5, timeout: float = 10, workers: int = 4) -> None:
+        self.releases_api_url = f'{sentry_url.rstrip("/")}/api/0/organizations/{org_id}/releases/'
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.workers = workers
+        # requests (and ssl) are imported once a client is made, not along with the fabfile
+        import requests
+        self.session = requests.Session()
+        self.session.headers.update({
+            'Authorization': f'Bearer {api_token}',
+            'Content-Type': 'application/json',
+        })
+        self._executor = None  # type: Optional[ThreadPoolExecutor]
+        self._futures = []  # type: List[Future]
+
+    def post(self, url: str, data: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Post json data retrying connection errors, timeouts and 429/5xx responses
+        """
+        import requests
+        for attempt in range(self.retries + 1):
+            try:
+                response = self.session.post(url, json=data, timeout=self.timeout)
+            except (requests.ConnectionError, requests.Timeout) as exc:
+                error = f'{type(exc).__name__}: {exc}'
+            else:
+                if response.status_code not in RETRY_STATUSES:
+                    if response.status_code >= 400:
+                        raise SentryError(f'{url} responded with {response.status_code}: {response.text[:200]}')
+                    try:
+                        return response.json()
+                    except ValueError:
+                        return {}
+                error = f'{url} responded with {response.status_code}'
+            if attempt < self.retries:
+                sleep(self.backoff * 2 ** attempt)
+        raise SentryError(f'{error} (after {self.retries + 1} attempts)')
+
+    def create_release(self, version: str, *, projects: List[str],
+                       refs: Optional[List[Dict[str, str]]] = None) -> Dict[str, Any]:
+        # https://docs.sentry.io/api/releases/post-organization-releases/
+        release_data = {
+            'version': version,
+            'refs': refs or [],
+            'projects': projects,
+        }
+        return self.post(self.releases_api_url, release_data)
+
+    def create_deploy(self, version: str, environment: str,
+                      started_at: Optional[datetime] = None,
+                      finished_at: Optional[datetime] = None) -> Dict[str, Any]:
+        deployment_data = {
+            'environment': environment,
+        }
+        if started_at and finished_at:
+            deployment_data.update({
+                'dateStarted': started_at.isoformat(),
+                'dateFinished': finished_at.isoformat(),
+            })
+        return self.post(f'{self.releases_api_url}{version}/deploys/', deployment_data)
+
+    def register_release(self, version: str, *, projects: List[str], environments: List[str],
+                         refs: Optional[List[Dict[str, str]]] = None,
+                         started_at: Optional[datetime] = None,
+                         finished_at: Optional[datetime] = None) -> None:
+        """
+        Create a release and register its deploys to every environment
+        """
+        self.create_release(version, projects=projects, refs=refs)
+        for environment in environments:
+            self.create_deploy(version, environment, started_at, finished_at)
+
+    def submit(self, func: Callable, *args: Any, **kwargs: Any) -> 'Future':
+        """
+        Run a client method in a background thread, the pending calls are flushed at exit
+        """
+        if self._executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self._executor = ThreadPoolExecutor(max_workers=self.workers)
+            atexit.register(self.flush)
+        future = self._executor.submit(func, *args, **kwargs)
+        self._futures.append(future)
+        return future
+
+    def flush(self, timeout: Optional[float] = None) -> List[BaseException]:
+        """
+        Wait for the background calls and return their errors (including the calls that did not finish in time)
+        """
+        from concurrent.futures import wait
+        futures, self._futures = self._futures, []
+        done, not_done = wait(futures, timeout=timeout)
+        errors = [future.exception() for future in done if future.exception()]
+        errors.extend(SentryError('sentry call has not finished in time') for _ in not_done)
+        return errors
@@ -0,0 +1,123 @@
+"""
+Deploy steps skipped unless their inputs changed.
+
+Every step declares glob patterns of its input files (relative to the project root).
+The host keeps a manifest of the inputs each step last succeeded with,
+so a single remote call tells the paths changed per step and the steps with unchanged inputs are skipped:
+
+    steps = DeploySteps('/srv/app/.deploy-steps', root='/srv/app/src')
+
+    @steps.step('requirements*.txt')
+    def install_requirements():
+        sudo('pip install -r requirements.txt')
+
+    @steps.step('static/*', 'package*.json')
+    def build_static():
+        sudo('npm ci && npm run build')
+
+    steps.run()
+"""
+import json
+import shlex
+from collections import namedtuple, OrderedDict
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Iterator, List, Optional, Union
+
+from fabric.api import cd, puts, quiet
+from fabric.colors import green as g, yellow as y
+
+from .helpers import manifest_command
+from .profiling import sudo
+from .tasks import check_deploy_lease
+
+
+__all__ = [
+    'DeployStep',
+    'DeploySteps',
+]
+
+DeployStep = namedtuple('DeployStep', ['name', 'inputs', 'func'])
+
+
+class DeploySteps:
+
+    def __init__(self, state_dir: str, root: Optional[str] = None) -> None:
+        self.state_dir = state_dir
+        self.root = root
+        self.steps = OrderedDict()  # type: Dict[str, DeployStep]
+
+    def add(self, name: str, inputs: Iterable[str], func: Callable) -> None:
+        if '=' in name or '/' in name:
+            raise ValueError(f'invalid step name {name}')
+        self.steps[name] = DeployStep(name=name, inputs=tuple(inputs), func=func)
+
+    def step(self, *inputs: str, name: Optional[str] = None) -> Callable:
+        """
+        Register the decorated function as a step of the given input patterns
+        """
+        def decorator(func: Callable) -> Callable:
+            self.add(name or func.__name__, inputs, func)
+            return func
+        return decorator
+
+    @contextmanager
+    def _cd(self) -> Iterator[None]:
+        if self.root:
+            with cd(self.root):
+                yield
+        else:
+            yield
+
+    def get_changes(self) -> Dict[str, Optional[List[str]]]:
+        """
+        Return paths changed per step since the step last succeeded (None if it has never succeeded)
+        """
+        step_options = ' '.join(
+            f'--step {shlex.quote(step.name + "=" + ",".join(step.inputs))}'
+            for step in self.steps.values()
+        )
+        with self._cd(), quiet():
+            result = sudo(manifest_command('steps', shlex.quote(self.state_dir), step_options))
+        if result.failed:
+            raise Exception(f'failed to get changes of deploy steps: {result}')
+        # skip anything printed before the json (such as login banners)
+        return json.loads(str(result).splitlines()[-1])
+
+    def commit(self, names: List[str]) -> None:
+        """
+        Save the manifests of the steps, so that they are skipped until their inputs change
+        """
+        if not names:
+            return
+        with self._cd(), quiet():
+            sudo(manifest_command('commit', shlex.quote(self.state_dir), *(shlex.quote(name) for name in names)))
+
+    def run(self, force: Union[bool, Iterable[str]] = False) -> Dict[str, Optional[List[str]]]:
+        """
+        Run the steps whose inputs changed (and the forced ones) in order of declaration.
+
+        The manifests of the steps that succeeded are saved even if a later step fails.
+        No step is started once the deploy lease (see with_deploy_lease) is lost.
+        Return changed paths of the steps that have been run.
+        """
+        forced = set(self.steps) if force is True else set(force or ())
+        changes = self.get_changes()
+        done = []  # type: List[str]
+        ran = OrderedDict()  # type: Dict[str, Optional[List[str]]]
+        try:
+            for step in self.steps.values():
+                changed = changes.get(step.name)
+                if changed == [] and step.name not in forced:
+                    puts(g(f'skipping {step.name}, its inputs have not changed'))
+                    continue
+                if changed is None:
+                    puts(y(f'running {step.name} for the first time'))
+                else:
+                    puts(y(f'running {step.name}, {len(changed)} input(s) changed'))
+                check_deploy_lease()
+                step.func()
+                ran[step.name] = changed
+                done.append(step.name)
+        finally:
+            self.commit(done)
+        return ran
@@ -1,11 +1,23 @@
-import random
-from typing import Optional, Callable, Any
+import json
+import os
+from collections import namedtuple, deque, OrderedDict
+from time import monotonic, time, sleep
+from typing import Optional, Callable, Any, Dict, List
 from functools import wraps
 
-from fabric.api import quiet, puts, task, abort, run, settings
+from fabric.api import quiet, puts, task, abort, settings, execute, hide
 from fabric.colors import green as g, red as r, yellow as y
+from fabric.exceptions import NetworkError
+from paramiko import SSHException
 
-from fabric_utils.healthcheck import check_role_is_up
+from fabric_utils.helpers import is_parallel_supported
+from fabric_utils.profiling import run, profiled, timed
+
+
+MANAGERS_CACHE_TTL = 60
+
+# role -> {'checked_at': timestamp, 'managers': {host: latency or None if failed}}
+_managers_cache = {}  # type: Dict[str, Dict[str, Any]]
 
 
 @task
@@ -14,26 +26,105 @@ def docker_swarm_ping_manager() -> Optional[str]:
     # perhaps it's under a maintenance?
     with quiet(), settings(abort_exception=Exception, abort_on_prompts=True):
         try:
-            return run('docker node ls')
+            started_at = monotonic()
+            result = run('docker node ls')
+            result.latency = monotonic() - started_at
+            return result
         except Exception:
             return None
 
 
-def docker_swarm_select_manager(role: str) -> Optional[str]:
-    checked_hosts, stderr = check_role_is_up(docker_swarm_ping_manager, role=role)
-    if any(checked_hosts.values()):
-        good_hosts = [host for host, status in checked_hosts.items() if status]
-        puts(g(f'swarm is healthy. {len(good_hosts)}/{len(checked_hosts)} available managers: {", ".join(good_hosts)}'))
-        return random.choice(good_hosts)
+@timed
+def docker_swarm_select_manager(role: str, ttl: float = MANAGERS_CACHE_TTL,
+                                cache_path: Optional[str] = None) -> Optional[str]:
+    """
+    Pick the swarm manager that answered the fastest.
+
+    Managers health is cached for `ttl` seconds,
+    optionally on disk (`cache_path` or SWARM_MANAGERS_CACHE env variable) to be shared across fab runs.
+    """
+    cache_path = cache_path or os.environ.get('SWARM_MANAGERS_CACHE')
+    managers = _get_cached_managers(role, ttl, cache_path)
+    # all cached managers have failed since the last check
+    if managers is not None and not any(latency is not None for latency in managers.values()):
+        managers = None
+    if managers is None:
+        managers = _ping_managers(role)
+        _set_cached_managers(role, managers, cache_path)
+
+    good_hosts = {host: latency for host, latency in managers.items() if latency is not None}
+    if good_hosts:
+        puts(g(f'swarm is healthy. {len(good_hosts)}/{len(managers)} available managers: {", ".join(good_hosts)}'))
+        return min(good_hosts, key=good_hosts.get)
     else:
-        failed_hosts = ', '.join([host for host, status in checked_hosts.items() if not status])
+        failed_hosts = ', '.join(managers)
         abort(r(f'swarm is not healthy. all managers failed: {failed_hosts}'))
         return None
 
 
+def invalidate_swarm_manager(role: str, host: str, cache_path: Optional[str] = None) -> None:
+    """
+    Mark a cached manager as failed, so that it's not picked until the managers are checked again
+    """
+    cache_path = cache_path or os.environ.get('SWARM_MANAGERS_CACHE')
+    managers = _get_cached_managers(role, None, cache_path)
+    if managers and host in managers:
+        managers[host] = None
+        _set_cached_managers(role, managers, cache_path, checked_at=_managers_cache[role]['checked_at'])
+
+
+def _is_manager_up(host: str) -> bool:
+    with settings(hide('everything'), parallel=False):
+        result = execute(docker_swarm_ping_manager, hosts=[host])[host]
+    return result is not None and not result.failed
+
+
+def _ping_managers(role: str) -> Dict[str, Optional[float]]:
+    with settings(parallel=is_parallel_supported()):
+        results = execute(docker_swarm_ping_manager, role=role)
+    return {
+        host: res.latency if getattr(res, 'succeeded', False) else None
+        for host, res in results.items()
+    }
+
+
+def _get_cached_managers(role: str, ttl: Optional[float],
+                         cache_path: Optional[str]) -> Optional[Dict[str, Optional[float]]]:
+    if cache_path and os.path.exists(cache_path):
+        try:
+            with open(cache_path) as cache_file:
+                _managers_cache.update(json.load(cache_file))
+        except (OSError, ValueError):
+            pass
+    cached = _managers_cache.get(role)
+    if not cached or (ttl is not None and time() - cached['checked_at'] > ttl):
+        return None
+    return dict(cached['managers'])
+
+
+def _set_cached_managers(role: str, managers: Dict[str, Optional[float]], cache_path: Optional[str],
+                         checked_at: Optional[float] = None) -> None:
+    _managers_cache[role] = {
+        'checked_at': checked_at or time(),
+        'managers': managers,
+    }
+    if cache_path:
+        tmp_path = f'{cache_path}.{os.getpid()}'
+        with open(tmp_path, 'w') as cache_file:
+            json.dump(_managers_cache, cache_file)
+        os.replace(tmp_path, cache_path)
+
+
+ServiceRollout = namedtuple('ServiceRollout', ['service', 'state', 'elapsed'])
+
+ROLLOUT_FAILED_STATES = ('paused', 'rollback_started', 'rollback_paused', 'rollback_completed')
+
+
 @task
 def docker_swarm_restart(label: str, value: str, stack: str,
-                         no_serial: bool = False, no_wait: bool = False) -> None:
+                         no_serial: bool = False, no_wait: bool = False,
+                         concurrency: int = 1, order: Optional[str] = None,
+                         timeout: float = 600, poll_interval: float = 5) -> None:
     """
     Restart swarm services by their deploy labels defined in the compose file.
 
@@ -42,6 +133,10 @@ def docker_swarm_restart(label: str, value: str, stack: str,
     :param stack: name of the stack where the labeled service is defined
     :param no_serial: Execute the update command on all nodes at once ignoring the parallelism mode
     :param no_wait: Do not wait for currently services to exit gracefully
+    :param concurrency: number of services updated at once
+    :param order: comma separated service name parts defining the order of updates (e.g. celery,uwsgi)
+    :param timeout: seconds a service is given to converge
+    :param poll_interval: seconds between service update status checks
     """
     service_format = '{{.Name}}'
     service_names = run(f'docker stack services '
@@ -55,20 +150,134 @@ def docker_swarm_restart(label: str, value: str, stack: str,
             command = f'{command} --update-parallelism=0'
         if no_wait:
             command = f'{command} --stop-grace-period=1s'
-        for service_name in service_names.splitlines():
-            puts(y(f'restarting service {service_name}'))
-            run(f'{command} {service_name}')
+
+        concurrency = int(concurrency)
+        if concurrency <= 1 and not order:
+            for service_name in service_names.splitlines():
+                puts(y(f'restarting service {service_name}'))
+                run(f'{command} {service_name}')
+            return
+
+        service_groups = group_services(service_names.splitlines(), order.split(',') if order else [])
+        rollouts = rollout_services(run, service_groups, command,
+                                    concurrency=concurrency, timeout=float(timeout),
+                                    poll_interval=float(poll_interval))
+        for rollout in rollouts:
+            color = g if rollout.state == 'completed' else r
+            puts(color(f'{rollout.service}: {rollout.state} after {rollout.elapsed:.1f} seconds'))
+        failed_services = [rollout.service for rollout in rollouts if rollout.state != 'completed']
+        if failed_services:
+            abort(r(f'services failed to converge: {", ".join(failed_services)}'))
+
+
+def group_services(service_names: List[str], order: List[str]) -> List[List[str]]:
+    """
+    Split services into groups by the first name part they contain,
+    the services matching none of the parts form the last group.
+    """
+    groups = [[] for _ in range(len(order) + 1)]  # type: List[List[str]]
+    for service_name in service_names:
+        service_name = service_name.strip()
+        if not service_name:
+            continue
+        group_idx = next((idx for idx, part in enumerate(order) if part and part in service_name), len(order))
+        groups[group_idx].append(service_name)
+    return [group for group in groups if group]
+
+
+def rollout_services(call: Callable, service_groups: List[List[str]], update_command: str, *,
+                     concurrency: int = 1, timeout: float = 600, poll_interval: float = 5,
+                     sleep: Callable = sleep, clock: Callable = monotonic) -> List[ServiceRollout]:
+    """
+    Update services group after group, no more than `concurrency` services at once.
+
+    The updates are run detached and their convergence is tracked by polling the services update status.
+    No more services are updated once a service fails to converge in `timeout` seconds
+    (a service whose status is unknown, e.g. the status check failed, is given the same time).
+    """
+    call = profiled(call)
+    rollouts = OrderedDict()  # type: Dict[str, ServiceRollout]
+    failed = False
+
+    for group in service_groups:
+        pending = deque(group)
+        running = OrderedDict()  # type: Dict[str, float]
+
+        while running or (pending and not failed):
+            while pending and not failed and len(running) < concurrency:
+                service_name = pending.popleft()
+                puts(y(f'restarting service {service_name}'))
+                call(f'{update_command} --detach {service_name}')
+                running[service_name] = clock()
+
+            sleep(poll_interval)
+            states = _get_update_states(call, list(running))
+            for service_name, started_at in list(running.items()):
+                elapsed = clock() - started_at
+                state = states.get(service_name)
+                if state in ('completed', ''):
+                    state = 'completed'
+                elif state in ROLLOUT_FAILED_STATES or elapsed > timeout:
+                    failed = True
+                    state = state if state in ROLLOUT_FAILED_STATES else 'timeout'
+                else:
+                    continue
+                running.pop(service_name)
+                rollouts[service_name] = ServiceRollout(service_name, state, elapsed)
+
+            # stop tracking the other services as soon as one fails
+            if failed:
+                for service_name, started_at in running.items():
+                    rollouts[service_name] = ServiceRollout(service_name, 'interrupted', clock() - started_at)
+                running.clear()
+
+        if failed:
+            break
+
+    return list(rollouts.values())
+
+
+def _get_update_states(call: Callable, service_names: List[str]) -> Dict[str, str]:
+    """
+    Return update states of the services, a service left out of the output (e.g. removed) has no state
+    """
+    if not service_names:
+        return {}
+    status_format = '{{.Spec.Name}} {{if .UpdateStatus}}{{.UpdateStatus.State}}{{end}}'
+    with quiet():
+        output = call(f"docker service inspect --format '{status_format}' {' '.join(service_names)}")
+    if getattr(output, 'failed', False):
+        # inspect fails for all services when any one of them is missing, but still prints the others
+        puts(y(f'failed to check services update status: {getattr(output, "stderr", "") or output}'))
+    states = {}
+    for line in output.splitlines():
+        service_name, _, state = line.strip().partition(' ')
+        if service_name in service_names:
+            states[service_name] = state.strip()
+    return states
 
 
-def with_swarm_node(role: str) -> Callable:
+def with_swarm_node(role: str, ttl: float = MANAGERS_CACHE_TTL, cache_path: Optional[str] = None) -> Callable:
     """
-    Pick a random swarm node and pass it as a keyword arg to the decorated function
+    Pick a healthy swarm node and pass it as a keyword arg to the decorated function.
+    The node is not picked again (until the managers are checked again) if the function fails to reach it.
+    A failure of the task itself (e.g. a failed migration) leaves the node in the cache
+    as long as it still answers docker node ls.
     """
     def decorator(func: Callable) -> Callable:
         @wraps(func)
         def wrapper(*task_args: Any, **task_kwargs: Any) -> Any:
-            swarm_node = docker_swarm_select_manager(role)
+            swarm_node = docker_swarm_select_manager(role, ttl=ttl, cache_path=cache_path)
             task_kwargs['node'] = swarm_node
-            return func(*task_args, **task_kwargs)
+            try:
+                return func(*task_args, **task_kwargs)
+            except (NetworkError, SSHException, OSError, EOFError):
+                invalidate_swarm_manager(role, swarm_node, cache_path=cache_path)
+                raise
+            except (Exception, SystemExit):
+                # fabric aborts on connection errors as well
+                if not _is_manager_up(swarm_node):
+                    invalidate_swarm_manager(role, swarm_node, cache_path=cache_path)
+                raise
         return wrapper
     return decorator
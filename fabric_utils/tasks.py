@@ -1,10 +1,14 @@
-from typing import Callable
+from typing import Callable, Optional
 
-from fabric.api import puts, task
+from fabric.api import abort, env, puts, task
+
+from .lease import Lease, RedisLeaseBackend, get_redis_pool
+from .profiling import profiled
 
 
 @task
 def set_redis_lock(call: Callable, *, host: str, port: int, lock: str, user: str) -> bool:
+    call = profiled(call)
     result = call(f'redis-cli -h {host} -p {port} msetnx {lock} {user}')
     is_locked = '(integer) 0' in result.stdout
     if is_locked:
@@ -16,4 +20,23 @@ def set_redis_lock(call: Callable, *, host: str, port: int, lock: str, user: str
 
 @task
 def delete_redis_lock(call: Callable, host: str, port: int, lock: str) -> None:
+    call = profiled(call)
     call(f'redis-cli -h {host} -p {port} del {lock}')
+
+
+def get_redis_lease(*, host: str, port: int, lock: str, user: str, ttl: float = 10) -> Lease:
+    """
+    Return a lease of the lock held by the user in redis, connected to directly from this host.
+    Unlike the msetnx lock, the lease expires within `ttl` seconds once its holder is gone.
+    """
+    return Lease(RedisLeaseBackend(get_redis_pool(host, port)), lock, owner=user, ttl=ttl)
+
+
+def check_deploy_lease(lease: Optional[Lease] = None) -> None:
+    """
+    Abort the deploy if the lease (the one held by with_deploy_lease by default) has been lost,
+    called between deploy steps so that no step is started without the lock
+    """
+    lease = lease or env.get('deploy_lease')
+    if lease is not None and lease.lost:
+        abort(f'deploy lock {lease.key} is lost, the deploy is stopped')
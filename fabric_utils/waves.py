@@ -0,0 +1,142 @@
+"""
+Health-gated deploys in waves.
+
+The hosts are split into a canary wave and waves of growing size. Every wave is deployed in two phases:
+upload (anything that leaves the running release alone, e.g. code, env, static) and activate (switch and restart),
+and is promoted once its hosts pass the check task (the predicates of fabric_utils.healthcheck).
+
+The waves are pipelined: the next wave is uploaded while the previous one is activated and checked
+in the same parallel execute, so the deploy takes about a single parallel deploy plus a check per wave:
+
+    deploy_in_waves(upload, activate, partial(check_http_is_200_ok, 'http://localhost/health/'),
+                    roles=['app'], canary=1, growth=3, lease=get_redis_lease(...))
+
+A wave that fails the check aborts the deploy, the following wave stays uploaded but not activated.
+"""
+from collections import namedtuple, OrderedDict
+from time import time, perf_counter
+from typing import Callable, Dict, Iterable, List, Optional
+
+from fabric.api import abort, env, execute, puts, settings, warn
+from fabric.task_utils import merge
+
+from .healthcheck import wait_until_host_is_up
+from .helpers import is_parallel_supported
+from .lease import Lease
+from .profiling import span
+from .tasks import check_deploy_lease
+
+
+__all__ = [
+    'WaveResult',
+    'deploy_in_waves',
+    'plan_waves',
+]
+
+UPLOAD = 'upload'
+ACTIVATE = 'activate'
+
+WaveResult = namedtuple('WaveResult', ['host', 'phase', 'succeeded', 'started_at', 'duration', 'error'])
+
+
+def plan_waves(hosts: Iterable[str], canary: int = 1, growth: float = 2,
+               max_wave_size: Optional[int] = None) -> List[List[str]]:
+    """
+    Split the hosts into a canary wave of `canary` hosts and waves growing `growth` times up to `max_wave_size`
+    """
+    if canary < 1 or growth < 1:
+        raise ValueError('canary must be at least 1 host and growth at least 1')
+    hosts = list(OrderedDict.fromkeys(hosts))
+    waves = []
+    size = float(canary)
+    while hosts:
+        wave_size = int(size) if max_wave_size is None else min(int(size), max_wave_size)
+        waves.append(hosts[:wave_size])
+        hosts = hosts[wave_size:]
+        size *= growth
+    return waves
+
+
+def _run_phase(phases: Dict[str, str], upload_task: Callable, activate_task: Callable, check_task: Callable,
+               max_wait: float, poll_interval: float) -> WaveResult:
+    host = env.host_string
+    phase = phases[host]
+    started_at, started_counter = time(), perf_counter()
+    try:
+        with settings(abort_exception=Exception):
+            if phase == UPLOAD:
+                upload_task()
+                succeeded = True
+            else:
+                activate_task()
+                succeeded = wait_until_host_is_up(check_task, max_wait=max_wait, poll_interval=poll_interval)
+    except Exception as exc:
+        return WaveResult(host=host, phase=phase, succeeded=False, started_at=started_at,
+                          duration=perf_counter() - started_counter, error=f'{type(exc).__name__}: {exc}')
+    return WaveResult(host=host, phase=phase, succeeded=succeeded, started_at=started_at,
+                      duration=perf_counter() - started_counter, error=None if succeeded else 'check failed')
+
+
+def _get_wave_result(host: str, phase: str, result: object, started_at: float) -> WaveResult:
+    # a parallel worker that died (and with warn_only or skip_bad_hosts, a host that was not reached)
+    # leaves nothing or its exception instead of a result
+    if isinstance(result, WaveResult):
+        return result
+    return WaveResult(host=host, phase=phase, succeeded=False, started_at=started_at, duration=time() - started_at,
+                      error=f'{type(result).__name__}: {result}' if isinstance(result, BaseException)
+                      else f'no result from the host: {result!r}')
+
+
+def deploy_in_waves(upload_task: Callable, activate_task: Callable, check_task: Callable, *,
+                    hosts: Optional[List[str]] = None, roles: Optional[List[str]] = None,
+                    canary: int = 1, growth: float = 2, max_wave_size: Optional[int] = None, check: Callable = all,
+                    max_wait: float = 60, poll_interval: float = 3, concurrency: Optional[int] = None,
+                    lease: Optional[Lease] = None) -> Dict[str, WaveResult]:
+    """
+    Deploy the hosts and roles in waves (see plan_waves) and return the result of the activation per host.
+
+    The tasks are run on a host without arguments (bind them with functools.partial).
+    A wave is promoted when the results of the check task on its hosts pass `check` (e.g. healthcheck.quorum(0.9)),
+    each host is checked for as long as `max_wait` seconds.
+    The deploy lease (see fabric_utils.lease) is held for the whole deploy and is checked before every activation.
+    """
+    target_hosts = merge(hosts or [], roles or [], env.exclude_hosts, env.roledefs)
+    waves = plan_waves(target_hosts, canary=canary, growth=growth, max_wave_size=max_wave_size)
+    if lease is not None and not lease.acquire():
+        abort(f'deploy lock is set for {lease.holder()}')
+
+    activated = OrderedDict()  # type: Dict[str, WaveResult]
+    try:
+        # stage N activates and checks wave N-1 and uploads wave N
+        for idx in range(len(waves) + 1):
+            checked_wave = waves[idx - 1] if idx > 0 else []
+            uploaded_wave = waves[idx] if idx < len(waves) else []
+            if checked_wave:
+                check_deploy_lease(lease)
+
+            phases = OrderedDict((host, ACTIVATE) for host in checked_wave)
+            phases.update((host, UPLOAD) for host in uploaded_wave)
+            puts(f'wave {idx}: activating {len(checked_wave)} hosts, uploading {len(uploaded_wave)} hosts')
+            parallel = concurrency != 1 and len(phases) > 1 and is_parallel_supported()
+            started_at = time()
+            with span(f'wave {idx}'), settings(parallel=parallel, pool_size=concurrency or 0):
+                results = execute(_run_phase, phases, upload_task, activate_task, check_task,
+                                  max_wait=max_wait, poll_interval=poll_interval, hosts=list(phases))
+            results = {host: _get_wave_result(host, phases[host], results.get(host), started_at) for host in phases}
+
+            failed_uploads = [result for host, result in results.items()
+                              if phases[host] == UPLOAD and not result.succeeded]
+            checked = [results[host] for host in checked_wave]
+            activated.update((result.host, result) for result in checked)
+            if checked and not check(result.succeeded for result in checked):
+                failed = '\n'.join(f'{result.host}: {result.error}' for result in checked if not result.succeeded)
+                abort(f'wave {idx - 1} is not up, the deploy is stopped:\n{failed}')
+            if failed_uploads:
+                failed = '\n'.join(f'{result.host}: {result.error}' for result in failed_uploads)
+                abort(f'wave {idx} upload failed, the deploy is stopped:\n{failed}')
+            if checked:
+                puts(f'wave {idx - 1} is up ({sum(result.succeeded for result in checked)}/{len(checked)} hosts)')
+    finally:
+        if lease is not None and not lease.release():
+            warn(f'deploy lock {lease.key} expired before the deploy was finished')
+    return activated
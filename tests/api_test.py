@@ -1,4 +1,7 @@
 # coding: utf-8
+import os
+import subprocess
+import sys
 
 import pytest
 
@@ -48,3 +51,78 @@ def test_branch_to_db(branch, db_name):
 ])
 def test_branch_to_url(branch, url):
     assert branch_to_url('example.com', branch) == url
+
+
+@pytest.mark.parametrize('branch,names', [
+    ('feature/some-stuff-MYB-3456', ('myb3456', 'myb3456', 'myb3456', 'myb3456.example.com')),
+    ('feature/soMR3ALLy__feature-1', ('feature-somr3ally-feature-1', 'somr3ally-feature-1',
+                                      'featuresomr3allyfeature1', 'feature-somr3ally-feature-1.example.com')),
+    ('master', ('master', 'master', 'master', 'example.com')),
+])
+def test_branch_namer(branch, names):
+    namer = BranchNamer(domain_pattern=(r'^.*myb-?(\d+)$', r'myb\1'), base_domain='example.com')
+    assert namer.names(branch) == BranchNames(*names)
+    assert namer.names(branch) is namer.names(branch)
+
+
+def test_branch_namer_requires_base_domain_for_url():
+    with pytest.raises(ValueError):
+        BranchNamer().url('master')
+
+
+def git(cwd, *args):
+    subprocess.run(['git', *args], cwd=str(cwd), check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                   env=dict(os.environ, GIT_AUTHOR_NAME='test', GIT_AUTHOR_EMAIL='test@example.com',
+                            GIT_COMMITTER_NAME='test', GIT_COMMITTER_EMAIL='test@example.com'))
+
+
+@pytest.fixture
+def repo(tmp_path):
+    read_git_head.cache_clear()
+    git(tmp_path, 'init', '-q')
+    git(tmp_path, 'checkout', '-q', '-b', 'feature/myb-1')
+    git(tmp_path, 'commit', '-q', '--allow-empty', '-m', 'initial')
+    yield tmp_path
+    read_git_head.cache_clear()
+
+
+def rev_parse(cwd, rev):
+    return subprocess.check_output(['git', 'rev-parse', rev], cwd=str(cwd), universal_newlines=True).strip()
+
+
+def test_git_head_of_a_branch(repo):
+    (repo / 'src').mkdir()
+    assert get_active_branch_name(str(repo / 'src')) == 'feature/myb-1'
+    assert read_git_head(str(repo)).sha == rev_parse(repo, 'HEAD')
+
+
+def test_git_head_with_packed_refs(repo):
+    git(repo, 'pack-refs', '--all')
+    assert not (repo / '.git' / 'refs' / 'heads' / 'feature' / 'myb-1').exists()
+    assert read_git_head(str(repo)) == GitHead(branch='feature/myb-1', sha=rev_parse(repo, 'HEAD'))
+
+
+def test_detached_git_head(repo):
+    git(repo, 'checkout', '-q', '--detach')
+    assert get_active_branch_name(str(repo)) is None
+    assert read_git_head(str(repo)).sha == rev_parse(repo, 'HEAD')
+
+
+def test_git_head_of_a_worktree(repo, tmp_path_factory):
+    worktree = tmp_path_factory.mktemp('worktree') / 'demo'
+    git(repo, 'worktree', 'add', '-q', '-b', 'demo', str(worktree))
+    assert get_active_branch_name(str(worktree)) == 'demo'
+    assert read_git_head(str(worktree)).sha == rev_parse(repo, 'HEAD')
+
+
+def test_not_a_git_repository(tmp_path_factory):
+    assert get_active_branch_name(str(tmp_path_factory.mktemp('not-a-repo'))) is None
+
+
+@pytest.mark.parametrize('module', ['fabric_utils.release', 'fabric_utils.healthcheck', 'fabric_utils.projects'])
+def test_heavy_modules_are_imported_on_use(module):
+    pytest.importorskip('fabric.api')
+    heavy_modules = ['requests', 'asyncio', 'ssl', 'sqlite3', 'concurrent.futures']
+    script = f'import sys, {module}; print(" ".join(name for name in {heavy_modules!r} if name in sys.modules))'
+    imported = subprocess.check_output([sys.executable, '-W', 'ignore', '-c', script], universal_newlines=True)
+    assert imported.split() == []
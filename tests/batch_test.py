@@ -0,0 +1,69 @@
+# coding: utf-8
+import pickle
+import subprocess
+
+import pytest
+
+pytest.importorskip('fabric.api')
+
+from fabric_utils.batch import CommandBatch, build_batch_script, parse_batch_output, run_batch  # noqa: E402
+
+
+def bash(script):
+    return subprocess.run(['bash', '-c', script], stdout=subprocess.PIPE, universal_newlines=True).stdout
+
+
+def test_commands_are_run_with_a_single_call():
+    calls = []
+
+    def call(script):
+        calls.append(script)
+        return bash(script)
+
+    results = run_batch('echo one; echo two', 'echo oops >&2; exit 3', 'printf "no newline"', 'cd /; exit 0',
+                        'pwd', call=call)
+    assert len(calls) == 1
+    assert [str(result) for result in results] == ['one\ntwo', '', 'no newline', '', bash('pwd').strip()]
+    assert results[1].stderr == 'oops'
+    assert [result.return_code for result in results] == [0, 3, 0, 0, 0]
+    assert results[1].failed and results[0].succeeded
+    assert results[1].command == 'echo oops >&2; exit 3'
+
+
+def test_futures_are_resolved_when_the_block_is_done():
+    with CommandBatch(bash) as batch:
+        first = batch.add('echo first')
+        second = batch.add('false')
+        assert not first.done()
+    assert first.result() == 'first'
+    assert second.result().return_code == 1
+    assert len(batch) == 0
+
+
+def test_failed_call_fails_the_futures():
+    def call(script):
+        raise OSError('connection lost')
+
+    batch = CommandBatch(call)
+    future = batch.add('true')
+    with pytest.raises(OSError):
+        batch.run()
+    with pytest.raises(OSError):
+        future.result()
+
+
+def test_output_is_parsed_despite_banners_and_crlf():
+    commands = ['echo a', 'echo b']
+    output = bash(build_batch_script(commands, 'boundary')).replace('\n', '\r\n')
+    results = parse_batch_output(f'Last login: today\r\n{output}', commands + ['never run'], 'boundary')
+    assert results == ['a', 'b', '']
+    assert results[2].return_code is None
+
+
+def test_results_are_picklable():
+    result, = run_batch('echo out; echo err >&2; exit 2', call=bash)
+    result.latency = 0.5
+    unpickled = pickle.loads(pickle.dumps(result))
+    assert unpickled == 'out'
+    assert (unpickled.stderr, unpickled.return_code, unpickled.latency) == ('err', 2, 0.5)
+    assert unpickled.failed
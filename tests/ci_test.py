@@ -0,0 +1,103 @@
+# coding: utf-8
+import gc
+import io
+import os
+
+import pytest
+
+pytest.importorskip('fabric.api')
+
+from fabric.api import env, execute, hide, parallel, settings  # noqa: E402
+
+from fabric_utils import ci  # noqa: E402
+from fabric_utils.ci import TeamCityReporter  # noqa: E402
+
+
+@pytest.fixture
+def stream():
+    return io.StringIO()
+
+
+def test_disabled_reporter_writes_nothing(stream):
+    reporter = TeamCityReporter(stream, enabled=False)
+    reporter.emit('testStarted', 'deploy')
+    reporter.flush()
+    assert stream.getvalue() == ''
+
+    reporter.emit('testStarted', 'deploy', force=True)
+    reporter.flush()
+    assert stream.getvalue() == "##teamcity[testStarted name='deploy']\n"
+
+
+def test_values_are_escaped():
+    message = TeamCityReporter.format('testFailed', "it's [broken]", 'a|b\nc\r')
+    assert message == "##teamcity[testFailed name='it|'s |[broken|]' message='a||b|nc|r']"
+
+
+def test_flow_id_and_extra_attributes():
+    message = TeamCityReporter.format('testFailed', 'deploy', 'failed', flow_id='web1', details='trace')
+    assert message == "##teamcity[testFailed name='deploy' message='failed' details='trace' flowId='web1']"
+
+
+def test_single_value_and_statistic_messages():
+    assert TeamCityReporter.format('progressMessage', 'uploading') == "##teamcity[progressMessage 'uploading']"
+    assert (TeamCityReporter.format('buildStatisticValue', 'fabric.run.calls', 3) ==
+            "##teamcity[buildStatisticValue key='fabric.run.calls' value='3']")
+    assert TeamCityReporter.format('message', 'done') == "##teamcity[message text='done']"
+
+
+def test_messages_are_written_in_batches(stream):
+    reporter = TeamCityReporter(stream, enabled=True, batch_size=2)
+    reporter.emit('buildStatisticValue', 'uploaded', 1)
+    assert stream.getvalue() == ''
+    reporter.emit('buildStatisticValue', 'activated', 1)
+    assert stream.getvalue() == ("##teamcity[buildStatisticValue key='uploaded' value='1']\n"
+                                 "##teamcity[buildStatisticValue key='activated' value='1']\n")
+
+
+def test_starts_are_written_right_away(stream):
+    reporter = TeamCityReporter(stream, enabled=True)
+    reporter.emit('buildStatisticValue', 'uploaded', 1)
+    reporter.emit('blockOpened', 'activate')
+    assert stream.getvalue() == ("##teamcity[buildStatisticValue key='uploaded' value='1']\n"
+                                 "##teamcity[blockOpened name='activate']\n")
+    reporter.emit('blockClosed', 'activate')
+    assert stream.getvalue().count('\n') == 2
+
+
+def test_unsupported_message_is_skipped(stream):
+    reporter = TeamCityReporter(stream, enabled=True)
+    reporter.emit('unknownMessage', 'value')
+    reporter.flush()
+    assert stream.getvalue() == ''
+
+
+def test_reporters_are_flushed_before_a_fork_and_released(stream):
+    reporter = TeamCityReporter(stream, enabled=True)
+    reporter.emit('testFinished', 'deploy')
+    pid = os.fork()
+    if pid == 0:
+        os._exit(0)
+    os.waitpid(pid, 0)
+    assert stream.getvalue() == "##teamcity[testFinished name='deploy']\n"
+
+    reporters = len(ci._reporters)
+    for _ in range(10):
+        TeamCityReporter(io.StringIO())
+    gc.collect()
+    assert len(ci._reporters) == reporters
+
+
+def test_messages_of_parallel_tasks_are_written(tmp_path, monkeypatch):
+    path = tmp_path / 'messages'
+    with open(str(path), 'w') as stream:
+        monkeypatch.setattr(ci, '_reporter', TeamCityReporter(stream, enabled=True))
+
+        @parallel
+        def deploy():
+            ci.teamcity('buildStatus', f'{env.host_string} deployed')
+
+        with settings(hide('everything')):
+            execute(deploy, hosts=['web1', 'web2'])
+    assert sorted(path.read_text().splitlines()) == ["##teamcity[buildStatus text='web1 deployed']",
+                                                     "##teamcity[buildStatus text='web2 deployed']"]
@@ -0,0 +1,151 @@
+# coding: utf-8
+import io
+import re
+import time
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+pytest.importorskip('fabric.api')
+
+from fabric.api import env, hide, settings  # noqa: E402
+
+from fabric_utils import cleanup  # noqa: E402
+from fabric_utils.batch import BatchedResult  # noqa: E402
+from fabric_utils.ci import TeamCityReporter  # noqa: E402
+
+
+class FakeDestroy:
+    """
+    Destroys branches by writing down when they were destroyed (workers are forked, so files are used)
+    """
+
+    def __init__(self, path, failing=(), seconds=0.05):
+        self.path = path
+        self.failing = set(failing)
+        self.seconds = seconds
+
+    def __call__(self, branch_slug):
+        started_at = time.time()
+        time.sleep(self.seconds)
+        if branch_slug in self.failing:
+            raise RuntimeError(f'{branch_slug} is stuck')
+        (self.path / branch_slug).write_text(f'{started_at} {time.time()}')
+
+    def get_timings(self):
+        return {
+            path.name: tuple(float(value) for value in path.read_text().split())
+            for path in self.path.iterdir()
+        }
+
+
+@pytest.fixture
+def reporter(monkeypatch):
+    reporter = TeamCityReporter(io.StringIO(), enabled=True)
+    monkeypatch.setattr(cleanup, 'get_teamcity_reporter', lambda: reporter)
+    return reporter
+
+
+def prune(branches, destroy, **kwargs):
+    with settings(hide('everything')):
+        cleanup.prune_stale_branches(lambda days: set(branches), destroy, protected_branches=['master'], **kwargs)
+
+
+def get_messages(reporter, name):
+    return [line for line in reporter.stream.getvalue().splitlines() if line.startswith(f'##teamcity[{name} ')]
+
+
+def test_pooled_destroy_reports_failures(tmp_path, reporter):
+    destroy = FakeDestroy(tmp_path, failing=['branch-2'])
+    prune(['branch-1', 'branch-2', 'branch-3', 'master'], destroy, concurrency=3)
+
+    assert sorted(destroy.get_timings()) == ['branch-1', 'branch-3']
+    failed = get_messages(reporter, 'testFailed')
+    assert failed == ["##teamcity[testFailed name='Destroy branch-2' message='Exception: RuntimeError' "
+                      "flowId='branch-2']"]
+    assert "key='cleanup.branches.destroyed' value='2'" in reporter.stream.getvalue()
+    assert "key='cleanup.branches.failed' value='1'" in reporter.stream.getvalue()
+
+
+def test_pooled_destroy_reports_measured_durations(tmp_path, reporter):
+    destroy = FakeDestroy(tmp_path, seconds=0.2)
+    prune(['branch-1', 'branch-2'], destroy, concurrency=2)
+
+    finished = get_messages(reporter, 'testFinished')
+    assert len(finished) == 2
+    for message in finished:
+        duration = int(re.search(r"duration='(\d+)'", message).group(1))
+        assert 200 <= duration < 2000
+
+
+def test_pooled_destroy_limits_branches_per_host(tmp_path, reporter):
+    destroy = FakeDestroy(tmp_path, seconds=0.2)
+    branches = [f'branch-{idx}' for idx in range(4)]
+    prune(branches, destroy, concurrency=4, per_host_concurrency=1, get_branch_host=lambda branch_slug: 'node1')
+
+    timings = sorted(destroy.get_timings().values())
+    assert len(timings) == 4
+    # a single branch at a time is destroyed on the host
+    for (_, finished_at), (started_at, _) in zip(timings, timings[1:]):
+        assert finished_at <= started_at
+
+
+def test_sequential_destroy_reports_durations(tmp_path, reporter):
+    destroy = FakeDestroy(tmp_path, failing=['branch-2'], seconds=0.1)
+    prune(['branch-1', 'branch-2'], destroy)
+
+    assert sorted(destroy.get_timings()) == ['branch-1']
+    assert len(get_messages(reporter, 'testFailed')) == 1
+    durations = [int(re.search(r"duration='(\d+)'", message).group(1))
+                 for message in get_messages(reporter, 'testFinished')]
+    assert len(durations) == 2 and all(duration >= 100 for duration in durations)
+
+
+def test_parse_docker_timestamp():
+    assert cleanup.parse_docker_timestamp('2019-05-10 12:34:56 +0300 MSK') == datetime(
+        2019, 5, 10, 12, 34, 56, tzinfo=timezone(timedelta(hours=3)))
+    assert cleanup.parse_docker_timestamp('2023-01-02 03:04:05 -0530 NST') == datetime(
+        2023, 1, 2, 3, 4, 5, tzinfo=timezone(-timedelta(hours=5, minutes=30)))
+    assert cleanup.parse_docker_timestamp('2023-01-02 03:04:05 +0000 UTC') == datetime(
+        2023, 1, 2, 3, 4, 5, tzinfo=timezone.utc)
+
+
+def test_parse_docker_branches_keeps_the_latest_container():
+    lines = [
+        'feature-a:2019-05-10 12:34:56 +0300 MSK',
+        'feature-a:2019-05-11 08:00:00 +0300 MSK',
+        # the same moment in another time zone is not more recent
+        'feature-b:2019-05-10 10:00:00 +0000 UTC',
+        'feature-b:2019-05-10 12:00:00 +0200 CEST',
+        '',
+        # a container without the branch label
+        ':2019-05-10 12:34:56 +0300 MSK',
+    ]
+    assert cleanup.parse_docker_branches(lines) == {
+        'feature-a': datetime(2019, 5, 11, 8, tzinfo=timezone(timedelta(hours=3))),
+        'feature-b': datetime(2019, 5, 10, 10, tzinfo=timezone.utc),
+    }
+
+
+def test_branches_last_seen_are_merged_across_hosts(monkeypatch):
+    containers = {
+        'node1': 'feature-a:2019-05-10 12:00:00 +0000 UTC\nfeature-b:2019-05-01 12:00:00 +0000 UTC',
+        'node2': 'feature-a:2019-05-12 12:00:00 +0000 UTC\nfeature-c:2019-04-01 12:00:00 +0000 UTC\n',
+    }
+    monkeypatch.setattr(cleanup, 'run', lambda command: BatchedResult(command, containers[env.host_string], '', 0))
+    with settings(hide('everything')):
+        last_seen = cleanup.get_docker_branches_last_seen(project_label='project', project_name='app',
+                                                          branch_label='branch', hosts=['node1', 'node2'])
+    assert last_seen == {
+        'feature-a': datetime(2019, 5, 12, 12, tzinfo=timezone.utc),
+        'feature-b': datetime(2019, 5, 1, 12, tzinfo=timezone.utc),
+        'feature-c': datetime(2019, 4, 1, 12, tzinfo=timezone.utc),
+    }
+
+
+def test_stale_branches_of_a_single_host():
+    recent = (datetime.now(timezone.utc) - timedelta(days=1)).strftime('%Y-%m-%d %H:%M:%S +0000 UTC')
+    output = f'feature-a:2019-05-10 12:00:00 +0000 UTC\nfeature-b:{recent}\n'
+    stale = cleanup.get_stale_docker_branches(lambda command: BatchedResult(command, output, '', 0), days=7,
+                                              project_label='project', project_name='app', branch_label='branch')
+    assert stale == {'feature-a'}
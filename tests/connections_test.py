@@ -0,0 +1,160 @@
+# coding: utf-8
+import pytest
+
+pytest.importorskip('fabric.api')
+
+import fabric.network  # noqa: E402
+from fabric import state  # noqa: E402
+from fabric.api import hide, settings  # noqa: E402
+
+from fabric_utils import connections  # noqa: E402
+from fabric_utils.connections import (ConnectionPool, connection_pool, get_connection_stats,  # noqa: E402
+                                      install_connection_pool)
+
+
+class FakeTransport:
+
+    def __init__(self):
+        self.active = True
+
+    def is_active(self):
+        return self.active
+
+
+class FakeClient:
+
+    def __init__(self, key):
+        self.key = key
+        self.transport = FakeTransport()
+        self.closed = False
+
+    def get_transport(self):
+        return self.transport
+
+    def close(self):
+        self.closed = True
+        self.transport.active = False
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def opened(monkeypatch):
+    opened = []
+
+    def connect(user, host, port, cache, seek_gateway=True):
+        client = FakeClient(f'{user}@{host}:{port}')
+        opened.append(client)
+        return client
+
+    monkeypatch.setattr(fabric.network, 'connect', connect)
+    return opened
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(connections, 'monotonic', clock)
+    return clock
+
+
+def test_connections_are_reused_and_reconnected(opened, clock):
+    pool = ConnectionPool()
+    client = pool['deploy@web1:22']
+    assert pool['deploy@web1:22'] is client
+
+    client.transport.active = False
+    assert pool['deploy@web1:22'] is not client
+    assert client.closed
+    assert dict(pool.stats) == {'opened': 2, 'reused': 1, 'reconnected': 1}
+
+
+def test_idle_connections_are_evicted_when_a_connection_is_opened(opened, clock):
+    pool = ConnectionPool()
+    pool.setup(idle_timeout=60)
+    web1 = pool['deploy@web1:22']
+    clock.now += 120
+    # a lookup never evicts
+    assert pool['deploy@web1:22'] is web1
+    clock.now += 120
+    pool['deploy@web2:22']
+    assert web1.closed
+    assert list(dict.keys(pool)) == ['deploy@web2:22']
+    assert pool.stats['evicted'] == 1
+
+
+def test_connections_per_host_are_capped(opened, clock):
+    pool = ConnectionPool()
+    pool.setup(max_connections_per_host=2)
+    first = pool['deploy@web1:22']
+    clock.now += 1
+    pool['root@web1:22']
+    clock.now += 1
+    pool['app@web1:22']
+    assert first.closed
+    assert sorted(dict.keys(pool)) == ['app@web1:22', 'root@web1:22']
+
+
+def test_disconnect_all_opens_nothing(opened, clock):
+    pool = ConnectionPool()
+    pool.setup(idle_timeout=60)
+    web1, web2 = pool['deploy@web1:22'], pool['deploy@web2:22']
+    dead = pool['deploy@web3:22']
+    dead.transport.active = False
+    clock.now += 120
+
+    state.connections, saved = pool, state.connections
+    try:
+        with settings(hide('everything')):
+            fabric.network.disconnect_all()
+    finally:
+        state.connections = saved
+
+    assert len(opened) == 3
+    assert web1.closed and web2.closed
+    assert len(pool) == 0
+
+
+def test_listed_connections_are_still_reconnected(opened, clock):
+    pool = ConnectionPool()
+    web1 = pool['deploy@web1:22']
+    assert list(pool.keys()) == ['deploy@web1:22']
+    assert pool['deploy@web1:22'] is web1
+    web1.transport.active = False
+    assert pool['deploy@web1:22'] is not web1
+    assert dict(pool.stats) == {'opened': 2, 'reused': 1, 'reconnected': 1}
+
+
+def test_pool_is_installed_in_place(opened, clock):
+    cache = state.connections
+    cache['deploy@web1:22'] = client = FakeClient('deploy@web1:22')
+    try:
+        pool = install_connection_pool(max_connections_per_host=1)
+        assert pool is cache and isinstance(cache, ConnectionPool)
+        assert pool['deploy@web1:22'] is client
+        assert get_connection_stats() == {'opened': 0, 'reused': 1, 'reconnected': 0, 'evicted': 0, 'open': 1}
+    finally:
+        dict.clear(cache)
+        cache.__class__ = fabric.network.HostConnectionCache
+
+
+def test_pool_of_a_block_is_reported_and_closed(opened, clock, capsys):
+    cache = state.connections
+    with settings(hide('running')):
+        with connection_pool() as pool:
+            assert pool is cache and isinstance(cache, ConnectionPool)
+            web1 = pool['deploy@web1:22']
+            pool['deploy@web1:22']
+            with connection_pool() as nested_pool:
+                assert nested_pool is pool
+            assert not web1.closed
+    assert web1.closed
+    assert len(cache) == 0 and type(cache) is fabric.network.HostConnectionCache
+    assert 'connections opened: 1, reused: 1, reconnected: 0, evicted: 0, open: 1' in capsys.readouterr().out
@@ -0,0 +1,98 @@
+# coding: utf-8
+import pytest
+
+pytest.importorskip('fabric.api')
+
+from fabric.api import hide, settings  # noqa: E402
+
+from fabric_utils import healthcheck  # noqa: E402
+from fabric_utils.batch import BatchedResult  # noqa: E402
+
+
+class FakeClock:
+
+    def __init__(self):
+        self.now = 100.0
+        self.sleeps = []
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.sleeps.append(seconds)
+        self.now += seconds
+
+
+class FakeRole:
+    """
+    Stands for check_role_is_up, a host is up from the given check on (never if it's not listed)
+    """
+
+    def __init__(self, hosts, up_from=None):
+        self.hosts = hosts
+        self.up_from = up_from or {}
+        self.checked_hosts = []
+
+    def __call__(self, task, *task_args, hosts=None, **task_kwargs):
+        hosts = hosts or self.hosts
+        self.checked_hosts.append(list(hosts))
+        check_number = len(self.checked_hosts)
+        statuses = {host: check_number >= self.up_from.get(host, float('inf')) for host in hosts}
+        return statuses, ''
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(healthcheck, 'monotonic', clock.monotonic)
+    monkeypatch.setattr(healthcheck, 'sleep', clock.sleep)
+    return clock
+
+
+def wait(role, monkeypatch, **kwargs):
+    monkeypatch.setattr(healthcheck, 'check_role_is_up', role)
+    with settings(hide('everything')):
+        return healthcheck.wait_until_role_is_up(lambda: None, task_kwargs={'hosts': role.hosts}, **kwargs)
+
+
+def test_waiting_stops_at_the_deadline(clock, monkeypatch):
+    role = FakeRole(['app1', 'app2'])
+    with pytest.raises(SystemExit):
+        wait(role, monkeypatch, poll_interval=3, max_wait=10, initial_interval=0.5, jitter=0)
+
+    # the intervals grow up to the poll interval, the last one is cut at the deadline
+    assert clock.sleeps == [0.5, 1, 2, 3, 3, 0.5]
+    assert clock.now == 110
+    assert len(role.checked_hosts) == 7
+
+
+def test_intervals_are_jittered(clock, monkeypatch):
+    role = FakeRole(['app1'])
+    with pytest.raises(SystemExit):
+        wait(role, monkeypatch, poll_interval=2, max_wait=30, initial_interval=2, jitter=0.2)
+
+    assert all(1.6 <= seconds <= 2.4 for seconds in clock.sleeps[:-1])
+    assert len(set(clock.sleeps)) > 1
+
+
+def test_only_failed_hosts_are_checked_again(clock, monkeypatch):
+    role = FakeRole(['app1', 'app2', 'app3'], up_from={'app1': 1, 'app2': 2, 'app3': 3})
+    assert wait(role, monkeypatch, jitter=0) is True
+
+    assert role.checked_hosts == [['app1', 'app2', 'app3'], ['app2', 'app3'], ['app3']]
+    assert clock.sleeps == [0.5, 1]
+
+
+def test_quorum_is_enough(clock, monkeypatch):
+    role = FakeRole(['app1', 'app2', 'app3', 'app4'], up_from={'app1': 1, 'app2': 1, 'app3': 1})
+    assert wait(role, monkeypatch, check=healthcheck.quorum(0.75)) is True
+    assert len(role.checked_hosts) == 1
+
+
+def test_host_is_polled_until_it_is_up(clock):
+    results = iter([1, 1, 0])
+    assert healthcheck.wait_until_host_is_up(lambda: BatchedResult('curl', '', '', next(results)), jitter=0) is True
+    assert clock.sleeps == [0.5, 1]
+
+    assert healthcheck.wait_until_host_is_up(lambda: BatchedResult('curl', '', '', 1), max_wait=5, jitter=0) is False
+    assert sum(clock.sleeps[2:]) == 5
@@ -0,0 +1,78 @@
+# coding: utf-8
+import os
+import shutil
+import subprocess
+
+import pytest
+
+pytest.importorskip('fabric.api')
+
+from fabric.api import settings  # noqa: E402
+
+from fabric_utils import helpers  # noqa: E402
+from fabric_utils.batch import BatchedResult  # noqa: E402
+
+
+class LocalHost:
+    """
+    Runs commands and uploads files on this machine with the given home directory
+    """
+
+    def __init__(self, home):
+        self.home = home
+        self.uploads = []
+
+    def run(self, command, *args, **kwargs):
+        process = subprocess.run(['bash', '-c', command], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                 universal_newlines=True, env=dict(os.environ, HOME=str(self.home)))
+        return BatchedResult(command, process.stdout.strip(), process.stderr, process.returncode)
+
+    def put(self, local_path, remote_path, mode=None):
+        self.uploads.append(remote_path)
+        shutil.copy(local_path, remote_path)
+        os.chmod(remote_path, mode)
+
+
+@pytest.fixture
+def host(tmp_path, monkeypatch):
+    host = LocalHost(tmp_path)
+    monkeypatch.setattr(helpers, 'run', host.run)
+    monkeypatch.setattr(helpers, 'put', host.put)
+    monkeypatch.setattr(helpers, '_manifest_script_paths', {})
+    return host
+
+
+def test_manifest_script_is_uploaded_to_a_private_directory(host, tmp_path, monkeypatch):
+    (tmp_path / 'app.txt').write_text('app')
+    with settings(host_string='web1'):
+        command = helpers.manifest_command('root', str(tmp_path / 'app.txt'))
+        assert helpers.manifest_command('root') == command.rsplit(' ', 1)[0]
+
+    script_path, = host.uploads
+    assert os.path.dirname(script_path) == str(tmp_path / '.fabric-utils')
+    assert not os.stat(os.path.dirname(script_path)).st_mode & 0o022
+    assert host.run(command).succeeded
+
+    # another run finds the script uploaded
+    monkeypatch.setattr(helpers, '_manifest_script_paths', {})
+    with settings(host_string='web1'):
+        helpers.manifest_command('root')
+    assert len(host.uploads) == 1
+
+
+def test_modified_manifest_script_is_not_run(host, tmp_path, monkeypatch):
+    with settings(host_string='web1'):
+        command = helpers.manifest_command('root', str(tmp_path))
+    script_path, = host.uploads
+    with open(script_path, 'a') as script:
+        script.write('\nraise SystemExit("tampered")\n')
+    result = host.run(command)
+    assert result.failed
+    assert 'tampered' not in result.stderr
+
+    # the script is uploaded again once its digest does not match
+    monkeypatch.setattr(helpers, '_manifest_script_paths', {})
+    with settings(host_string='web1'):
+        helpers.manifest_command('root')
+    assert len(host.uploads) == 2
+    assert host.run(command).succeeded
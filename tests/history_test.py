@@ -0,0 +1,168 @@
+# coding: utf-8
+import os
+import sqlite3
+import subprocess
+from datetime import datetime
+
+import pytest
+
+pytest.importorskip('fabric.api')
+
+from fabric.api import hide, settings  # noqa: E402
+
+from fabric_utils.history import ReleaseHistory  # noqa: E402
+from fabric_utils.release import get_pending_release, with_release, Release  # noqa: E402
+
+
+@pytest.fixture
+def history(tmp_path):
+    release_history = ReleaseHistory(str(tmp_path / 'history.sqlite3'))
+    yield release_history
+    release_history.close()
+
+
+@pytest.fixture
+def repo(tmp_path, monkeypatch):
+    path = tmp_path / 'repo'
+    path.mkdir()
+    monkeypatch.chdir(str(path))
+    for name, value in [('GIT_AUTHOR_NAME', 'test'), ('GIT_AUTHOR_EMAIL', 'test@example.com'),
+                        ('GIT_COMMITTER_NAME', 'test'), ('GIT_COMMITTER_EMAIL', 'test@example.com')]:
+        monkeypatch.setenv(name, value)
+    subprocess.check_call(['git', 'init', '-q'])
+    shas = []
+    for idx in range(4):
+        subprocess.check_call(['git', 'commit', '-q', '--allow-empty', '-m', f'commit {idx}'])
+        shas.append(subprocess.check_output(['git', 'rev-parse', 'HEAD'], universal_newlines=True).strip())
+    return shas
+
+
+class LocalGit:
+
+    def __init__(self):
+        self.commands = []
+
+    def __call__(self, command):
+        self.commands.append(command)
+        return subprocess.check_output(command, shell=True, universal_newlines=True)
+
+
+def test_releases_are_recorded_per_node_and_environment(history):
+    history.record_release('web1', 'prod', 'a' * 40, deployed_at=datetime(2020, 1, 1))
+    history.record_release('web1', 'prod', 'b' * 40, deployed_at=datetime(2020, 1, 2))
+    history.record_release('web1', 'stage', 'c' * 40)
+    history.record_release('web2', 'prod', 'd' * 40)
+
+    assert history.get_last_release('web1', 'prod').sha == 'b' * 40
+    assert [record.sha for record in history.get_releases('web1', 'prod')] == ['b' * 40, 'a' * 40]
+    assert history.get_last_release('web3', 'prod') is None
+
+
+def test_history_is_shared_by_processes(history):
+    history.record_release('web1', 'prod', 'a' * 40)
+    pid = os.fork()
+    if not pid:
+        history.record_release('web2', 'prod', 'b' * 40)
+        os._exit(0)
+    os.waitpid(pid, 0)
+    assert history.get_last_release('web2', 'prod').sha == 'b' * 40
+
+
+def test_pending_release_starts_from_the_last_node_release(repo, history, monkeypatch):
+    monkeypatch.setenv('BUILD_VCS_NUMBER', repo[3])
+    history.record_release('web1', 'prod', repo[1])
+    call = LocalGit()
+
+    release = get_pending_release(call, 'HEAD', history=history, node='web1', environment='prod')
+    assert release.base.sha == repo[1]
+    assert release.release.sha == repo[3]
+    assert [commit.sha for commit in release.changelog] == [repo[3], repo[2]]
+    assert len(call.commands) == 2
+
+    # the other node of the same release reuses the changelog
+    history.record_release('web2', 'prod', repo[1])
+    cached_release = get_pending_release(call, 'HEAD', history=history, node='web2', environment='prod')
+    assert cached_release == release
+    assert len(call.commands) == 2
+
+
+def test_releases_are_kept_per_project(history):
+    history.record_release('manager1', 'prod', 'a' * 40, project='api')
+    history.record_release('manager1', 'prod', 'b' * 40, project='web')
+    assert history.get_last_release('manager1', 'prod', project='api').sha == 'a' * 40
+    assert history.get_last_release('manager1', 'prod', project='web').project == 'web'
+    assert history.get_last_release('manager1', 'prod') is None
+
+
+def test_history_without_projects_is_migrated(tmp_path):
+    path = str(tmp_path / 'history.sqlite3')
+    connection = sqlite3.connect(path)
+    connection.executescript("""
+        CREATE TABLE releases (id INTEGER PRIMARY KEY, node TEXT NOT NULL, environment TEXT NOT NULL,
+                               sha TEXT NOT NULL, deployed_at REAL NOT NULL);
+        CREATE INDEX releases_node ON releases (node, environment, deployed_at);
+        INSERT INTO releases (node, environment, sha, deployed_at) VALUES ('web1', 'prod', 'aaaa', 1);
+    """)
+    connection.close()
+
+    history = ReleaseHistory(path)
+    try:
+        assert history.get_last_release('web1', 'prod').sha == 'aaaa'
+        history.record_release('web1', 'prod', 'bbbb', project='web')
+        assert history.get_last_release('web1', 'prod', project='web').sha == 'bbbb'
+    finally:
+        history.close()
+
+
+def test_release_that_is_not_an_ancestor_is_not_the_base(repo, history, monkeypatch):
+    # e.g. the release of another project recorded for the node before the history was kept per project
+    branch = subprocess.check_output(['git', 'rev-parse', '--abbrev-ref', 'HEAD'], universal_newlines=True).strip()
+    subprocess.check_call(['git', 'checkout', '-q', '--orphan', 'other'])
+    for idx in range(2):
+        subprocess.check_call(['git', 'commit', '-q', '--allow-empty', '-m', f'other project {idx}'])
+    other_sha = subprocess.check_output(['git', 'rev-parse', 'HEAD'], universal_newlines=True).strip()
+    subprocess.check_call(['git', 'checkout', '-q', branch])
+    history.record_release('web1', 'prod', other_sha)
+    history.record_release('web2', 'prod', 'f' * 40)
+    monkeypatch.setenv('BUILD_VCS_NUMBER', repo[3])
+
+    with settings(hide('everything')):
+        for node in ['web1', 'web2']:
+            release = get_pending_release(LocalGit(), 'HEAD', history=history, node=node, environment='prod')
+            # the changelog starts from HEAD~1
+            assert release.base.sha == repo[3]
+            assert release.release.sha == repo[3]
+
+
+def test_with_release_records_deployed_release(repo, history):
+    commit = get_pending_release(LocalGit(), repo[3], repo[2]).release
+
+    @with_release('template', lambda node: Release(base=None, release=commit, changelog=[]),
+                  lambda **kwargs: None, lambda **kwargs: None, history=history, environment='prod')
+    def deploy(node, release):
+        return node
+
+    assert deploy(node='web1') == 'web1'
+    assert history.get_last_release('web1', 'prod').sha == repo[3]
+
+    # e.g. with_swarm_node picks any manager of the swarm
+    @with_release('template', lambda node: Release(base=None, release=commit, changelog=[]),
+                  lambda **kwargs: None, lambda **kwargs: None, history=history, environment='prod',
+                  project='web', target='swarm')
+    def deploy_stack(node, release):
+        return node
+
+    deploy_stack(node='manager2')
+    assert history.get_last_release('swarm', 'prod', project='web').sha == repo[3]
+    assert history.get_last_release('manager2', 'prod', project='web') is None
+
+
+def test_commits_are_dated_by_the_committer(repo, monkeypatch):
+    # e.g. a commit authored long ago and cherry-picked now
+    monkeypatch.setenv('GIT_AUTHOR_DATE', '2001-01-01T00:00:00+0000')
+    monkeypatch.setenv('GIT_COMMITTER_DATE', '2020-02-02T00:00:00+0000')
+    subprocess.check_call(['git', 'commit', '-q', '--allow-empty', '-m', 'cherry-picked'])
+
+    release = get_pending_release(LocalGit(), 'HEAD', repo[3])
+    assert release.release.msg == 'cherry-picked'
+    assert release.release.committed_at == datetime.fromtimestamp(1580601600)
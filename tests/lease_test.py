@@ -0,0 +1,214 @@
+# coding: utf-8
+import socket
+import socketserver
+import threading
+import time
+
+import pytest
+
+from fabric_utils.lease import (Lease, LeaseError, MemoryLeaseBackend, RedisConnection, RedisConnectionPool,
+                                RedisLeaseBackend, RENEW_SCRIPT, RELEASE_SCRIPT)
+
+
+class StubRedisHandler(socketserver.StreamRequestHandler):
+    """
+    Serves the few redis commands leases use off a MemoryLeaseBackend
+    """
+
+    def read_command(self):
+        line = self.rfile.readline()
+        if not line:
+            return None
+        args = []
+        for _ in range(int(line[1:])):
+            size = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(size + 2)[:-2].decode())
+        return args
+
+    def handle(self):
+        backend = self.server.backend
+        while True:
+            args = self.read_command()
+            if args is None:
+                return
+            self.server.commands.append(args[0])
+            command = args[0].upper()
+            if command == 'INCR':
+                reply = b':%d\r\n' % backend.next_fence(args[1][:-len(':fence')])
+            elif command == 'SET':
+                key, token, _, _, ttl_ms = args[1:]
+                reply = b'+OK\r\n' if backend.acquire(key, token, int(ttl_ms)) else b'$-1\r\n'
+            elif command == 'GET':
+                value = backend.holder(args[1])
+                reply = b'$-1\r\n' if value is None else b'$%d\r\n%s\r\n' % (len(value), value.encode())
+            elif command == 'EVAL' and args[1] == RENEW_SCRIPT:
+                reply = b':%d\r\n' % backend.renew(args[3], args[4], int(args[5]))
+            elif command == 'EVAL' and args[1] == RELEASE_SCRIPT:
+                reply = b':%d\r\n' % backend.release(args[3], args[4])
+            else:
+                reply = b'-ERR unknown command\r\n'
+            self.wfile.write(reply)
+
+
+class StubRedisServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StubRedisHandler)
+        self.backend = MemoryLeaseBackend()
+        self.commands = []
+
+
+@pytest.fixture
+def redis_backend():
+    server = StubRedisServer()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield RedisLeaseBackend(RedisConnectionPool(*server.server_address))
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture(params=['memory', 'redis'])
+def backend(request):
+    if request.param == 'memory':
+        return MemoryLeaseBackend()
+    return request.getfixturevalue('redis_backend')
+
+
+def test_lease_is_exclusive(backend):
+    lease = Lease(backend, 'deploy', owner='alice')
+    other_lease = Lease(backend, 'deploy', owner='bob')
+    assert lease.acquire()
+    assert not other_lease.acquire()
+    assert other_lease.holder() == f'{lease.fence}:alice'
+    assert lease.release()
+    assert other_lease.acquire()
+    assert other_lease.fence > lease.fence
+    other_lease.release()
+
+
+def test_lease_is_renewed(backend):
+    lease = Lease(backend, 'deploy', owner='alice', ttl=0.3)
+    with lease:
+        time.sleep(0.6)
+        assert not lease.lost
+        assert not Lease(backend, 'deploy', owner='bob').acquire()
+
+
+def test_lease_expires_without_heartbeat(backend):
+    lease = Lease(backend, 'deploy', owner='alice', ttl=0.2)
+    assert lease.acquire()
+    # the holder has crashed
+    lease._stop.set()
+    time.sleep(0.4)
+    other_lease = Lease(backend, 'deploy', owner='bob', ttl=0.2)
+    assert other_lease.acquire()
+    # the expired holder can not release somebody else's lease
+    assert not lease.release()
+    assert other_lease.holder() == other_lease.token
+    other_lease.release()
+
+
+def test_lease_context_manager(backend):
+    with Lease(backend, 'deploy', owner='alice'):
+        with pytest.raises(LeaseError):
+            with Lease(backend, 'deploy', owner='bob'):
+                pass
+    assert backend.holder('deploy') is None
+
+
+def test_redis_connections_are_reused(redis_backend):
+    pool = redis_backend.pool
+    for _ in range(3):
+        redis_backend.holder('deploy')
+    assert len(pool._idle) == 1
+
+
+def test_redis_encode():
+    assert RedisConnection.encode(('SET', 'key', 10)) == b'*3\r\n$3\r\nSET\r\n$3\r\nkey\r\n$2\r\n10\r\n'
+
+
+class OneShotRedisServer:
+    """
+    Closes every connection after a single command, with or without replying to it
+    """
+
+    def __init__(self, reply):
+        self.reply = reply
+        self.commands = []
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(5)
+        self.address = self.sock.getsockname()
+        threading.Thread(target=self.serve, daemon=True).start()
+
+    def serve(self):
+        while True:
+            try:
+                client, _ = self.sock.accept()
+            except OSError:
+                return
+            with client, client.makefile('rb') as reader:
+                line = reader.readline()
+                args = [reader.readline() and reader.readline().strip() for _ in range(int(line[1:]))]
+                self.commands.append(args[0].decode())
+                if self.reply:
+                    client.sendall(self.reply)
+
+    def close(self):
+        self.sock.close()
+
+
+def test_redis_connection_closed_by_server_is_not_reused():
+    server = OneShotRedisServer(b':1\r\n')
+    pool = RedisConnectionPool(*server.address)
+    try:
+        assert pool.execute('INCR', 'deploy:fence') == 1
+        time.sleep(0.1)
+        assert pool.execute('INCR', 'deploy:fence') == 1
+    finally:
+        server.close()
+    assert server.commands == ['INCR', 'INCR']
+
+
+def test_redis_command_is_not_sent_twice():
+    server = OneShotRedisServer(None)
+    pool = RedisConnectionPool(*server.address)
+    try:
+        with pytest.raises(ConnectionError):
+            pool.execute('INCR', 'deploy:fence')
+        time.sleep(0.1)
+    finally:
+        server.close()
+    assert server.commands == ['INCR']
+
+
+def test_deploy_lease_is_checked_and_fenced():
+    pytest.importorskip('fabric.api')
+    from fabric.api import hide, settings
+    from fabric_utils.release import with_deploy_lease
+    from fabric_utils.tasks import check_deploy_lease
+
+    backend = MemoryLeaseBackend()
+    leases = []
+    steps = []
+
+    def get_lease(node):
+        leases.append(Lease(backend, 'deploy', owner=node))
+        return leases[-1]
+
+    @with_deploy_lease(get_lease, fence_kwarg='fence')
+    def deploy(node, fence):
+        steps.append(fence)
+        check_deploy_lease()
+        steps.append('upload')
+        # e.g. the heartbeat could not renew the lease in time
+        leases[0].lost = True
+        check_deploy_lease()
+        steps.append('restart')
+
+    with settings(hide('everything')):
+        with pytest.raises(Exception, match='deploy lock deploy is lost'):
+            deploy(node='web1')
+    assert steps == [leases[0].fence, 'upload']
+    assert backend.holder('deploy') is None
@@ -0,0 +1,116 @@
+# coding: utf-8
+import json
+import os
+
+from fabric_utils.manifest import (build_manifest, diff_manifests, load_manifest, main, merkle_root, save_manifest,
+                                   select_paths)
+
+
+def make_tree(root, files):
+    for name, content in files.items():
+        path = os.path.join(root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as file:
+            file.write(content)
+
+
+def test_build_manifest_rehashes_changed_files_only(tmp_path):
+    make_tree(str(tmp_path), {'a.txt': 'a', 'static/b.css': 'b', 'static/js/c.js': 'c'})
+    paths = [str(tmp_path / 'a.txt'), str(tmp_path / 'static')]
+
+    manifest, hashed_count = build_manifest(paths)
+    assert hashed_count == 3
+    assert sorted(manifest) == sorted([paths[0], f'{paths[1]}/b.css', f'{paths[1]}/js/c.js'])
+
+    same_manifest, hashed_count = build_manifest(paths, manifest)
+    assert hashed_count == 0
+    assert merkle_root(same_manifest) == merkle_root(manifest)
+
+    make_tree(str(tmp_path), {'static/js/c.js': 'changed'})
+    changed_manifest, hashed_count = build_manifest(paths, manifest)
+    assert hashed_count == 1
+    assert merkle_root(changed_manifest) != merkle_root(manifest)
+
+
+def test_merkle_root_depends_on_paths(tmp_path):
+    make_tree(str(tmp_path), {'a': 'x', 'b': 'x'})
+    manifest, _ = build_manifest([str(tmp_path / 'a')])
+    renamed_manifest, _ = build_manifest([str(tmp_path / 'b')])
+    assert merkle_root(manifest) != merkle_root(renamed_manifest)
+    assert merkle_root({}) == merkle_root({})
+
+
+def test_symlinks_are_skipped(tmp_path):
+    make_tree(str(tmp_path), {'src/a': 'a'})
+    os.symlink(str(tmp_path / 'src' / 'a'), str(tmp_path / 'src' / 'link'))
+    manifest, _ = build_manifest([str(tmp_path / 'src')])
+    assert list(manifest) == [str(tmp_path / 'src' / 'a')]
+
+
+def test_save_and_load_manifest(tmp_path):
+    make_tree(str(tmp_path), {'a': 'a'})
+    manifest, _ = build_manifest([str(tmp_path / 'a')])
+    filename = str(tmp_path / 'manifest.json')
+    root = save_manifest(filename, manifest)
+    assert load_manifest(filename) == (manifest, root)
+    assert load_manifest(str(tmp_path / 'missing.json')) == ({}, None)
+    assert load_manifest(str(tmp_path / 'a')) == ({}, None)
+
+
+def test_check_and_update_commands(tmp_path, capsys):
+    make_tree(str(tmp_path), {'requirements.txt': 'django'})
+    filename = str(tmp_path / 'requirements.sha')
+    paths = [str(tmp_path / 'requirements.txt')]
+
+    assert main(['check', filename] + paths) == 1
+    assert main(['update', filename] + paths) == 0
+    assert main(['check', filename] + paths) == 0
+
+    make_tree(str(tmp_path), {'requirements.txt': 'django\nrequests'})
+    assert main(['check', filename] + paths) == 1
+
+    capsys.readouterr()
+    assert main(['root'] + paths) == 0
+    assert capsys.readouterr().out.strip() == merkle_root(build_manifest(paths)[0])
+
+
+def test_diff_and_select_paths(tmp_path, monkeypatch):
+    make_tree(str(tmp_path), {'a.txt': 'a', 'static/b.css': 'b', 'static/js/c.js': 'c'})
+    old, _ = build_manifest([str(tmp_path)])
+    make_tree(str(tmp_path), {'a.txt': 'changed', 'static/d.css': 'd'})
+    os.remove(str(tmp_path / 'static' / 'b.css'))
+    new, _ = build_manifest([str(tmp_path)], old)
+
+    changed_names = ['a.txt', 'static/b.css', 'static/d.css']
+    assert diff_manifests(old, new) == sorted(str(tmp_path / name) for name in changed_names)
+    assert diff_manifests(new, new) == []
+
+    monkeypatch.chdir(str(tmp_path))
+    relative, _ = build_manifest(['.'])
+    assert sorted(build_manifest(['.'], patterns=['static/*'])[0]) == ['./static/d.css', './static/js/c.js']
+    assert sorted(select_paths(relative, ['static/*'])) == ['./static/d.css', './static/js/c.js']
+    assert sorted(select_paths(relative, ['*.txt', '*.js'])) == ['./a.txt', './static/js/c.js']
+
+
+def test_steps_and_commit_commands(tmp_path, monkeypatch, capsys):
+    make_tree(str(tmp_path), {'requirements.txt': 'django', 'static/app.js': 'app'})
+    monkeypatch.chdir(str(tmp_path))
+    state_dir = str(tmp_path / '.steps')
+    step_options = ['--step', 'pip=requirements*.txt', '--step', 'static=static/*,package.json']
+
+    def get_changes():
+        capsys.readouterr()
+        assert main(['steps', state_dir] + step_options) == 0
+        return json.loads(capsys.readouterr().out)
+
+    # steps that have never been committed
+    assert get_changes() == {'pip': None, 'static': None}
+    assert main(['commit', state_dir, 'pip', 'static']) == 0
+    assert get_changes() == {'pip': [], 'static': []}
+
+    make_tree(str(tmp_path), {'static/app.js': 'changed', 'static/vendor.js': 'vendor'})
+    assert get_changes() == {'pip': [], 'static': ['static/app.js', 'static/vendor.js']}
+    # the step failed and has not been committed
+    assert get_changes() == {'pip': [], 'static': ['static/app.js', 'static/vendor.js']}
+    assert main(['commit', state_dir, 'static']) == 0
+    assert get_changes() == {'pip': [], 'static': []}
@@ -0,0 +1,116 @@
+# coding: utf-8
+import os
+import threading
+import time
+
+import pytest
+
+from fabric_utils.notifications import NotificationDispatcher
+
+
+def test_notifications_run_in_background():
+    calls = []
+    release = threading.Event()
+
+    def notify_release_started(**kwargs):
+        release.wait(5)
+        calls.append(kwargs)
+
+    dispatcher = NotificationDispatcher(workers=2)
+    started_at = time.monotonic()
+    dispatcher.notify(notify_release_started, node='web1')
+    dispatcher.notify(notify_release_started, node='web2')
+    assert time.monotonic() - started_at < 1
+    assert not dispatcher.flush(timeout=0.05)
+
+    release.set()
+    assert dispatcher.flush(timeout=5)
+    assert sorted(call['node'] for call in calls) == ['web1', 'web2']
+    assert len(dispatcher.timings['notify_release_started']) == 2
+
+
+def test_notifications_are_merged():
+    calls = []
+
+    def notify_release_finished(**kwargs):
+        calls.append(kwargs)
+
+    dispatcher = NotificationDispatcher(merge_window=0.2)
+    for node in ('web1', 'web2', 'web3'):
+        dispatcher.notify(notify_release_finished, merge_key='abcdef', node=node, release='abcdef')
+    dispatcher.notify(notify_release_finished, merge_key='012345', node='web1', release='012345')
+    assert dispatcher.flush(timeout=5)
+
+    calls_by_release = {call['release']: call for call in calls}
+    assert len(calls) == 2
+    assert calls_by_release['abcdef']['nodes'] == ['web1', 'web2', 'web3']
+    assert calls_by_release['abcdef']['node'] == 'web1'
+    assert calls_by_release['012345']['nodes'] == ['web1']
+
+
+def test_failed_notifier_does_not_stop_the_dispatcher(capsys):
+    calls = []
+
+    def broken_notifier(**kwargs):
+        raise ValueError('webhook is down')
+
+    dispatcher = NotificationDispatcher(workers=1)
+    dispatcher.notify(broken_notifier, node='web1')
+    dispatcher.notify(lambda **kwargs: calls.append(kwargs), node='web1')
+    assert dispatcher.flush(timeout=5)
+    assert calls == [{'node': 'web1'}]
+    assert [name for name, _ in dispatcher.errors] == ['broken_notifier']
+    assert 'webhook is down' in capsys.readouterr().err
+
+
+relayed_calls = []
+
+
+def notify_release_started(**kwargs):
+    relayed_calls.append(kwargs)
+
+
+def test_notifications_of_parallel_tasks_are_merged_by_the_parent():
+    pytest.importorskip('fabric.api')
+    from fabric.api import env, execute, hide, settings
+    from fabric_utils.release import Commit, Release, with_release
+
+    dispatcher = NotificationDispatcher(merge_window=0.5)
+    relayed_calls.clear()
+    release = Release(base=None, release=Commit(sha='a' * 40, sha_short='aaaaaa', msg='release'), changelog=[])
+
+    @with_release('template', lambda node: release,
+                  notify_release_started, lambda **kwargs: None, dispatcher=dispatcher)
+    def deploy(node, release):
+        return os.getpid()
+
+    def deploy_host():
+        return deploy(node=env.host_string)
+
+    with settings(hide('everything'), parallel=True):
+        pids = execute(deploy_host, hosts=['web1', 'web2', 'web3'])
+    assert os.getpid() not in pids.values()
+    assert dispatcher.flush(timeout=5)
+
+    # the nodes deployed at once get a single notification of the release
+    call, = relayed_calls
+    assert sorted(call['nodes']) == ['web1', 'web2', 'web3']
+    assert call['release'] == release
+
+
+def test_relayed_notifications_are_merged():
+    dispatcher = NotificationDispatcher(merge_window=0.5)
+    relayed_calls.clear()
+    pids = []
+    for node in ('web1', 'web2'):
+        pid = os.fork()
+        if not pid:
+            dispatcher.notify(notify_release_started, merge_key='abcdef', node=node)
+            os._exit(0)
+        pids.append(pid)
+    for pid in pids:
+        os.waitpid(pid, 0)
+    assert dispatcher.flush(timeout=5)
+
+    call, = relayed_calls
+    assert sorted(call['nodes']) == ['web1', 'web2']
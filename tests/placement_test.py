@@ -0,0 +1,117 @@
+# coding: utf-8
+from collections import Counter, namedtuple
+
+import pytest
+
+pytest.importorskip('fabric.api')
+
+from fabric_utils.helpers import with_branch_node  # noqa: E402
+from fabric_utils.placement import HashRing, ModuloPlacement, get_moved_keys, get_ring  # noqa: E402
+
+NODES = [f'node{idx}.example.com' for idx in range(1, 6)]
+BRANCHES = [f'feature/myb-{idx}' for idx in range(5000)]
+
+
+def test_keys_are_spread_over_nodes():
+    placement = HashRing(NODES).place(BRANCHES)
+    counts = Counter(placement.values())
+    assert set(counts) == set(NODES)
+    assert max(counts.values()) < 1.25 * len(BRANCHES) / len(NODES)
+
+
+def test_anagrams_are_not_placed_together():
+    ring = HashRing(NODES)
+    anagrams = ['feature/abcde', 'feature/edcba', 'feature/badce', 'feature/cabed', 'feature/dceab']
+    assert len({ring.get_node(name) for name in anagrams}) > 1
+
+
+def test_adding_a_node_moves_few_keys():
+    moved = get_moved_keys(BRANCHES, HashRing(NODES), HashRing(NODES + ['node6.example.com']))
+    assert 0 < len(moved) < 1.5 * len(BRANCHES) / 6
+    assert {new_node for _, new_node in moved.values()} == {'node6.example.com'}
+
+
+def test_weights():
+    counts = Counter(HashRing(NODES[:2], weights={NODES[0]: 3}).place(BRANCHES).values())
+    assert counts[NODES[0]] > 2 * counts[NODES[1]]
+
+
+def test_bounded_loads():
+    ring = HashRing(NODES)
+    preferred = ring.get_node('feature/new')
+    loads = {node: 10 for node in NODES}
+    assert ring.get_node('feature/new', loads) == preferred
+    loads[preferred] = 30
+    fallback = ring.get_node('feature/new', loads)
+    assert fallback != preferred
+    assert fallback == list(ring.iter_nodes('feature/new'))[1]
+
+
+def test_get_ring_is_cached():
+    assert get_ring(NODES) is get_ring(list(NODES))
+    assert get_ring(NODES) is not get_ring(NODES, weights={NODES[0]: 2})
+
+
+def test_with_branch_node_keeps_the_modulo_placement():
+    Branch = namedtuple('Branch', ['name', 'hosts'])
+
+    @with_branch_node(NODES)
+    def deploy(branch, node=None):
+        return node
+
+    for name in BRANCHES[:100]:
+        assert deploy(Branch(name=name, hosts=NODES)) == NODES[sum(map(ord, name)) % len(NODES)]
+        assert deploy(Branch(name=name, hosts=NODES)) == ModuloPlacement(NODES).get_node(name)
+
+
+def test_with_branch_node_on_the_ring():
+    Branch = namedtuple('Branch', ['name', 'hosts'])
+    loads = {node: 10 for node in NODES}
+    weights = {NODES[0]: 2}
+
+    @with_branch_node(NODES, ring=True, weights=weights, get_loads=lambda: loads, get_branch_node=lambda b: None)
+    def deploy(branch, node=None):
+        return node
+
+    branch = Branch(name='feature/myb-1', hosts=NODES)
+    ring = HashRing(NODES, weights=weights)
+    preferred = ring.get_node(branch.name)
+    assert deploy(branch) == preferred
+    loads[preferred] = 100
+    assert deploy(branch) == ring.get_node(branch.name, loads)
+    assert deploy(branch) != preferred
+
+    with pytest.raises(ValueError):
+        with_branch_node(NODES, ring=True, get_loads=lambda: loads)
+
+
+def test_redeployed_branches_keep_their_nodes():
+    Branch = namedtuple('Branch', ['name', 'hosts'])
+    placement = {}
+
+    def get_loads():
+        return Counter(placement.values())
+
+    @with_branch_node(NODES, ring=True, get_loads=get_loads, get_branch_node=lambda branch: placement.get(branch.name))
+    def deploy(branch, node=None):
+        placement[branch.name] = node
+        return node
+
+    branches = [Branch(name=name, hosts=NODES) for name in BRANCHES[:100]]
+    for branch in branches:
+        deploy(branch)
+    assert max(get_loads().values()) <= 1.25 * len(branches) / len(NODES) + 1
+
+    placed = dict(placement)
+    for branch in branches:
+        deploy(branch)
+    assert placement == placed
+
+    # a branch of a node that left the pool is placed anew
+    assert HashRing(NODES[1:]).get_node('feature/new', current_node=NODES[0]) in NODES[1:]
+
+
+def test_switching_to_the_ring_is_reported():
+    moved = get_moved_keys(BRANCHES, ModuloPlacement(NODES), HashRing(NODES))
+    assert moved
+    assert all(old_node == ModuloPlacement(NODES).get_node(key) for key, (old_node, _) in moved.items())
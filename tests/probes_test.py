@@ -0,0 +1,250 @@
+# coding: utf-8
+import asyncio
+import gc
+import socket
+import struct
+import threading
+import warnings
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn, UnixStreamServer, StreamRequestHandler
+
+import pytest
+
+from fabric_utils.probes import http_probe, uwsgi_probe, run_probes, _run_probe
+
+
+class StubHTTPHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    connections = set()
+
+    def do_GET(self):
+        self.connections.add(self.client_address)
+        if self.path in ('/health', '/moved/'):
+            location = '/health/' if self.path == '/health' else 'http://elsewhere.example/health/'
+            self.send_response(301)
+            self.send_header('Location', location)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        status = 200 if self.path.startswith('/health') else 404
+        body = f'{self.headers["Host"]} {self.path}'.encode()
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('X-Probe', 'stub')
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+class StubUwsgiHandler(StreamRequestHandler):
+    requests = []
+
+    def handle(self):
+        modifier1, size, modifier2 = struct.unpack('<BHB', self.rfile.read(4))
+        data = self.rfile.read(size)
+        variables = {}
+        while data:
+            key_size, = struct.unpack('<H', data[:2])
+            key, data = data[2:2 + key_size], data[2 + key_size:]
+            value_size, = struct.unpack('<H', data[:2])
+            value, data = data[2:2 + value_size], data[2 + value_size:]
+            variables[key.decode()] = value.decode()
+        self.requests.append(variables)
+        status = '200 OK' if variables['PATH_INFO'] == '/health/' else '500 Internal Server Error'
+        self.wfile.write(f'HTTP/1.1 {status}\r\nContent-Type: text/plain\r\n\r\nstub'.encode())
+
+
+class ThreadingUnixServer(ThreadingMixIn, UnixStreamServer):
+    daemon_threads = True
+
+
+@pytest.fixture
+def http_server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubHTTPHandler)
+    StubHTTPHandler.connections.clear()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def uwsgi_sock(tmp_path):
+    path = str(tmp_path / 'uwsgi.sock')
+    server = ThreadingUnixServer(path, StubUwsgiHandler)
+    StubUwsgiHandler.requests.clear()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield path
+    server.shutdown()
+    server.server_close()
+
+
+def test_http_probe(http_server):
+    port = http_server.server_address[1]
+    ok, not_found = run_probes([
+        http_probe('http://example.com/health/', host='127.0.0.1', port=port),
+        http_probe('/missing/', host='127.0.0.1', port=port, http_host='example.org'),
+    ])
+    assert ok.succeeded
+    assert ok.status_code == 200
+    assert ok.headers['x-probe'] == 'stub'
+    assert ok.latency > 0
+    assert not not_found.succeeded
+    assert not_found.stdout == '404 Not Found'
+
+
+def test_http_probes_share_keep_alive_connection(http_server):
+    port = http_server.server_address[1]
+    results = run_probes([http_probe('/health/', host='127.0.0.1', port=port) for _ in range(5)])
+    assert all(result.succeeded for result in results)
+    assert len(StubHTTPHandler.connections) == 1
+
+
+def test_http_probe_connection_refused():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    result, = run_probes([http_probe('/health/', host='127.0.0.1', port=port)])
+    assert not result.succeeded
+    assert result.status_code is None
+    assert 'ConnectionRefusedError' in result.error
+
+
+def test_http_probe_timeout():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(1)
+    try:
+        result, = run_probes([http_probe('/health/', host='127.0.0.1', port=sock.getsockname()[1], timeout=0.2)])
+    finally:
+        sock.close()
+    assert not result.succeeded
+    assert 'timed out' in result.error
+
+
+
+def test_http_probe_follows_redirects_to_the_same_host(http_server):
+    port = http_server.server_address[1]
+    moved, elsewhere, expected = run_probes([
+        http_probe('/health', host='127.0.0.1', port=port),
+        http_probe('/moved/', host='127.0.0.1', port=port),
+        http_probe('/health', host='127.0.0.1', port=port, status='301'),
+    ])
+    assert moved.succeeded
+    assert moved.probe.path == '/health'
+    assert not elsewhere.succeeded
+    assert elsewhere.stdout == '301 Moved Permanently'
+    assert expected.succeeded
+
+
+def test_http_probe_quotes_non_ascii_path(http_server):
+    port = http_server.server_address[1]
+    result, = run_probes([http_probe('/health/\u20ac/', host='127.0.0.1', port=port)])
+    assert result.succeeded
+    assert result.probe.path == '/health/%E2%82%AC/'
+
+
+def test_oversized_or_unencodable_requests_fail():
+    async def handle(reader, writer):
+        await reader.readuntil(b'\r\n\r\n')
+        writer.write(b'HTTP/1.1 200 OK\r\nX-Padding: ' + b'x' * 100000 + b'\r\n\r\n')
+        await writer.drain()
+        writer.close()
+
+    async def probe_oversized():
+        server = await asyncio.start_server(handle, '127.0.0.1', 0)
+        port = server.sockets[0].getsockname()[1]
+        try:
+            return await _run_probe(http_probe('/health/', host='127.0.0.1', port=port), None)
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    loop = asyncio.new_event_loop()
+    try:
+        oversized, connection = loop.run_until_complete(probe_oversized())
+    finally:
+        loop.close()
+    assert not oversized.succeeded
+    assert 'LimitOverrunError' in oversized.error
+    assert connection is None
+
+    unencodable, = run_probes([uwsgi_probe('/health/\u20ac/', host='127.0.0.1', port=1)])
+    assert not unencodable.succeeded
+    assert 'UnicodeEncodeError' in unencodable.error
+
+def test_uwsgi_probe(uwsgi_sock):
+    ok, failed = run_probes([
+        uwsgi_probe('/health/', unix_sock=uwsgi_sock, http_host='example.com'),
+        uwsgi_probe('/broken/?debug=1', unix_sock=uwsgi_sock),
+    ])
+    assert ok.succeeded
+    assert ok.headers['content-type'] == 'text/plain'
+    assert not failed.succeeded
+    assert failed.status_code == 500
+    variables = {request['PATH_INFO']: request for request in StubUwsgiHandler.requests}
+    assert variables['/health/']['HTTP_HOST'] == 'example.com'
+    assert variables['/broken/']['QUERY_STRING'] == 'debug=1'
+
+
+def test_uwsgi_probe_requires_address():
+    with pytest.raises(ValueError):
+        uwsgi_probe('/health/')
+
+
+def test_timed_out_probe_closes_its_connection():
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    sock.listen(1)
+    probe = http_probe('/health/', host='127.0.0.1', port=sock.getsockname()[1], timeout=0.2)
+
+    async def probe_and_check():
+        result, connection = await _run_probe(probe, None)
+        # the transport is closed by the loop
+        await asyncio.sleep(0.05)
+        client, _ = sock.accept()
+        client.settimeout(1)
+        try:
+            assert client.recv(1024).startswith(b'GET /health/')
+            assert client.recv(1024) == b''
+        finally:
+            client.close()
+        return result, connection
+
+    loop = asyncio.new_event_loop()
+    # a connection dropped without being closed is reported once it's garbage collected
+    with warnings.catch_warnings(record=True) as caught:
+        warnings.simplefilter('always', ResourceWarning)
+        try:
+            result, connection = loop.run_until_complete(probe_and_check())
+        finally:
+            loop.close()
+            sock.close()
+        gc.collect()
+    assert 'timed out' in result.error
+    assert connection is None
+    assert not [warning for warning in caught if issubclass(warning.category, ResourceWarning)]
+
+
+def test_direct_checks_probe_from_this_machine(http_server):
+    pytest.importorskip('fabric.api')
+    from fabric.api import settings
+    from fabric_utils.healthcheck import check_http_is_200_ok, check_uwsgi_is_200_ok
+
+    port = http_server.server_address[1]
+    with settings(host_string='127.0.0.1'):
+        assert check_http_is_200_ok(f'http://localhost:{port}/health/', direct=True).succeeded
+        with pytest.raises(ValueError):
+            check_http_is_200_ok('http://localhost/health/', unix_sock='/run/app.sock', direct=True)
+        with pytest.raises(ValueError):
+            check_uwsgi_is_200_ok('/health/', uwsgi_sock='/run/uwsgi.sock', direct=True)
+        # uwsgi listens on the loopback of the host, so the reachable address is required
+        with pytest.raises(ValueError):
+            check_uwsgi_is_200_ok('/health/', uwsgi_port=8000, direct=True)
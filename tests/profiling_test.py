@@ -0,0 +1,96 @@
+# coding: utf-8
+import json
+import os
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip('fabric.api')
+
+from fabric_utils import profiling  # noqa: E402
+
+
+class Result(str):
+    return_code = 0
+
+
+@pytest.fixture
+def profiler():
+    yield profiling.enable_profiling()
+    profiling.disable_profiling()
+
+
+def echo(command):
+    return Result(command)
+
+
+def test_disabled_profiler_records_nothing():
+    profiling.disable_profiling()
+    assert profiling.profiled(echo)('ls') == 'ls'
+    assert profiling.get_profiler() is None
+
+
+def test_profiled_call_records_a_span(profiler):
+    profiling.profiled(echo, 'shell')('ls -la')
+    recorded_span, = profiler.spans
+    assert recorded_span.name == 'shell'
+    assert recorded_span.command == 'ls -la'
+    assert recorded_span.output_bytes == len('ls -la')
+    assert recorded_span.exit_code == 0
+
+
+def test_failed_call_is_recorded(profiler):
+    def fail(command):
+        raise RuntimeError(command)
+
+    with pytest.raises(RuntimeError):
+        profiling.profiled(fail)('false')
+    assert [recorded_span.name for recorded_span in profiler.spans] == ['fail']
+
+
+def test_spans_file_is_shared(tmp_path):
+    spans_path = str(tmp_path / 'spans.jsonl')
+    profiling.enable_profiling(spans_path)
+    try:
+        profiling.timed(lambda: None)()
+        with profiling.span('upload'):
+            pass
+        # e.g. a forked worker
+        names = [recorded_span.name for recorded_span in profiling.Profiler(spans_path).spans]
+    finally:
+        profiling.disable_profiling()
+    assert names == ['<lambda>', 'upload']
+
+
+def test_statistics_and_chrome_trace(profiler):
+    profiled_echo = profiling.profiled(echo)
+    profiled_echo('a')
+    profiled_echo('b')
+
+    statistics = profiler.get_statistics()
+    assert statistics['fabric.echo.calls'] == 2
+    assert statistics['fabric.echo.seconds'] >= 0
+
+    events = profiler.to_chrome_trace()['traceEvents']
+    assert [event['args']['command'] for event in events] == ['a', 'b']
+    assert all(event['ph'] == 'X' for event in events)
+
+
+
+def test_spans_file_is_truncated_when_the_run_starts(tmp_path):
+    spans_path = tmp_path / 'spans.jsonl'
+    spans_path.write_text(json.dumps(['stale', None, None, None, 0, 0, None, None, 1, 1]) + '\n')
+
+    def profile(name, **environ):
+        environ = dict(os.environ, FABRIC_UTILS_PROFILE=str(spans_path), **environ)
+        environ.setdefault('FABRIC_UTILS_PROFILE_RUN_PID', '')
+        script = f'from fabric_utils.profiling import span\nwith span({name!r}): pass'
+        subprocess.run([sys.executable, '-c', script], env=environ, check=True)
+        return [recorded_span.name for recorded_span in profiling.Profiler(str(spans_path)).spans]
+
+    assert profile('first') == ['first']
+    assert (tmp_path / 'spans.jsonl.trace.json').exists()
+    # a subprocess of the run appends
+    assert profile('nested', FABRIC_UTILS_PROFILE_RUN_PID='1') == ['first', 'nested']
+    assert profile('second') == ['second']
@@ -0,0 +1,125 @@
+# coding: utf-8
+import subprocess
+import sys
+
+import pytest
+
+pytest.importorskip('fabric.api')
+
+from fabric.api import env, hide, settings  # noqa: E402
+
+from fabric_utils import projects  # noqa: E402
+from fabric_utils.batch import BatchedResult, CommandBatch  # noqa: E402
+from fabric_utils.projects import DjangoProject, PythonProject, ProjectState, elect_leader  # noqa: E402
+
+
+class Project(PythonProject):
+    python_bin = 'python'
+    state_links = ('/srv/app/current', '/srv/app/missing')
+
+
+def bash(script):
+    return subprocess.check_output(['bash', '-c', script], universal_newlines=True)
+
+
+def test_state_is_probed_with_a_batch(tmp_path):
+    release = tmp_path / 'release'
+    release.mkdir()
+    (tmp_path / 'current').symlink_to(release)
+
+    project = Project()
+    project.python_bin = sys.executable
+    project.state_links = (str(tmp_path / 'current'), str(tmp_path / 'missing'))
+    calls = []
+    batch = CommandBatch(lambda script: calls.append(script) or f'Welcome to the host\n{bash(script)}')
+
+    state = project._probe_state(batch)
+    assert len(calls) == 1
+    assert state.python_version.startswith('Python 3.')
+    assert state.env_exists is None
+    assert state.links == {str(tmp_path / 'current'): str(release), str(tmp_path / 'missing'): None}
+
+
+def test_state_is_cached_per_host_until_invalidated():
+    project = Project()
+    state = ProjectState(python_version='Python 3.6.5', env_exists=True, requirements_hash='abc',
+                         links={'/srv/app/current': '/srv/app/releases/1', '/srv/app/missing': None})
+    with settings(host_string='app1'):
+        project._states['app1'] = state
+        assert project.get_state() is state
+        assert project.python_version == 'python_3_6_5'
+        assert project.readlink('/srv/app/current') == '/srv/app/releases/1'
+        with project.changing_state():
+            pass
+        assert 'app1' not in project._states
+
+
+class FakeHosts:
+    """
+    Records the commands run on the hosts, the unreachable hosts fail to connect and the failing ones exit with 1
+    """
+
+    def __init__(self, unreachable=(), failing=()):
+        self.unreachable = set(unreachable)
+        self.failing = set(failing)
+        self.calls = []
+
+    def __call__(self, command, *args, **kwargs):
+        if env.host_string in self.unreachable:
+            raise Exception(f'{env.host_string} is unreachable')
+        self.calls.append((env.host_string, command, env.cwd, env.sudo_user, env.path))
+        return BatchedResult(command, 'done', '', 1 if env.host_string in self.failing else 0)
+
+
+class App(DjangoProject):
+    src = '/srv/app/src'
+    env = '/srv/app/env'
+    user = 'app'
+
+
+def test_first_reachable_host_is_elected(monkeypatch):
+    fake_hosts = FakeHosts(unreachable=['app1'])
+    monkeypatch.setattr(projects, 'run', fake_hosts)
+    with settings(hide('everything')):
+        assert elect_leader(['app1', 'app2', 'app3']) == 'app2'
+        assert elect_leader(['app1', 'app2', 'app3']) == 'app2'
+        assert elect_leader(['app1']) is None
+    assert [call[0] for call in fake_hosts.calls] == ['app2', 'app2']
+
+
+def test_command_is_run_in_the_project_env_on_every_host(monkeypatch):
+    fake_hosts = FakeHosts(failing=['app2'])
+    monkeypatch.setattr(projects, 'sudo', fake_hosts)
+    with settings(hide('everything')):
+        results = App().managepy_on_hosts('check --deploy', hosts=['app1', 'app2'], concurrency=1)
+
+    assert list(results) == ['app1', 'app2']
+    assert results['app1'].succeeded and results['app1'].stdout == 'done'
+    assert not results['app2'].succeeded and results['app2'].return_code == 1
+    assert fake_hosts.calls == [
+        (host, 'python manage.py check --deploy', '/srv/app/src', 'app', '/srv/app/env/bin')
+        for host in ['app1', 'app2']
+    ]
+
+
+def test_command_is_run_once_on_the_elected_host(monkeypatch):
+    monkeypatch.setattr(projects, 'run', FakeHosts(unreachable=['app1']))
+    fake_hosts = FakeHosts()
+    monkeypatch.setattr(projects, 'sudo', fake_hosts)
+    with settings(hide('everything')):
+        results = App().managepy_on_hosts('migrate --noinput', hosts=['app1', 'app2', 'app3'], once=True)
+        assert list(results) == ['app2']
+        assert [call[:2] for call in fake_hosts.calls] == [('app2', 'python manage.py migrate --noinput')]
+
+        monkeypatch.setattr(projects, 'run', FakeHosts(unreachable=['app1', 'app2']))
+        results = App().python_on_hosts('-V', hosts=['app1', 'app2'], once=True)
+    assert {host: result.error for host, result in results.items()} == {
+        'app1': 'no host is reachable', 'app2': 'no host is reachable'}
+
+
+def test_failure_to_connect_is_a_failed_result(monkeypatch):
+    monkeypatch.setattr(projects, 'sudo', FakeHosts(unreachable=['app1']))
+    with settings(hide('everything'), host_string='app1'):
+        result, = App().python_on_hosts('-V').values()
+    assert not result.succeeded
+    assert result.error == 'Exception: app1 is unreachable'
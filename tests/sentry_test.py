@@ -0,0 +1,113 @@
+# coding: utf-8
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+
+import pytest
+
+pytest.importorskip('requests')
+
+from fabric_utils.sentry import SentryClient, SentryError  # noqa: E402
+
+
+class StubSentryHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_POST(self):
+        server = self.server
+        data = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        server.requests.append((self.path, self.headers['Authorization'], data, self.client_address))
+        if server.failures:
+            server.failures -= 1
+            status = 503
+        else:
+            status = server.status
+        body = json.dumps({'ok': True}).encode()
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class StubSentryServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(('127.0.0.1', 0), StubSentryHandler)
+        self.requests = []
+        self.failures = 0
+        self.status = 201
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}/'
+
+
+@pytest.fixture
+def sentry_server():
+    server = StubSentryServer()
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def test_register_release(sentry_server):
+    client = SentryClient(sentry_server.url, 'mybook', 'token')
+    client.register_release('abcdef', projects=['web', 'api'], environments=['production', 'staging'],
+                            refs=[{'repository': 'mybook/web', 'commit': 'abcdef0'}])
+    paths = [path for path, *_ in sentry_server.requests]
+    assert paths == [
+        '/api/0/organizations/mybook/releases/',
+        '/api/0/organizations/mybook/releases/abcdef/deploys/',
+        '/api/0/organizations/mybook/releases/abcdef/deploys/',
+    ]
+    assert {auth for _, auth, _, _ in sentry_server.requests} == {'Bearer token'}
+    assert sentry_server.requests[0][2]['projects'] == ['web', 'api']
+    assert [data['environment'] for _, _, data, _ in sentry_server.requests[1:]] == ['production', 'staging']
+    # the requests share a keep-alive connection
+    assert len({address for *_, address in sentry_server.requests}) == 1
+
+
+def test_retry_with_backoff(sentry_server):
+    sentry_server.failures = 2
+    client = SentryClient(sentry_server.url, 'mybook', 'token', backoff=0.01)
+    assert client.create_release('abcdef', projects=['web']) == {'ok': True}
+    assert len(sentry_server.requests) == 3
+
+
+def test_retries_exhausted(sentry_server):
+    sentry_server.failures = 10
+    client = SentryClient(sentry_server.url, 'mybook', 'token', retries=1, backoff=0.01)
+    with pytest.raises(SentryError):
+        client.create_release('abcdef', projects=['web'])
+    assert len(sentry_server.requests) == 2
+
+
+def test_client_errors_are_not_retried(sentry_server):
+    sentry_server.status = 400
+    client = SentryClient(sentry_server.url, 'mybook', 'token', backoff=0.01)
+    with pytest.raises(SentryError):
+        client.create_release('abcdef', projects=['web'])
+    assert len(sentry_server.requests) == 1
+
+
+def test_background_registration(sentry_server):
+    client = SentryClient(sentry_server.url, 'mybook', 'token')
+    for environment in ('production', 'staging'):
+        client.submit(client.create_deploy, 'abcdef', environment)
+    assert client.flush(timeout=5) == []
+    assert len(sentry_server.requests) == 2
+
+
+def test_background_registration_errors(sentry_server):
+    sentry_server.status = 403
+    client = SentryClient(sentry_server.url, 'mybook', 'token')
+    client.submit(client.create_release, 'abcdef', projects=['web'])
+    errors = client.flush(timeout=5)
+    assert len(errors) == 1
+    assert isinstance(errors[0], SentryError)
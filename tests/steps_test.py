@@ -0,0 +1,99 @@
+# coding: utf-8
+import os
+import shutil
+import subprocess
+
+import pytest
+
+pytest.importorskip('fabric.api')
+
+from fabric.api import env, hide, settings  # noqa: E402
+
+from fabric_utils import helpers, steps  # noqa: E402
+from fabric_utils.batch import BatchedResult  # noqa: E402
+from fabric_utils.steps import DeploySteps  # noqa: E402
+
+
+class LocalHost:
+    """
+    Runs commands (in the directory set by cd) and uploads files on this machine with the given home directory
+    """
+
+    def __init__(self, home):
+        self.home = home
+
+    def run(self, command, *args, **kwargs):
+        if env.cwd:
+            command = f'cd {env.cwd} && {command}'
+        process = subprocess.run(['bash', '-c', command], stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+                                 universal_newlines=True, env=dict(os.environ, HOME=str(self.home)))
+        return BatchedResult(command, process.stdout.strip(), process.stderr, process.returncode)
+
+    def put(self, local_path, remote_path, mode=None):
+        shutil.copy(local_path, remote_path)
+
+
+@pytest.fixture
+def project(tmp_path, monkeypatch):
+    host = LocalHost(tmp_path)
+    monkeypatch.setattr(helpers, 'run', host.run)
+    monkeypatch.setattr(helpers, 'put', host.put)
+    monkeypatch.setattr(helpers, '_manifest_script_paths', {})
+    monkeypatch.setattr(steps, 'sudo', host.run)
+    root = tmp_path / 'src'
+    (root / 'static').mkdir(parents=True)
+    (root / 'requirements.txt').write_text('fabric\n')
+    (root / 'static' / 'app.css').write_text('body {}\n')
+    return root
+
+
+def make_steps(root, ran, failing=()):
+    deploy_steps = DeploySteps(str(root.parent / 'state'), root=str(root))
+
+    def make_step(name):
+        def step():
+            if name in failing:
+                raise RuntimeError(f'{name} failed')
+            ran.append(name)
+        return step
+
+    deploy_steps.add('install_requirements', ['requirements*.txt'], make_step('install_requirements'))
+    deploy_steps.add('build_static', ['static/*'], make_step('build_static'))
+    deploy_steps.add('migrate', ['requirements*.txt', 'migrations/*'], make_step('migrate'))
+    return deploy_steps
+
+
+def run_steps(deploy_steps, **kwargs):
+    with settings(hide('everything'), host_string='web1'):
+        return deploy_steps.run(**kwargs)
+
+
+def test_steps_are_skipped_until_their_inputs_change(project):
+    ran = []
+    changes = run_steps(make_steps(project, ran))
+    assert ran == ['install_requirements', 'build_static', 'migrate']
+    assert changes == {'install_requirements': None, 'build_static': None, 'migrate': None}
+
+    ran.clear()
+    assert run_steps(make_steps(project, ran)) == {}
+    assert ran == []
+
+    (project / 'static' / 'app.css').write_text('body {color: red}\n')
+    assert run_steps(make_steps(project, ran)) == {'build_static': ['static/app.css']}
+    assert ran == ['build_static']
+
+    ran.clear()
+    run_steps(make_steps(project, ran), force=['migrate'])
+    assert ran == ['migrate']
+
+
+def test_only_succeeded_steps_are_recorded(project):
+    ran = []
+    with pytest.raises(RuntimeError, match='build_static failed'):
+        run_steps(make_steps(project, ran, failing=['build_static']))
+    # the step after the failed one is not run
+    assert ran == ['install_requirements']
+
+    ran.clear()
+    run_steps(make_steps(project, ran))
+    assert ran == ['build_static', 'migrate']
@@ -0,0 +1,230 @@
+# coding: utf-8
+import re
+
+import pytest
+
+pytest.importorskip('fabric.api')
+
+from fabric.api import abort, hide, settings  # noqa: E402
+from fabric.exceptions import NetworkError  # noqa: E402
+
+from fabric_utils import swarm  # noqa: E402
+from fabric_utils.batch import BatchedResult  # noqa: E402
+from fabric_utils.swarm import group_services, rollout_services  # noqa: E402
+
+
+class FakeDocker:
+    """
+    Fake docker cli, a service update converges after the given number of status checks
+    """
+
+    def __init__(self, checks_to_converge, failing=()):
+        self.checks_to_converge = checks_to_converge
+        self.failing = failing
+        self.updating = {}
+        self.updates = []
+        self.max_concurrent = 0
+        self.time = 0
+
+    def clock(self):
+        return self.time
+
+    def sleep(self, seconds):
+        self.time += seconds
+
+    def __call__(self, command):
+        if command.startswith('docker service update'):
+            service_name = command.split()[-1]
+            self.updates.append(service_name)
+            self.updating[service_name] = 0
+            self.max_concurrent = max(self.max_concurrent, len(self.updating))
+            return ''
+        service_names = re.match(r"docker service inspect --format '.+' (.+)$", command).group(1).split()
+        lines = []
+        for service_name in service_names:
+            self.updating[service_name] += 1
+            if service_name in self.failing:
+                state = 'paused'
+            elif self.updating[service_name] >= self.checks_to_converge.get(service_name, 1):
+                state = 'completed'
+                del self.updating[service_name]
+            else:
+                state = 'updating'
+            lines.append(f'{service_name} {state}')
+        return '\n'.join(lines)
+
+
+def rollout(docker, groups, **kwargs):
+    return rollout_services(docker, groups, 'docker service update --force',
+                            sleep=docker.sleep, clock=docker.clock, poll_interval=1, **kwargs)
+
+
+def test_group_services():
+    services = ['app_uwsgi', 'app_celery', 'app_celerybeat', 'app_nginx', '']
+    assert group_services(services, ['celery', 'uwsgi']) == [
+        ['app_celery', 'app_celerybeat'],
+        ['app_uwsgi'],
+        ['app_nginx'],
+    ]
+    assert group_services(services, []) == [['app_uwsgi', 'app_celery', 'app_celerybeat', 'app_nginx']]
+
+
+def test_rollout_services_concurrently():
+    docker = FakeDocker({'a': 3, 'b': 1, 'c': 2, 'd': 1})
+    rollouts = rollout(docker, [['a', 'b', 'c', 'd']], concurrency=2)
+    assert docker.max_concurrent == 2
+    assert {rollout.service: rollout.state for rollout in rollouts} == dict.fromkeys('abcd', 'completed')
+    assert [rollout.service for rollout in rollouts] == ['b', 'a', 'c', 'd']
+    assert {rollout.service: rollout.elapsed for rollout in rollouts}['a'] == 3
+    assert docker.time == 4
+
+
+def test_rollout_services_groups_in_order():
+    docker = FakeDocker({'worker': 3})
+    rollout(docker, [['worker'], ['web1', 'web2']], concurrency=5)
+    assert docker.updates == ['worker', 'web1', 'web2']
+
+
+def test_rollout_services_stops_on_failure():
+    docker = FakeDocker({'a': 5}, failing=['b'])
+    rollouts = rollout(docker, [['a', 'b', 'c'], ['d']], concurrency=2)
+    assert docker.updates == ['a', 'b']
+    assert {rollout.service: rollout.state for rollout in rollouts} == {'a': 'interrupted', 'b': 'paused'}
+
+
+def test_rollout_services_timeout():
+    docker = FakeDocker({'a': 100})
+    rollouts = rollout(docker, [['a']], timeout=10)
+    assert [(rollout.service, rollout.state) for rollout in rollouts] == [('a', 'timeout')]
+
+
+def test_rollout_services_timeout_without_status():
+    docker = FakeDocker({})
+
+    def inspect_nothing(command):
+        # e.g. the service has been removed or the status check failed quietly
+        return docker(command) if command.startswith('docker service update') else BatchedResult(command, '', '', 1)
+
+    rollouts = rollout_services(inspect_nothing, [['a', 'b']], 'docker service update --force', concurrency=2,
+                                timeout=10, poll_interval=1, sleep=docker.sleep, clock=docker.clock)
+    assert [(rollout.service, rollout.state) for rollout in rollouts] == [('a', 'timeout'), ('b', 'timeout')]
+    assert docker.time == 11
+
+
+class FakeManagers:
+    """
+    Stands for the managers ping, the latencies are answered in turn
+    """
+
+    def __init__(self, *answers):
+        self.answers = list(answers)
+        self.pings = 0
+        self.time = 1000.0
+        self.down = set()
+        self.checked = []
+
+    def is_up(self, host):
+        self.checked.append(host)
+        return host not in self.down
+
+    def ping(self, role):
+        self.pings += 1
+        return dict(self.answers.pop(0))
+
+
+@pytest.fixture
+def managers(monkeypatch):
+    managers = FakeManagers()
+    monkeypatch.setattr(swarm, '_ping_managers', managers.ping)
+    monkeypatch.setattr(swarm, '_is_manager_up', managers.is_up)
+    monkeypatch.setattr(swarm, 'time', lambda: managers.time)
+    monkeypatch.setattr(swarm, '_managers_cache', {})
+    monkeypatch.delenv('SWARM_MANAGERS_CACHE', raising=False)
+    return managers
+
+
+def select_manager(**kwargs):
+    with settings(hide('everything')):
+        return swarm.docker_swarm_select_manager('managers', **kwargs)
+
+
+def test_managers_are_cached_for_ttl(managers):
+    managers.answers = [{'m1': 0.2, 'm2': 0.1}, {'m1': 0.1, 'm2': None}]
+    assert select_manager(ttl=60) == 'm2'
+    managers.time += 59
+    assert select_manager(ttl=60) == 'm2'
+    assert managers.pings == 1
+
+    managers.time += 2
+    assert select_manager(ttl=60) == 'm1'
+    assert managers.pings == 2
+
+
+def test_failed_manager_is_not_picked_again(managers):
+    managers.answers = [{'m1': 0.1, 'm2': 0.2}, {'m1': 0.1, 'm2': 0.2}]
+    nodes = []
+
+    @swarm.with_swarm_node('managers')
+    def deploy(node):
+        nodes.append(node)
+        if len(nodes) == 1:
+            raise NetworkError('connection lost')
+
+    with settings(hide('everything')):
+        with pytest.raises(NetworkError):
+            deploy()
+        deploy()
+    assert nodes == ['m1', 'm2']
+    assert managers.pings == 1
+    assert managers.checked == []
+
+    # once every cached manager has failed, the managers are checked again
+    swarm.invalidate_swarm_manager('managers', 'm2')
+    assert select_manager() == 'm1'
+    assert managers.pings == 2
+
+
+def test_manager_is_kept_when_the_task_fails(managers):
+    managers.answers = [{'m1': 0.1, 'm2': 0.2}]
+    nodes = []
+
+    @swarm.with_swarm_node('managers')
+    def migrate(node):
+        nodes.append(node)
+        if len(nodes) < 3:
+            abort('migration failed')
+
+    with settings(hide('everything')):
+        with pytest.raises(SystemExit):
+            migrate()
+        # e.g. the connection to the manager was lost and fabric aborted
+        managers.down.add('m1')
+        with pytest.raises(SystemExit):
+            migrate()
+        migrate()
+    assert nodes == ['m1', 'm1', 'm2']
+    assert managers.checked == ['m1', 'm1']
+    assert managers.pings == 1
+
+
+def test_all_managers_failed(managers):
+    managers.answers = [{'m1': None, 'm2': None}]
+    with pytest.raises(SystemExit):
+        select_manager()
+
+
+def test_managers_cache_is_shared_on_disk(managers, tmp_path, monkeypatch):
+    cache_path = str(tmp_path / 'managers.json')
+    managers.answers = [{'m1': 0.3, 'm2': 0.1}]
+    assert select_manager(cache_path=cache_path) == 'm2'
+
+    # another fab run starts with an empty cache in memory
+    monkeypatch.setattr(swarm, '_managers_cache', {})
+    monkeypatch.setenv('SWARM_MANAGERS_CACHE', cache_path)
+    assert select_manager() == 'm2'
+    assert managers.pings == 1
+
+    swarm.invalidate_swarm_manager('managers', 'm2')
+    monkeypatch.setattr(swarm, '_managers_cache', {})
+    assert select_manager() == 'm1'
+    assert managers.pings == 1
@@ -0,0 +1,116 @@
+# coding: utf-8
+import os
+
+import pytest
+
+pytest.importorskip('fabric.api')
+
+from fabric.api import env, hide, settings  # noqa: E402
+
+from fabric_utils.batch import BatchedResult  # noqa: E402
+from fabric_utils.healthcheck import quorum  # noqa: E402
+from fabric_utils.lease import Lease, MemoryLeaseBackend  # noqa: E402
+from fabric_utils.waves import deploy_in_waves, plan_waves  # noqa: E402
+
+HOSTS = [f'app{idx}' for idx in range(7)]
+
+
+def test_waves_grow_from_the_canary():
+    assert plan_waves(HOSTS) == [['app0'], ['app1', 'app2'], ['app3', 'app4', 'app5', 'app6']]
+    assert plan_waves(HOSTS, canary=2, growth=3) == [['app0', 'app1'], ['app2', 'app3', 'app4', 'app5', 'app6']]
+    assert plan_waves(HOSTS + ['app0'], growth=10, max_wave_size=4) == [['app0'], ['app1', 'app2', 'app3', 'app4'],
+                                                                       ['app5', 'app6']]
+    with pytest.raises(ValueError):
+        plan_waves(HOSTS, canary=0)
+
+
+class Recorder:
+
+    def __init__(self, down_hosts=()):
+        self.events = []
+        self.down_hosts = set(down_hosts)
+
+    def upload(self):
+        self.events.append(('upload', env.host_string))
+
+    def activate(self):
+        self.events.append(('activate', env.host_string))
+
+    def check(self):
+        self.events.append(('check', env.host_string))
+        return_code = 1 if env.host_string in self.down_hosts else 0
+        return BatchedResult('curl', '', '', return_code)
+
+    def deploy(self, **kwargs):
+        with settings(hide('everything')):
+            return deploy_in_waves(self.upload, self.activate, self.check, hosts=HOSTS, concurrency=1,
+                                   max_wait=0, **kwargs)
+
+
+def test_next_wave_is_uploaded_while_the_previous_one_is_checked():
+    recorder = Recorder()
+    results = recorder.deploy()
+
+    assert list(results) == HOSTS
+    assert all(result.succeeded for result in results.values())
+    events = recorder.events
+    assert events[:5] == [('upload', 'app0'), ('activate', 'app0'), ('check', 'app0'),
+                          ('upload', 'app1'), ('upload', 'app2')]
+    # a wave is activated only after the previous wave is up
+    assert events.index(('check', 'app2')) < events.index(('activate', 'app3'))
+    assert events.index(('upload', 'app6')) < events.index(('activate', 'app3'))
+
+
+def test_failed_wave_stops_the_deploy():
+    recorder = Recorder(down_hosts=['app1'])
+    with pytest.raises(SystemExit):
+        recorder.deploy()
+    # the last wave is uploaded but never activated
+    assert ('upload', 'app6') in recorder.events
+    assert ('activate', 'app3') not in recorder.events
+
+    recorder = Recorder(down_hosts=['app1'])
+    results = recorder.deploy(check=quorum(0.5))
+    assert [host for host, result in results.items() if not result.succeeded] == ['app1']
+
+
+def test_deploy_holds_the_lease():
+    backend = MemoryLeaseBackend()
+    holder = Lease(backend, 'deploy', owner='someone')
+    recorder = Recorder()
+    with holder:
+        with pytest.raises(SystemExit):
+            recorder.deploy(lease=Lease(backend, 'deploy', owner='me'))
+    assert recorder.events == []
+
+    lease = Lease(backend, 'deploy', owner='me')
+    recorder.deploy(lease=lease)
+    assert lease.token is None
+    assert backend.holder('deploy') is None
+
+
+def test_waves_run_in_parallel():
+    with settings(hide('everything')):
+        results = deploy_in_waves(lambda: None, lambda: None, lambda: BatchedResult('curl', '', '', 0),
+                                  hosts=HOSTS, growth=3)
+    assert sorted(results) == HOSTS
+    assert all(result.phase == 'activate' and result.succeeded for result in results.values())
+
+
+def test_failed_parallel_wave_stops_the_deploy(tmp_path):
+    def activate():
+        (tmp_path / env.host_string).touch()
+        if env.host_string == 'app2':
+            # e.g. the worker is killed
+            os._exit(1)
+
+    with settings(hide('everything'), warn_only=True):
+        with pytest.raises(SystemExit):
+            deploy_in_waves(lambda: None, activate, lambda: BatchedResult('curl', '', '', 0), hosts=HOSTS)
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['app0', 'app1', 'app2']
+
+    with settings(hide('everything'), warn_only=True):
+        results = deploy_in_waves(lambda: None, activate, lambda: BatchedResult('curl', '', '', 0),
+                                  hosts=HOSTS, check=quorum(0.5))
+    assert [host for host, result in results.items() if not result.succeeded] == ['app2']
+    assert results['app2'].phase == 'activate' and results['app2'].error